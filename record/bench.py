@@ -0,0 +1,353 @@
+#
+# bench.py
+#   Benchmarks for the recorder. Measures capture throughput and loss from
+#   a synthetic stream, and get, decode, csv and plot times of synthetic
+#   recordings of increasing size. Results are saved as JSON s.t. runs can
+#   be compared with --compare. It drives the recorder through record.py,
+#   which imports atom, so it needs atom installed even with --no-capture
+#
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import time
+from threading import Thread, Event
+
+import msgpack
+import numpy as np
+
+import record
+
+# Prefix of the names of everything the benchmark writes s.t. it can clean
+#   up after itself
+BENCH_PREFIX = "_bench_"
+
+# Payload shapes. Small float vectors, like most sensor streams, and large
+#   binary blobs, like camera frames
+SHAPES = ("vector", "blob")
+
+# Entries per batch written to synthetic recordings, same as the readers
+SYNTH_BATCH_LEN = record.READER_BATCH_LEN
+
+# How often to sample the recorder's stats during a capture
+STATS_SAMPLE_SEC = 0.25
+
+def _payloads(shape, n, args, rng):
+    '''
+    Returns n entries of the given shape, as a producer would write them
+    with serialize=True
+    '''
+    if shape == "vector":
+        values = rng.standard_normal((n, args.vector_len)).tolist()
+        return [{"v": msgpack.packb(v), "t": msgpack.packb(1000.0 + i / 100)} for (i, v) in enumerate(values)]
+    return [{"data": msgpack.packb(rng.bytes(args.blob_kb * 1024)), "t": msgpack.packb(1000.0 + i / 100)}
+        for i in range(n)]
+
+def _entry_bytes(shape, args):
+    '''
+    Returns about how many bytes an entry of the shape packs to
+    '''
+    entry = dict(_payloads(shape, 1, args, np.random.default_rng(0))[0], id="1600000000000-0")
+    return len(msgpack.packb(entry, use_bin_type=True))
+
+def _percentiles(samples):
+    '''
+    Returns the p50, p95 and max of a list of times in seconds, in ms
+    '''
+    ms = np.array(samples) * 1000
+    return {"p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)), "max": float(ms.max())}
+
+def _check(response):
+    '''
+    Raises if a command failed, else returns the response
+    '''
+    if response.err_code != 0:
+        raise RuntimeError("Command failed with {}: {}".format(response.err_code, response.err_str))
+    return response
+
+def _cleanup():
+    '''
+    Removes everything the benchmark wrote
+    '''
+    for f in glob.glob(os.path.join(record.TEMP_RECORDING_LOC, BENCH_PREFIX + "*")):
+        if os.path.isdir(f):
+            record._remove_segments(f)
+        else:
+            os.remove(f)
+
+class Producer(Thread):
+    '''
+    Writes entries of a shape to a stream at a fixed rate, noting the ID of
+    each. Entries are written on schedule s.t. rates above what sleep can
+    pace still come out right on average
+    '''
+    def __init__(self, name, shape, rate, args):
+        super().__init__(daemon=True)
+        self.elem = record.Element(name, host=record.ATOM_HOST)
+        self.shape = shape
+        self.rate = rate
+        self.maxlen = args.maxlen
+        self.payloads = _payloads(shape, min(max(rate, 1), 1000), args, np.random.default_rng(0))
+        self.ids = []
+        self.stop = Event()
+        self.seconds = 0.0
+
+    def run(self):
+        start = time.monotonic()
+        while not self.stop.is_set():
+            due = int((time.monotonic() - start) * self.rate)
+            while len(self.ids) < due:
+                entry = self.payloads[len(self.ids) % len(self.payloads)]
+                self.ids.append(record._split_id(self.elem.entry_write(self.shape, entry, maxlen=self.maxlen)))
+            time.sleep(0.001)
+        self.seconds = time.monotonic() - start
+
+def bench_capture(shape, rate, args):
+    '''
+    Records a synthetic stream for args.seconds and returns the capture
+    throughput, the entries lost and what the recorder's time went on
+    '''
+    producer = Producer("{}{}".format(BENCH_PREFIX, shape), shape, rate, args)
+    producer.start()
+    time.sleep(0.5)
+
+    name = "{}capture_{}_{}".format(BENCH_PREFIX, shape, rate)
+    request = {"name": name, "e": producer.elem.name, "s": shape, "t": args.seconds, "mode": "continuous"}
+    if args.codec is not None:
+        request["codec"] = args.codec
+    if args.encoding is not None:
+        request["encoding"] = args.encoding
+    _check(record.start_recording(request))
+
+    # Sample the stats until the recording finishes. The last sample has
+    #   the times, the lag is the worst we saw
+    stats = {}
+    max_lag = 0
+    recording = record.active_recordings[name]
+    while not recording.join(STATS_SAMPLE_SEC):
+        stats = record._recorder_stats().get(name, stats)
+        if stats.get("lag_ms") is not None:
+            max_lag = max(max_lag, stats["lag_ms"])
+    producer.stop.set()
+    producer.join()
+
+    # Anything the producer wrote between the first and last entries we
+    #   recorded that isn't in the recording was lost
+    filename = os.path.join(record.TEMP_RECORDING_LOC, name + record.RECORDING_EXTENSION)
+    index = record._load_index(filename)
+    recorded = len(index)
+    produced = 0
+    if recorded > 0:
+        first = (int(index["ts"][0]), int(index["seq"][0]))
+        last = (int(index["ts"][-1]), int(index["seq"][-1]))
+        produced = sum(1 for i in producer.ids if first <= i <= last)
+
+    return {
+        "shape": shape,
+        "rate": rate,
+        "produced_per_sec": len(producer.ids) / producer.seconds,
+        "recorded": recorded,
+        "lost": produced - recorded,
+        "gaps": recording.gaps,
+        "entries_per_sec": recorded / args.seconds,
+        "bytes_per_sec": os.path.getsize(filename) / args.seconds,
+        "max_lag_ms": max_lag,
+        "read_sec": stats.get("read_sec"),
+        "pack_sec": stats.get("pack_sec"),
+        "blocked_sec": stats.get("blocked_sec"),
+        "write_sec": stats.get("write_sec"),
+        "mean_batch": stats.get("mean_batch"),
+        "full_batches": stats.get("full_batches"),
+        "max_queue": recording.writer.max_queued,
+    }
+
+def write_synthetic(name, shape, n, args):
+    '''
+    Writes a recording of n entries of the shape straight to disk, the same
+    way the recorder would have. Returns its filename
+    '''
+    filename = os.path.join(record.TEMP_RECORDING_LOC, name + record.RECORDING_EXTENSION)
+    header = {"sources": [["bench", shape]]}
+    if args.codec is not None:
+        header["codec"] = args.codec
+    recording_file = record.RecordingFile(filename, header=header, codec=args.codec,
+        typed=(args.encoding == "typed"))
+
+    rng = np.random.default_rng(0)
+    ts = 1600000000000
+    keys = set()
+    for start in range(0, n, SYNTH_BATCH_LEN):
+        batch = []
+        for (i, entry) in enumerate(_payloads(shape, min(SYNTH_BATCH_LEN, n - start), args, rng)):
+            keys.update(entry)
+            redis_id = "{}-0".format(ts + start + i)
+            batch.append((msgpack.packb(dict(entry, id=redis_id), use_bin_type=True), ts + start + i, 0, 0))
+        recording_file.write_batch(batch)
+
+    recording_file.footer = {"sources": header["sources"], "keys": [sorted(keys)], "gaps": 0}
+    recording_file.close()
+    return filename
+
+def bench_read(shape, mb, args):
+    '''
+    Writes a synthetic recording of about mb megabytes and times windowed
+    gets, a full decode, a csv conversion and a plot of it
+    '''
+    n = max(int(mb * 1024 * 1024 / _entry_bytes(shape, args)), args.window_len)
+    name = "{}read_{}_{}".format(BENCH_PREFIX, shape, mb)
+    start = time.monotonic()
+    filename = write_synthetic(name, shape, n, args)
+    result = {"shape": shape, "mb": mb, "entries": n, "bytes": os.path.getsize(filename),
+        "write_sec": time.monotonic() - start}
+
+    # Windows of the recording at random spots, through the command s.t.
+    #   loading the index and packing the response count
+    rng = np.random.default_rng(1)
+    times = []
+    for start_idx in rng.integers(0, n - args.window_len + 1, args.windows).tolist():
+        start = time.monotonic()
+        _check(record.get_recording({"name": name, "msgpack": True, "start": start_idx,
+            "stop": start_idx + args.window_len - 1}))
+        times.append(time.monotonic() - start)
+    result["get_ms"] = _percentiles(times)
+
+    # The whole recording, with nothing cached
+    record.recording_cache = record.RecordingCache(record.CACHE_BUDGET)
+    start = time.monotonic()
+    record._get_recording({"name": name, "msgpack": True})
+    result["decode_sec"] = time.monotonic() - start
+    record.recording_cache = record.RecordingCache(record.CACHE_BUDGET)
+
+    # Blobs don't make sense as CSV columns or lines, so only their small
+    #   key is converted and plotted, skipping over the blobs
+    key = "v" if shape == "vector" else "t"
+    start = time.monotonic()
+    _check(record.csv_recording({"name": name, "msgpack": True, "keys": [key]}))
+    result["csv_sec"] = time.monotonic() - start
+
+    start = time.monotonic()
+    job = msgpack.unpackb(_check(record.plot_recording({"name": name, "msgpack": True, "show": False,
+        "max_points": args.plot_points, "plots": [{"data": [["x[0]" if shape == "vector" else "x", [key], "value"]]}]})).data,
+        raw=False)["job"]
+    _check(record.plot_result({"job": job, "wait": True}))
+    result["plot_sec"] = time.monotonic() - start
+
+    return result
+
+def _warm_up(args):
+    '''
+    Starts the plot and export processes s.t. their startup isn't counted
+    against the first recording
+    '''
+    name = BENCH_PREFIX + "warmup"
+    write_synthetic(name, "vector", 100, args)
+    record._export_pool().submit(time.sleep, 0).result()
+    job = msgpack.unpackb(record.plot_recording({"name": name, "msgpack": True, "show": False,
+        "plots": [{"data": [["x[0]", ["v"], "value"]]}]}).data, raw=False)["job"]
+    record.plot_result({"job": job, "wait": True})
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, old):
+    '''
+    Prints each number of the results next to the same one from an old run
+    '''
+    for phase, fields in (("capture", ("shape", "rate")), ("read", ("shape", "mb"))):
+        old_rows = {tuple(row[f] for f in fields): row for row in old.get(phase, [])}
+        for row in results.get(phase, []):
+            key = tuple(row[f] for f in fields)
+            if key not in old_rows:
+                continue
+            print("{} {}".format(phase, " ".join(str(k) for k in key)))
+            for (metric, value) in row.items():
+                old_value = old_rows[key].get(metric)
+                if isinstance(value, dict) and isinstance(old_value, dict):
+                    pairs = [("{}.{}".format(metric, k), v, old_value.get(k)) for (k, v) in value.items()]
+                else:
+                    pairs = [(metric, value, old_value)]
+                for (label, new, before) in pairs:
+                    if (metric in fields) or (type(new) not in (int, float)) or (type(before) not in (int, float)):
+                        continue
+                    change = "{:+.1f}%".format(100 * (new - before) / before) if before != 0 else ""
+                    print("  {:<24} {:>14.4g} {:>14.4g} {:>9}".format(label, before, new, change))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recorder",
+        epilog="Needs atom installed, as the recorder imports it. Only the capture benchmarks need Redis")
+    parser.add_argument("--out", default=None, help="JSON file to save the results to")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--shapes", nargs="+", default=list(SHAPES), choices=SHAPES)
+    parser.add_argument("--rates", nargs="+", type=int, default=[100, 1000],
+        help="Entries per second to capture at")
+    parser.add_argument("--seconds", type=int, default=5, help="Length of each capture")
+    parser.add_argument("--maxlen", type=int, default=10000, help="Length the stream is capped at")
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1, 10, 100],
+        help="Sizes of the recordings to read, in MB")
+    parser.add_argument("--vector-len", type=int, default=8)
+    parser.add_argument("--blob-kb", type=int, default=64)
+    parser.add_argument("--windows", type=int, default=20, help="Number of windowed gets per recording")
+    parser.add_argument("--window-len", type=int, default=100, help="Entries per windowed get")
+    parser.add_argument("--plot-points", type=int, default=2000)
+    parser.add_argument("--codec", default=None, choices=list(record.CODECS.keys()))
+    parser.add_argument("--encoding", default=None, choices=record.ENCODINGS)
+    parser.add_argument("--host", default=record.ATOM_HOST, help="Redis host for the capture benchmarks")
+    parser.add_argument("--no-capture", action="store_true",
+        help="Skip the capture benchmarks, which need Redis. The rest run without it, but still need atom")
+    args = parser.parse_args()
+    record.ATOM_HOST = args.host
+
+    results = {
+        "meta": {
+            "time": datetime.datetime.now().isoformat(),
+            "revision": _git_revision(),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "msgpack": ".".join(str(v) for v in msgpack.version),
+            "args": vars(args),
+        },
+        "capture": [],
+        "read": [],
+    }
+
+    try:
+        if not args.no_capture:
+            for shape in args.shapes:
+                for rate in args.rates:
+                    results["capture"].append(bench_capture(shape, rate, args))
+                    print("capture", json.dumps(results["capture"][-1]), flush=True)
+
+        _warm_up(args)
+        for shape in args.shapes:
+            for mb in args.sizes:
+                results["read"].append(bench_read(shape, mb, args))
+                print("read", json.dumps(results["read"][-1]), flush=True)
+                _cleanup()
+    finally:
+        _cleanup()
+
+    out = args.out or "bench-{}.json".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Saved results to {}".format(out))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    # The pools don't need to finish anything
+    for pool in (record.plot_pool, record.export_pool):
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,27 @@
 #
 from atom import Element
 from atom.messages import Response, LogLevel
-from threading import Thread
+from threading import Thread, Condition, Event, Lock
+from collections import OrderedDict, deque
+from queue import Queue, Empty, Full
+from concurrent.futures import ProcessPoolExecutor, Future
+import multiprocessing
 import time
 import msgpack
 import os
+import shutil
 import matplotlib.pyplot as plt
 import numpy as np
 import math
+import itertools
+import struct
+import base64
+import zlib
+import io
+import zipfile
+import bisect
+import mmap
+import errno
 
 # Where to store temporary recordings
 TEMP_RECORDING_LOC = "/shared"
@@ -21,6 +35,12 @@ PERM_RECORDING_LOC = "/recordings"
 # Recording extension
 RECORDING_EXTENSION = ".atomrec"
 
+# Segmented recordings are a folder of numbered recording files along with
+#   a manifest noting the byte offset, entry count and ID range of each
+#   segment
+SEGMENT_EXTENSION = ".atomseg"
+MANIFEST_FILENAME = "manifest"
+
 # Default number of seconds to record for
 DEFAULT_N_SEC = 10
 
@@ -30,483 +50,3967 @@ POLL_INTERVAL = 0.1
 # Max time to block for data
 BLOCK_MS = 1000
 
-# Active recording threads
-active_recordings = {}
+# Sidecar index stored next to each recording. It's a small header followed
+#   by one fixed-size row per entry noting where the entry starts in the
+#   recording file, the redis ID of the entry and which of the recording's
+#   sources it came from s.t. reads can seek straight to the entries they
+#   want. For compressed recordings the offset is of the block the entry is
+#   in and pos is where the entry is in the block
+INDEX_EXTENSION = ".atomidx"
+INDEX_MAGIC = b"ATOMIDX"
+INDEX_VERSION = 3
+INDEX_HEADER = INDEX_MAGIC + bytes([INDEX_VERSION])
+INDEX_ROW = struct.Struct("<QQQII")
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("ts", "<u8"), ("seq", "<u8"), ("src", "<u4"), ("pos", "<u4")])
 
-ATOM_HOST=os.getenv("ATOM_HOST", None)
+# Codecs that compressed recordings can use, name -> (compress, decompress).
+#   zlib is always available, others are added if their packages are
+#   installed
+CODECS = {"zlib": (zlib.compress, zlib.decompress)}
+try:
+    import lz4.frame
+    CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+try:
+    import zstandard
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
 
-def record_fn(name, n_entries, n_sec, perm, element, stream):
-    '''
-    Mainloop for a recording thread. Creates a new
-    element with the proper name and listens on and
-    records the stream until we're told to stop
-    '''
-    global active_recordings
+# Every recording ends with a footer summarizing it followed by a fixed-size
+#   trailer holding the offset of the footer, s.t. the summary can be read
+#   without reading the rest of the file
+TRAILER_LEN = 32
 
-    # Make an element from the name
-    record_elem = Element("record_" + name, host=ATOM_HOST)
+# Default uncompressed size of a block of entries in a compressed recording
+BLOCK_SIZE = 256 * 1024
 
-    # Open the file for the recording
-    filename = os.path.join(
-        PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC, name + RECORDING_EXTENSION)
-    try:
-        record_file = open(filename, 'wb')
-    except:
-        record_elem.log(
-            LogLevel.ERR, "Unable to open file {}".format(filename))
-        del active_recordings[name]
-        return
-
-    # At the outer loop, we want to loop until we've been cancelled
-    last_id = "$"
-    intervals = 0
-    entries_read = 0
-    while name in active_recordings:
-
-        # Read the data
-        data = record_elem.entry_read_since(element, stream, last_id, n=n_entries, block=BLOCK_MS)
-
-        # If we got no data, then we should finish up
-        if len(data) == 0:
-            record_elem.log(
-                LogLevel.ERR,
-                "Recording {}: no data after {} entries read!".format(
-                    name,
-                    entries_read))
-            break
+# Encodings of the values of a recording. Typed recordings are written in
+#   blocks, and keys whose values are numbers or arrays of numbers of the
+#   same shape in every entry of a block are stored as one little-endian
+#   array for the block, optionally delta-encoded against the previous
+#   entry. They're read back with frombuffer. Everything else is stored as
+#   usual
+ENCODINGS = ("msgpack", "typed")
 
-        entries_read += len(data)
+# Max time a partial block waits before it's compressed and written out
+#   anyway s.t. readers of an active recording see recent entries
+BLOCK_FLUSH_SEC = 1.0
 
-        # We're going to pack up each entry into a msgpack item and
-        #   then write it to the file. If it's already msgpack'd
-        #   that's totally fine, this will just pack up the keys and ID
-        for entry in data:
-            packed_data = msgpack.packb(entry, use_bin_type=True)
+# Key marking records in a recording file that aren't stream entries, i.e.
+#   headers and gap markers. The value of the key is the type of the record
+MARKER_KEY = "_atomrec"
 
-            # Write the packed data to file
-            record_file.write(packed_data)
+# Key tagging each entry of a recording with more than one source with
+#   the index of its source in the header
+SOURCE_KEY = "_src"
 
-        # If n_entries is not none then we want to subtract
-        #   off the number of entries left and perhaps break out
-        if n_entries is not None:
-            n_enties -= len(data)
-            if (n_enties <= 0):
-                break
+# Recording modes. Poll sleeps for POLL_INTERVAL between reads, continuous
+#   reads back to back for high-rate streams. Ring reads back to back into
+#   an in-memory ring which is only written out when triggered
+RECORDING_MODES = ("poll", "continuous", "ring")
 
-        # Otherwise see if we've recorded for longer than our
-        #   elapsed time
-        else:
-            intervals += 1
-            if (intervals * POLL_INTERVAL) >= n_sec:
-                break
+# Max number of packed batches that can be waiting on the writer of a
+#   recording before the reader blocks
+WRITE_QUEUE_LEN = 64
 
-        # If we got here, we should sleep for the interval before
-        #   making the next call
-        time.sleep(POLL_INTERVAL)
+# Fraction of the write queue that needs to be full before we warn about it
+WRITE_QUEUE_WARN = 0.75
 
-        # And update the last ID
-        last_id = data[-1]["id"]
+# Policies for syncing recordings to disk. A number of seconds can also be
+#   given to sync at most that often
+FSYNC_POLICIES = ("never", "close")
 
-    # Once we're out of here we want to note that we're no longer
-    #   active in the global system. It might be that someone else popped
-    #   it out through already in the "stop" command
-    if name in active_recordings:
-        thread = active_recordings.pop(name)
+# Number of threads reading redis for all of the active recordings. Each one
+#   has its own element and so its own redis connection
+READER_POOL_SIZE = int(os.getenv("RECORD_READERS", 2))
 
-    # And we want to close the file
-    record_file.close()
+# Number of threads writing to disk for all of the active recordings
+WRITER_POOL_SIZE = int(os.getenv("RECORD_WRITERS", 2))
 
-    # And log that we completed the recording
-    record_elem.log(LogLevel.INFO, "Finished recording {} with {} entries read".format(
-        name, entries_read))
+# Max entries to read from each stream in a single read
+READER_BATCH_LEN = 1000
 
+# Interval in seconds at which the stats of the active recordings are
+#   published on streams of the stats element, one stream per recording.
+#   0 to not publish them. Can be changed with the stats command
+STATS_PUBLISH_SEC = float(os.getenv("RECORD_STATS_SEC", 0))
+STATS_ELEMENT = "record_stats"
+STATS_MAXLEN = 1024
 
-def start_recording(data):
+# Max time a reader blocks for data. Kept short s.t. readers pick up new
+#   and stopped recordings quickly
+READER_BLOCK_MS = 100
 
-    # Data should be a dictionary with the following keys
-    #   name: required. String for the name of the recording
-    #   t: Optional time (in seconds) to record for. If omitted, will
-    #           default to 10
-    #   n: Optional number of entries to record for. If omitted will default
-    #           to default time. If both time and n are specified, n will
-    #           take precedence
-    #   perm: Optional boolean to make the recording persistent/permanent.
-    #           Will store the recording in a different location if so
-    #   e: Required element name
-    #   s: Required stream name
-    global active_recordings
+# A reader retries after a failed read, e.g. a dropped redis connection,
+#   waiting this many seconds more after each try. Its recordings are only
+#   finished once this many reads in a row have failed
+READER_RETRY_SEC = 0.5
+READER_RETRIES = 3
 
-    # Make sure we got a name
-    if ("name" not in data) or (type(data["name"]) is not str):
-        return Response(err_code=1, err_str="name must be in data", serialize=True)
+# When reading entries that aren't contiguous we skip forward through the
+#   file if the next one is within this many bytes, else seek to it
+READ_SKIP_BYTES = 64 * 1024
 
-    # Make sure we got an element
-    if ("e" not in data) or (type(data["e"]) is not str):
-        return Response(err_code=2, err_str="element must be in data", serialize=True)
+# Number of index rows sized at a time when filling a page of a paginated
+#   get up to its max_bytes
+PAGE_SCAN_LEN = 4096
 
-    # Make sure we got a stream
-    if ("s" not in data) or (type(data["s"]) is not str):
-        return Response(err_code=3, err_str="stream must be in data", serialize=True)
+# Raw gets slice the keys and values of entries straight out of the
+#   memory-mapped recording. These are the packed keys they look for and,
+#   for the msgpack types they step over, the bytes of length and the extra
+#   bytes before the data, the bytes of item count and items per count, or
+#   the total size
+PACKED_ID = msgpack.packb("id")
+PACKED_SOURCE = msgpack.packb(SOURCE_KEY)
+PACKED_MARKER = msgpack.packb(MARKER_KEY)
+PACKED_LENGTHS = {0xc4: (1, 0), 0xc5: (2, 0), 0xc6: (4, 0), 0xc7: (1, 1), 0xc8: (2, 1), 0xc9: (4, 1),
+    0xd9: (1, 0), 0xda: (2, 0), 0xdb: (4, 0)}
+PACKED_CONTAINERS = {0xdc: (2, 1), 0xdd: (4, 1), 0xde: (2, 2), 0xdf: (4, 2)}
+PACKED_FIXED = {0xca: 5, 0xcb: 9, 0xcc: 2, 0xcd: 3, 0xce: 5, 0xcf: 9, 0xd0: 2, 0xd1: 3, 0xd2: 5, 0xd3: 9,
+    0xd4: 3, 0xd5: 4, 0xd6: 6, 0xd7: 10, 0xd8: 18}
 
-    # Get the name
-    name = data["name"]
-    element = data["e"]
-    stream = data["s"]
+# slice and merge copy runs of whole records between recordings in the
+#   kernel, at most this many bytes per call
+COPY_CHUNK_BYTES = 1024 * 1024 * 1024
 
-    # Check that the name is not in use
-    if name in active_recordings:
-        return Response(err_code=4, err_str="Name {} already in use".format(name), serialize=True)
+# Memory budget of the cache of decoded recordings, in bytes. get, and csv
+#   of up to CSV_CHUNK_LEN entries, decode through the cache of the element
+#   itself. Plots and longer csvs decode in the plot and export processes,
+#   each of which keeps a cache of its share of the budget, so at worst
+#   this is held three times over
+CACHE_BUDGET = int(os.getenv("RECORD_CACHE_MB", 256)) * 1024 * 1024
 
-    n_entries = None
-    n_sec = DEFAULT_N_SEC
-    perm = False
+# Counters of each cache of decoded recordings, in the order the plot and
+#   export processes note them for cache_stats
+CACHE_COUNTERS = ("hits", "misses", "evictions", "windows", "bytes", "budget")
 
-    # Process either the n or t values that came in over the API
-    if ("n" in data) and (type(data["n"]) is int):
-        n_entries = data["n"]
-    if ("t" in data) and (type(data["t"]) is int):
-        n_sec = data["t"]
-    if ("perm" in data) and (type(data["perm"]) is bool):
-        perm = data["perm"]
+# Number of entries, spread over a recording, on which a vectorized plot or
+#   csv lambda is checked against running it on the single entry
+VECTOR_CHECK_LEN = 8
 
-        # If we have a permanent data request, make sure the user has
-        #   mounted a permanent location
-        if perm and not os.path.exists(PERM_RECORDING_LOC):
-            return Response(err_code=5, err_str="Please mount {} in your docker-compose file".format(PERM_RECORDING_LOC), serialize=True)
+# Ways of downsampling a series for plot and get with max_points. minmax
+#   keeps the min and max of each bucket s.t. spikes stay visible, lttb
+#   (largest triangle three buckets) keeps the points that best preserve
+#   the shape of the series
+DOWNSAMPLE_METHODS = ("minmax", "lttb")
 
-    # Spawn a new thread that will go ahead and do the recording
-    thread = Thread(target=record_fn, args=(name, n_entries, n_sec, perm, element, stream,), daemon=True)
+# Summaries of recordings without a footer (i.e. recordings that were
+#   interrupted) from scanning them, filename -> ((mtime, size), summary)
+summary_cache = {}
 
-    # Put the thread into the active_recordings struct
-    active_recordings[name] = thread
+# Number of processes rendering plots, s.t. several plots can render at
+#   once without holding up the recorder or other commands
+PLOT_POOL_SIZE = int(os.getenv("RECORD_PLOTTERS", 2))
 
-    thread.start()
+# Image formats plots can be rendered to
+PLOT_FORMATS = ("png", "svg")
 
-    # Make the response
-    return Response(\
-        "Started recording {} for {} and storing in {}".format(
-            name, \
-            "{} entries".format(n_entries) if n_entries != None else "{} seconds".format(n_sec), \
-            PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC), \
-        serialize=True)
+# Seconds the result of a finished plot job is kept for plot_result to pick
+#   up. Results that aren't picked up in time are dropped s.t. rendered
+#   images don't pile up
+PLOT_RESULT_TTL = 600
 
-def stop_recording(data):
-    '''
-    Stops a recording. Data should be a msgpack'd string of the name
-    '''
-    # Active recordings
-    global active_recordings
+# Seconds the result of a finished csv, export, slice or merge job is kept
+#   for job_result to pick up
+JOB_RESULT_TTL = 600
 
-    # Make sure the recording is active
-    if data not in active_recordings:
-        return Response(err_code=1, err_str="Recording {} not active".format(data), serialize=True)
+# Number of processes converting recordings for export. Defaults to one per
+#   core s.t. long exports use the whole machine. Long reads for get are
+#   decoded in the same processes. Each plot process starts its own, with
+#   its share of this many
+EXPORT_POOL_SIZE = int(os.getenv("RECORD_EXPORTERS", os.cpu_count() or 2))
 
-    # Note the thread and delete it from the active recordings object
-    thread = active_recordings.pop(data)
+# Fewest entries decoded by one process when a read is split up across the
+#   export processes. Reads of fewer than twice this are decoded inline
+DECODE_CHUNK_LEN = 10000
 
-    # Wait for the recording thread to finish
-    thread.join()
+# Number of entries converted to CSV at a time. Recordings longer than this
+#   are converted chunk by chunk in the export processes
+CSV_CHUNK_LEN = 20000
 
-    return Response("Success", serialize=True)
+# Buffer size of the CSV files we write
+CSV_WRITE_BUFFER = 1024 * 1024
 
-def wait_recording(data):
+# Formats recordings can be exported to with export
+EXPORT_FORMATS = ("npy", "npz")
+
+# Number of entries exported at a time
+EXPORT_CHUNK_LEN = 20000
+
+# Size of the headers of the .npy files we export. Big enough for any shape
+#   s.t. the header can be filled in once we know the number of entries
+NPY_HEADER_LEN = 256
+
+# Number of entries the replay prefetch thread decodes at a time, and the
+#   number of decoded chunks it keeps ahead of the publisher
+REPLAY_PREFETCH_LEN = 1000
+REPLAY_PREFETCH_CHUNKS = 4
+
+# Default max length of the streams replays publish on
+REPLAY_MAXLEN = 1024
+
+# Lambdas for plot and csv, compiled once. (argument, expression) -> lambda
+lambda_cache = {}
+
+# Plot processes, started with the first plot, and the plot jobs that
+#   haven't been picked up yet, job ID -> future, along with when each
+#   finished job finished, job ID -> time
+plot_pool = None
+plot_jobs = {}
+plot_job_count = 0
+plot_jobs_finished = {}
+
+# Export processes, started with the first export that needs them. csv jobs
+#   can start them from their own threads
+export_pool = None
+export_pool_lock = Lock()
+
+# Jobs of the commands that run in the background (csv, export, slice and
+#   merge) that haven't been picked up yet, job ID -> future, along with
+#   when each finished job finished, job ID -> time
+jobs = {}
+job_count = 0
+jobs_finished = {}
+
+# Set in the plot processes, and the processes showing plots
+plot_worker = False
+
+# Active recordings
+active_recordings = {}
+
+# Active replays, recording name -> Replay
+active_replays = {}
+
+# Readers and writers for the active recordings. Started with the first
+#   recording
+recorder_engine = None
+
+# Publishes the stats of the active recordings, if asked to
+stats_publisher = None
+
+ATOM_HOST=os.getenv("ATOM_HOST", None)
+
+def _split_id(redis_id):
     '''
-    Waits for a recording to finish
+    Splits a redis ID of the form "<ms>-<seq>" into its integer timestamp
+    and sequence number
     '''
-    # Active recordings
-    global active_recordings
+    ts, seq = redis_id.split('-')
+    return int(ts), int(seq)
 
-    # Make sure the recording is active
-    if data not in active_recordings:
-        return Response(err_code=1, err_str="Recording {} not active".format(data), serialize=True)
+def _index_filename(filename):
+    '''
+    Returns the name of the sidecar index file for a recording file
+    '''
+    return os.path.splitext(filename)[0] + INDEX_EXTENSION
 
-    start_time = time.time()
-    active_recordings[data].join()
-    stop_time = time.time()
+def _read_index(index_filename):
+    '''
+    Maps an index file from disk. Returns None if the index doesn't exist
+    or was written by a different version, else a read-only numpy array of
+    INDEX_DTYPE backed by the file s.t. only the rows a read touches are
+    read from disk
+    '''
+    try:
+        with open(index_filename, 'rb') as f:
+            header = f.read(len(INDEX_HEADER))
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None
 
-    return Response("Returned after {} seconds".format(stop_time - start_time), serialize=True)
+    if header != INDEX_HEADER:
+        return None
 
-def list_recordings(data):
+    # The recorder may be partway through writing a row, so only take
+    #   complete ones
+    n = (size - len(INDEX_HEADER)) // INDEX_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(index_filename, dtype=INDEX_DTYPE, mode='r', offset=len(INDEX_HEADER), shape=(n,))
+
+def _read_manifest(dirname):
     '''
-    Returns a list of all recordings in the system
+    Reads the manifest of a segmented recording. Returns None if it
+    doesn't have one
     '''
-    recordings = []
+    try:
+        with open(os.path.join(dirname, MANIFEST_FILENAME), 'rb') as f:
+            manifest = msgpack.unpackb(f.read(), raw=False)
+    except Exception:
+        return None
 
-    # Loop over all locations
-    for folder in [PERM_RECORDING_LOC, TEMP_RECORDING_LOC]:
+    if (type(manifest) is not dict) or ("segments" not in manifest):
+        return None
+    return manifest
 
-        # If the folder doesn't exist, just move on
-        if not os.path.exists(folder):
-            continue
+def _remove_segments(dirname):
+    '''
+    Deletes a segmented recording, i.e. when a recording of the same name
+    is started over it
+    '''
+    for filename in os.listdir(dirname):
+        os.remove(os.path.join(dirname, filename))
+    os.rmdir(dirname)
 
-        # Loop over all folders in the location
-        for filename in os.listdir(folder):
+def _unpack_record(unpacker, keys=None):
+    '''
+    Unpacks the next record from an unpacker. If keys is given, the values
+    of an entry under any other keys are skipped over instead of being
+    unpacked and copied. Markers are always unpacked in full.
+    '''
+    if keys is None:
+        return unpacker.unpack()
 
-            # If it ends with our extension, then add it
-            if filename.endswith(RECORDING_EXTENSION):
-                recordings.append(os.path.splitext(filename)[0])
+    record = {}
+    for i in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if (key in keys) or (key in ("id", SOURCE_KEY, MARKER_KEY)) or (MARKER_KEY in record):
+            record[key] = unpacker.unpack()
+        else:
+            unpacker.skip()
+    return record
 
-    return Response(recordings, serialize=True)
+def _decompress(codec, data):
+    '''
+    Decompresses data from a block. Blocks of typed recordings without a
+    codec aren't compressed
+    '''
+    return data if codec is None else CODECS[codec][1](data)
 
-def _get_recording(data):
+def _typed_column(values):
     '''
-    Returns the contents of a recording. Takes a msgpack serialized
-    request object with the following fields:
+    Packs the values of a key in the entries of a block of a typed
+    recording into one array. The values must all unpack to numbers, or
+    arrays of numbers, of the same shape and type and must pack back to
+    exactly the same bytes s.t. the recording reads back the same. Returns
+    None if they don't
+    '''
+    try:
+        array = np.array([msgpack.unpackb(value, raw=False) for value in values])
+    except Exception:
+        return None
+    if array.dtype.kind not in "if":
+        return None
 
-    name: required recording name
-    start: start entry index
-    stop: stop entry index
-    msgpack: if we should use msgpack to deserialize values, assumed false
+    array = array.astype("<i8" if array.dtype.kind == "i" else "<f8")
+    packer = msgpack.Packer(use_bin_type=True)
+    if any(packer.pack(row) != value for row, value in zip(array.tolist(), values)):
+        return None
+    return array
 
-    Will return a Response() type on error, else a list of all items
-    in the recording.
+def _delta(array, inverse=False):
     '''
-    if (("name" not in data) or (type(data["name"]) is not str)):
-        return Response(err_code=1, err_str="Name is required", serialize=True)
+    Delta-encodes the rows of a typed array against the previous row, or
+    undoes it. Works on the bits of the values s.t. it's lossless, ints are
+    differenced and the bits of floats are XORed
+    '''
+    bits = array.view("<u8")
+    if inverse:
+        if array.dtype.kind == "i":
+            return np.cumsum(bits, axis=0, dtype="<u8").view(array.dtype)
+        return np.bitwise_xor.accumulate(bits, axis=0).view(array.dtype)
 
-    name = data["name"]
+    previous = np.concatenate((np.zeros((1,) + bits.shape[1:], dtype="<u8"), bits[:-1]))
+    if array.dtype.kind == "i":
+        return (bits - previous).view(array.dtype)
+    return (bits ^ previous).view(array.dtype)
 
-    file = None
-    for folder in [PERM_RECORDING_LOC, TEMP_RECORDING_LOC]:
-        filename = os.path.join(folder, name + RECORDING_EXTENSION)
-        if os.path.exists(filename):
+def _block_records(block, keys=None, arrays=False):
+    '''
+    Decompresses a block from a compressed or typed recording and returns
+    the list of records in it, only unpacking the values under keys if it's
+    given, along with the array of each typed key. Typed values are put
+    back into their entries already unpacked, as rows of their array,
+    unless arrays is true in which case they're left out of the entries
+    and only come back as the arrays
+    '''
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+    unpacker.feed(_decompress(block["codec"], block["data"]))
+    if keys is None:
+        records = list(unpacker)
+    else:
+        records = []
+        while True:
             try:
-                file = open(filename, 'rb', buffering=0)
+                records.append(_unpack_record(unpacker, keys))
+            except msgpack.OutOfData:
                 break
-            except:
-                return Response(err_code=2, err_str="Failed to open file {}".format(filename), serialize=True)
-
-    # Make sure we found the file
-    if file is None:
-        return Response(err_code=3, err_str="No recording {}".format(name), serialize=True)
 
-    start_idx = 0
-    stop_idx = -1
-    use_msgpack = False
+    typed = {}
+    columns = block.get("columns")
+    if columns is not None:
+        entries = [record for record in records if "id" in record]
+        for key, column in columns.items():
+            if (keys is not None) and (key not in keys):
+                continue
+            array = np.frombuffer(_decompress(block["codec"], column["data"]),
+                dtype=column["dtype"]).reshape([len(entries)] + column["shape"])
+            if column["delta"]:
+                array = _delta(array, inverse=True)
+            if not arrays:
+                for entry, value in zip(entries, array.tolist()):
+                    entry[key] = value
+            typed[key] = array
 
-    if ("start" in data) and (type(data["start"]) is int):
-        start_idx = data["start"]
-    if ("stop" in data) and (type(data["stop"]) is int):
-        stop_idx = data["stop"]
-    if ("msgpack" in data) and (type(data["msgpack"]) is bool):
-        use_msgpack = data["msgpack"]
+    return records, typed
 
-    # Now, we want to loop over the file. Note that when we packed the file
-    #   we packed it as individual msgpack objects with no padding/association
-    #   between them so we need to use the msgpack streaming API
+def _scan_entries(file, offset):
+    '''
+    Scans a recording file from the byte offset of a record to the end
+    of the file, returning a list of (offset, ts, seq, src, pos) index rows
+    for each entry found. For plain entries only the IDs and sources are
+    decoded, all other values are skipped over. Blocks are decompressed
+    to find the entries in them.
+    '''
+    file.seek(offset)
     unpacker = msgpack.Unpacker(file, raw=False)
-    response_items = []
-    for i, unpacked in enumerate(unpacker):
-        if (i >= start_idx):
-
-            # Make the
-            repacked = (unpacked["id"], {})
-
-            # If we should use msgpack to deserialize
-            for k in unpacked:
-                if k != "id":
-                    if use_msgpack:
-                        repacked[1][k] = msgpack.unpackb(unpacked[k], raw=False)
-                    else:
-                        repacked[1][k] = unpacked[k]
+    rows = []
+    while True:
+        record_offset = offset + unpacker.tell()
+        try:
+            n_keys = unpacker.read_map_header()
+            record = {}
+            for i in range(n_keys):
+                key = unpacker.unpack()
+                if (key in ("id", SOURCE_KEY, MARKER_KEY)) or (MARKER_KEY in record):
+                    record[key] = unpacker.unpack()
+                else:
+                    unpacker.skip()
+        except msgpack.OutOfData:
+            break
 
-            response_items.append(repacked)
+        if "id" in record:
+            records = [record]
+        elif record.get(MARKER_KEY) == "block":
+            records, typed = _block_records(record, frozenset())
+        else:
+            continue
 
-        if ((stop_idx != -1) and (i >= stop_idx)):
-            break
+        for pos, entry in enumerate(records):
+            if "id" in entry:
+                ts, seq = _split_id(entry["id"])
+                rows.append((record_offset, ts, seq, entry.get(SOURCE_KEY, 0), pos))
 
-    return response_items
+    return rows
 
-def get_recording(data):
+def _load_index(filename, persist=True):
     '''
-    Returns the contents of a recording. Takes a msgpack serialized
-    request object with the following fields:
-
-    name: required recording name
-    start: start entry index
-    stop: stop entry index
-    msgpack: if we should use msgpack to deserialize values, assumed false
+    Loads the index for a recording. Recordings without an index (or with
+    an out of date one) get one built from a scan of the file, and any
+    entries past the end of the index are picked up as well. If persist
+    is true the scanned rows are written back to the index file s.t. we
+    only pay for the scan once.
     '''
+    index_filename = _index_filename(filename)
+    index = _read_index(index_filename)
 
-    # Load the recording using the function we share with plot_recording
-    result = _get_recording(data)
-    if type(result) is not list:
-        return result
-    else:
-        return Response(result, serialize=True)
+    # Scan from the end of the last indexed record (or the start if we have
+    #   no index) to catch anything that was written and not indexed.
+    #   Records are always indexed in full so we only want what comes after
+    #   it, and we can step over it without reading its values. Finished
+    #   recordings only have the footer past it
+    with open(filename, 'rb') as file:
+        if index is None or len(index) == 0:
+            rows = _scan_entries(file, 0)
+        else:
+            last_offset = int(index["offset"][-1])
+            size = os.fstat(file.fileno()).st_size
+            try:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    end = _skip_packed(buf, last_offset)
+            except (IndexError, ValueError, OSError):
+                end = last_offset
+            rows = [row for row in _scan_entries(file, end) if row[0] > last_offset] if end < size else []
 
-def plot_recording(data):
-    '''
-    Makes a plot of the recording. Takes a msgpack-serialized JSON
-    object with the following fields
-    name : required recording name
-    plots: list of plots to make, where each item in the list is a list as well.
-        Each item in the plots list is a tuple, with values:
-            - 0 : lambda function to perform on the data. The data will be
-                    passed to the lambda as a dictionary named `x`
-            - 1 : list of keys on which to perform the lambda function
-            - 2 : optional label
+    if len(rows) == 0:
+        return index if index is not None else np.zeros(0, dtype=INDEX_DTYPE)
 
-        An example plots field would look like:
-            "plots": [
-                {
-                    "data": [
-                        ["x[0]", ["joint_0", "joint_1"], "label0"],
-                    ],
-                    "title": "Some Title",
-                    "y_label": "Some Y Label",
-                    "x_label": "Some X Label",
-                    "legend": true/false,
-                },
-                {
-                    "data": [
-                        ["x[1]", ["joint_0", "joint_1"], "label1"],
-                        ["x[2]", ["joint_0", "joint_1"], "label2"],
-                    ],
-                    ...
-                }
-            ]
-    start: Entry index to start the plot at
-    stop: Entry index to stop the plot at
-    msgpack: Whether or not to use msgpack to deserialize each key on
-        readback from the recording. Default false
-    save: Optional, if true will save an image of each plot, default false
-    show: Optional, default true, will show the plots in an interactive
-        fashion
-    perm: Optional, default false. If true will save in the permanent
-        file location, else temporary
-    x: Optional lambda for converting an entry into a timestamp. If not
-        passed, will use the redis timestamp. If passed, will be a
-        lambda for an entry lambda entry: ... where the user supplies ...
-        to convert the entry into an x-label
-    '''
+    # Write the rows after the last complete one, over any partial row
+    rows = b"".join(INDEX_ROW.pack(*row) for row in rows)
+    if persist:
+        try:
+            with open(index_filename, 'r+b' if index is not None else 'wb') as f:
+                if index is None:
+                    f.write(INDEX_HEADER)
+                else:
+                    f.seek(len(INDEX_HEADER) + len(index) * INDEX_DTYPE.itemsize)
+                f.write(rows)
+                f.truncate()
+        except OSError:
+            pass
 
-    # Load the recording. If we failed to load it just return that error
-    result = _get_recording(data)
-    if type(result) is not list:
-        return result
+    scanned = np.frombuffer(rows, dtype=INDEX_DTYPE)
+    return scanned if index is None else np.concatenate((index, scanned))
 
-    # Get the number of results
-    n_results = len(result)
-    if (n_results == 0):
-        return Response(err_code=4, err_str="0 results for recording", serialize=True)
+def _copy_bytes(src_fd, dst_fd, offset, count):
+    '''
+    Copies count bytes from offset in one file to the current position of
+    another without bringing them into Python. copy_file_range can copy
+    them without reading them at all on filesystems that share blocks. It
+    doesn't work across filesystems on older kernels so we fall back to
+    sendfile, and failing that to reading and writing
+    '''
+    end = offset + count
+    mode = 0 if hasattr(os, "copy_file_range") else 1
+    while offset < end:
+        n = min(end - offset, COPY_CHUNK_BYTES)
+        try:
+            if mode == 0:
+                copied = os.copy_file_range(src_fd, dst_fd, n, offset)
+            elif mode == 1:
+                copied = os.sendfile(dst_fd, src_fd, offset, n)
+            else:
+                copied = os.write(dst_fd, os.pread(src_fd, n, offset))
+        except OSError as e:
+            if (mode == 2) or (e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)):
+                raise
+            mode += 1
+            continue
+        if copied == 0:
+            raise OSError("Recording ended while copying it")
+        offset += copied
 
-    # We should have a list of all of the entries that we care about seeing
-    #   and now for each entry need to go ahead and run all of the lambdas
-    if ("plots" not in data) or (type(data["plots"]) is not list):
-        return Response(err_code=5, err_str="Plots must be specified", serialize=True)
+class RecordingFile:
+    '''
+    A recording file on disk along with its index. Takes batches of entries
+    which have already been packed and writes each with a single write call.
+    A batch is a list of (packed, ts, seq, src) tuples where ts and seq are
+    the redis ID of the entry and src the index of its source. src is None
+    for records that aren't entries. If a header is given it's written at
+    the start of the file.
 
-    # Note the plots
-    plots = data["plots"]
+    If a codec is given, entries are instead gathered into blocks of about
+    block_size bytes and each block is compressed and written out on its own
+    s.t. reads only need to decompress the blocks they want. Typed
+    recordings are always written in blocks, with the numeric keys of each
+    block pulled out into arrays, delta-encoded if delta is true.
+    '''
+    def __init__(self, filename, fsync="never", header=None, codec=None, block_size=BLOCK_SIZE,
+            typed=False, delta=False):
+        self.filename = filename
+        self.fsync = fsync
 
-    if ("x" in data):
+        # Reads map recordings and their indexes, so an old recording of the
+        #   same name is unlinked rather than truncated out from under them
+        for f in (filename, _index_filename(filename)):
+            if os.path.exists(f):
+                os.remove(f)
+        self.file = open(filename, 'wb')
         try:
-            x_lambda = eval("lambda entry: " + data["x"])
-            x_data = [x_lambda(entry[1]) for entry in result]
-            x_label = str(data["x"])
+            self.index_file = open(_index_filename(filename), 'wb')
         except:
-            return Response(err_code=6, err_str="Unable to convert {} to x data lambda".format(data["x"]))
-    else:
-        x_data = [int(entry[0].split('-')[0]) for entry in result]
-        x_label = "Redis Timestamp (ms)"
-
-    # Turn the x data into a numpy array and subtract off the first item
-    #   so that the scale is reasonable
-    x_data = np.array(x_data)
-    x_data -= x_data[0]
+            self.file.close()
+            raise
+        self.index_file.write(INDEX_HEADER)
+        self.offset = 0
+        self.last_sync = time.monotonic()
+        self.error = None
 
-    # Convert the input data to lambdas
-    figures = []
-    for plot_n, plot in enumerate(plots):
+        # What goes in the footer. The recording fills in the rest of the
+        #   footer before it's closed
+        self.entries = 0
+        self.first = None
+        self.last = None
+        self.footer = {}
 
-        # List of lambdas to run
-        lambdas = []
-        total_lines = 0
+        self.codec = codec
+        self.block_size = block_size
+        self.block = []
+        self.block_bytes = 0
+        self.block_time = time.monotonic()
 
-        # Get the plot data
-        if ("data" not in plot) or (type(plot["data"]) is not list):
-            return Response(err_code=7, err_str="Each plot must have a data list", serialize=True)
+        # Schema of the typed keys, key -> dtype and shape, and keys we
+        #   found can't be typed
+        self.typed = typed
+        self.delta = delta
+        self.schema = {}
+        self.untyped = set()
 
-        plot_data = plot["data"]
+        if header is not None:
+            packed = msgpack.packb(dict({MARKER_KEY: "header"}, **header), use_bin_type=True)
+            self.file.write(packed)
+            self.offset += len(packed)
 
-        # Make the lambda
-        for val in plot_data:
+    def write_batch(self, batch):
+        '''
+        Writes a batch of packed records to the file and indexes the entries,
+        or adds them to the current block for a compressed recording
+        '''
+        if (self.codec is None) and (not self.typed):
+            index_rows = []
+            for (packed, ts, seq, src) in batch:
+                if src is not None:
+                    index_rows.append(INDEX_ROW.pack(self.offset, ts, seq, src, 0))
+                    self.note_entry(ts, seq)
+                self.offset += len(packed)
 
-            # Make sure the length of the array is proper
-            if ((len(val) < 2) or (len(val) > 3)):
-                return Response(err_code=8, err_str="plot value {} does not have 2 or 3 items".format(val), serialize=True)
+            self.write_indexed(b"".join(item[0] for item in batch), index_rows)
+        else:
+            if len(self.block) == 0:
+                self.block_time = time.monotonic()
+            self.block.extend(batch)
+            self.block_bytes += sum(len(item[0]) for item in batch)
 
-            # Try to make the lambda from the first one
-            try:
-                lamb = eval("lambda x: " + val[0])
-            except:
-                return Response(err_code=9, err_str="Unable to make lambda from {}".format(val[0]), serialize=True)
+            if (self.block_bytes >= self.block_size) or \
+                    (time.monotonic() - self.block_time >= BLOCK_FLUSH_SEC):
+                self.flush_block()
 
-            # Make sure each key exists in the first data item
-            for key in val[1]:
-                if key not in result[0][1]:
-                    return Response(err_code=10, err_str="Key {} not in data".format(key), serialize=True)
+        # Sync if it's been long enough since the last one
+        if (type(self.fsync) is not str) and (time.monotonic() - self.last_sync >= self.fsync):
+            self.sync()
 
-            # Add the number of keys in this lambda to the total number of lines
-            total_lines += len(val[1])
+    def type_block(self):
+        '''
+        Pulls the keys of the current block whose values can be typed out
+        into arrays. Returns the packed records of the block without those
+        keys and the array of each key. Keys that can't be typed once aren't
+        tried again
+        '''
+        entries = [msgpack.unpackb(item[0], raw=False) if item[3] is not None else None for item in self.block]
+        present = [entry for entry in entries if entry is not None]
+        if len(present) == 0:
+            return [item[0] for item in self.block], {}
 
-            # Get the label
-            if len(val) == 3:
-                label = str(val[2])
+        columns = {}
+        for key in set(present[0]) - {"id", SOURCE_KEY} - self.untyped:
+            if any(key not in entry for entry in present):
+                continue
+            array = _typed_column([entry[key] for entry in present])
+            if array is None:
+                self.untyped.add(key)
             else:
-                label = str(val[0])
+                columns[key] = array
+                self.schema[key] = {"dtype": array.dtype.str, "shape": list(array.shape[1:])}
 
-            lambdas.append((lamb, val[1], label))
+        if len(columns) == 0:
+            return [item[0] for item in self.block], {}
 
-        # Now we want to preallocate the data for the plot. It should be a
-        #   matrix that's n-dimensional by lambda-key pair and entry
-        to_plot = np.zeros((total_lines, n_results))
+        packer = msgpack.Packer(use_bin_type=True)
+        return [item[0] if entry is None else packer.pack({k: v for k, v in entry.items() if k not in columns})
+            for item, entry in zip(self.block, entries)], columns
 
-        # And finally we want to loop over all of the data
-        for i, val in enumerate(result):
+    def flush_block(self):
+        '''
+        Compresses the current block and writes it out
+        '''
+        if len(self.block) == 0:
+            return
 
-            idx = 0
-            for (l, keys, label) in lambdas:
-                for key in keys:
-                    to_plot[idx][i] = l(val[1][key])
-                    idx += 1
+        records = [item[0] for item in self.block]
+        columns = {}
+        if self.typed:
+            records, columns = self.type_block()
+
+        compress = CODECS[self.codec][0] if self.codec is not None else (lambda data: data)
+        block = {
+            MARKER_KEY: "block",
+            "codec": self.codec,
+            "n": len(self.block),
+            "data": compress(b"".join(records)),
+        }
+        if len(columns) > 0:
+            block["columns"] = {key: {
+                "dtype": array.dtype.str,
+                "shape": list(array.shape[1:]),
+                "delta": self.delta,
+                "data": compress((_delta(array) if self.delta else array).tobytes()),
+            } for key, array in columns.items()}
+        packed = msgpack.packb(block, use_bin_type=True)
+
+        index_rows = []
+        for pos, (entry, ts, seq, src) in enumerate(self.block):
+            if src is not None:
+                index_rows.append(INDEX_ROW.pack(self.offset, ts, seq, src, pos))
+                self.note_entry(ts, seq)
+
+        self.write_indexed(packed, index_rows)
+        self.offset += len(packed)
+        self.block = []
+        self.block_bytes = 0
+
+    def copy(self, src_fd, offset, count, rows):
+        '''
+        Copies count bytes of whole records starting at offset in another
+        recording straight to the end of this one, in the kernel, and
+        indexes the entries among them. rows are the index rows of those
+        entries in the other recording, the first of which is the record
+        at offset
+        '''
+        self.flush_block()
+        self.flush()
+        dst_fd = self.file.fileno()
+        os.lseek(dst_fd, self.offset, os.SEEK_SET)
+        _copy_bytes(src_fd, dst_fd, offset, count)
+        self.file.seek(self.offset + count)
+
+        rows = rows.copy()
+        rows["offset"] -= rows["offset"][0]
+        rows["offset"] += self.offset
+        self.index_file.write(rows.tobytes())
+        self.flush()
+        self.offset += count
+
+        if len(rows) > 0:
+            self.entries += len(rows)
+            if self.first is None:
+                self.first = (int(rows["ts"][0]), int(rows["seq"][0]))
+            self.last = (int(rows["ts"][-1]), int(rows["seq"][-1]))
+
+    def write_indexed(self, records, index_rows):
+        '''
+        Writes records to the recording and then the index rows pointing
+        into them. The records are handed off to the OS before any of the
+        rows are written, since the index file can write out its buffer on
+        its own whenever it fills up, s.t. readers of an active recording
+        never see an index row pointing past the end of the recording
+        '''
+        self.file.write(records)
+        self.file.flush()
+        self.index_file.write(b"".join(index_rows))
+        self.index_file.flush()
+
+    def flush(self):
+        '''
+        Hands what we've written off to the OS s.t. readers of an active
+        recording see it. The recording goes first, though rows only get
+        written to the index once their records are out (see write_indexed)
+        '''
+        self.file.flush()
+        self.index_file.flush()
+
+    def size(self):
+        '''
+        Bytes written to the recording so far
+        '''
+        return self.offset
+
+    def note_entry(self, ts, seq):
+        '''
+        Notes an entry that's been written for the footer
+        '''
+        self.entries += 1
+        if self.first is None:
+            self.first = (ts, seq)
+        self.last = (ts, seq)
+
+    def write_footer(self):
+        '''
+        Writes the footer summarizing the recording and the trailer pointing
+        to it
+        '''
+        footer = dict({MARKER_KEY: "footer"}, **self.footer)
+        footer["entries"] = self.entries
+        footer["first_id"] = "{}-{}".format(*self.first) if self.first is not None else None
+        footer["last_id"] = "{}-{}".format(*self.last) if self.last is not None else None
+        footer["bytes"] = self.offset
+        if self.typed:
+            footer["schema"] = dict(self.footer.get("schema", {}), **self.schema)
+
+        trailer = msgpack.packb({MARKER_KEY: "tail", "footer": struct.pack("<Q", self.offset)}, use_bin_type=True)
+        self.file.write(msgpack.packb(footer, use_bin_type=True) + trailer)
+
+    def sync(self):
+        '''
+        Flushes the recording and its index all the way to disk
+        '''
+        for f in (self.file, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.flush_block()
+        self.write_footer()
+        if self.fsync != "never":
+            self.sync()
+        self.file.close()
+        self.index_file.close()
+
+class SegmentedRecordingFile:
+    '''
+    A recording split over a folder of segments, each one a RecordingFile
+    with its own index. Takes the same batches as a RecordingFile and rolls
+    over to a new segment once the current one is segment_bytes big or
+    segment_sec old. The manifest is rewritten on each roll over and notes
+    the byte offset of each segment as if the segments were one file, which
+    never changes once a segment is started s.t. index offsets stay valid as
+    segments are added and expired. If keep is given only the last keep
+    segments are kept.
+    '''
+    def __init__(self, dirname, fsync, header, codec, block_size, segment_bytes, segment_sec, keep,
+            typed=False, delta=False):
+        self.filename = dirname
+        self.fsync = fsync
+        self.header = header
+        self.codec = codec
+        self.block_size = block_size
+        self.typed = typed
+        self.delta = delta
+        self.segment_bytes = segment_bytes
+        self.segment_sec = segment_sec
+        self.keep = keep
+        self.error = None
+        self.footer = {}
+
+        if os.path.isdir(dirname):
+            _remove_segments(dirname)
+        os.makedirs(dirname)
+
+        self.segments = []
+        self.n_segments = 0
+        self.offset = 0
+        self.open_segment()
+
+    def open_segment(self):
+        '''
+        Starts the next segment and adds it to the manifest
+        '''
+        name = "{:06d}{}".format(self.n_segments, RECORDING_EXTENSION)
+        self.current = RecordingFile(os.path.join(self.filename, name),
+            self.fsync, self.header, self.codec, self.block_size, self.typed, self.delta)
+        self.started = time.monotonic()
+        self.n_segments += 1
+        self.segments.append({
+            "file": name,
+            "offset": self.offset,
+            "bytes": None,
+            "entries": None,
+            "first_id": None,
+            "last_id": None,
+        })
+        self.write_manifest(False)
+
+    def close_segment(self, footer):
+        '''
+        Closes out the current segment and notes its size, entries and
+        ID range in the manifest
+        '''
+        recording_file = self.current
+        recording_file.footer = footer
+        recording_file.close()
+
+        segment = self.segments[-1]
+        segment["bytes"] = os.path.getsize(recording_file.filename)
+        segment["entries"] = recording_file.entries
+        if recording_file.first is not None:
+            segment["first_id"] = "{}-{}".format(*recording_file.first)
+            segment["last_id"] = "{}-{}".format(*recording_file.last)
+        self.offset += segment["bytes"]
+
+    def write_manifest(self, complete):
+        '''
+        Writes the manifest to a temp file and moves it into place s.t.
+        readers never see half of one
+        '''
+        manifest = os.path.join(self.filename, MANIFEST_FILENAME)
+        with open(manifest + ".tmp", 'wb') as f:
+            f.write(msgpack.packb({
+                "header": self.header,
+                "complete": complete,
+                "segments": self.segments,
+            }, use_bin_type=True))
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(manifest + ".tmp", manifest)
+
+    def size(self):
+        '''
+        Bytes written to the recording so far, including expired segments
+        '''
+        return self.offset + self.current.offset
+
+    def write_batch(self, batch):
+        '''
+        Writes a batch to the current segment and rolls over to a new one if
+        it's full. Expired segments are only deleted once they're out of
+        the manifest
+        '''
+        self.current.write_batch(batch)
+
+        if ((self.segment_bytes is not None) and (self.current.offset >= self.segment_bytes)) or \
+                ((self.segment_sec is not None) and (time.monotonic() - self.started >= self.segment_sec)):
+            self.close_segment({})
+            expired = []
+            if (self.keep is not None) and (len(self.segments) >= self.keep):
+                expired = self.segments[:len(self.segments) - self.keep + 1]
+                self.segments = self.segments[len(expired):]
+            self.open_segment()
+
+            for segment in expired:
+                filename = os.path.join(self.filename, segment["file"])
+                for f in (filename, _index_filename(filename)):
+                    try:
+                        os.remove(f)
+                    except OSError:
+                        pass
+
+    def close(self):
+        self.close_segment(self.footer)
+        self.write_manifest(True)
+
+def _decode_id(redis_id):
+    '''
+    Returns a redis ID as a string, decoding it if it came back as bytes
+    '''
+    return redis_id.decode() if type(redis_id) is bytes else redis_id
+
+class StreamClient:
+    '''
+    The redis stream calls of the recorder that atom's public API doesn't
+    cover. The public API reads one stream per call and has no way to see
+    the start of a stream, while the readers read every stream of every
+    recording in one round trip. This is the only place that uses atom's
+    private redis client and stream naming, so if those change in atom this
+    is all that has to change with them. Everything else goes through the
+    element's public API.
+    '''
+    def __init__(self, elem):
+        self.elem = elem
+
+    def stream_id(self, element, stream):
+        '''
+        Returns the redis key of a stream of an element
+        '''
+        return self.elem._make_stream_id(element, stream)
+
+    def read(self, last_ids, count, block):
+        '''
+        Reads up to count entries newer than the given ID from each of the
+        streams, stream ID -> last ID, all at once. Waits up to block ms for
+        an entry if there are none. Returns the raw (stream ID, entries)
+        pairs from redis
+        '''
+        return self.elem._rclient.xread(last_ids, count=count, block=block)
+
+    def oldest_ids(self, stream_ids):
+        '''
+        Returns a dictionary of the (ts, seq) of the oldest entry still in
+        each of the streams, or None if the stream is empty, all in one
+        round trip
+        '''
+        pipe = self.elem._rclient.pipeline()
+        for stream_id in stream_ids:
+            pipe.xrange(stream_id, count=1)
+
+        oldest = {}
+        for stream_id, entries in zip(stream_ids, pipe.execute()):
+            oldest[stream_id] = _split_id(_decode_id(entries[0][0])) if len(entries) > 0 else None
+        return oldest
+
+    def last_ids(self, stream_ids):
+        '''
+        Returns a dictionary of the ID of the newest entry in each of the
+        streams, or "0-0" if the stream is empty, all in one round trip.
+        This is what "$" would mean for a read right now.
+        '''
+        pipe = self.elem._rclient.pipeline()
+        for stream_id in stream_ids:
+            pipe.xrevrange(stream_id, count=1)
+
+        last = {}
+        for stream_id, entries in zip(stream_ids, pipe.execute()):
+            last[stream_id] = _decode_id(entries[0][0]) if len(entries) > 0 else "0-0"
+        return last
+
+class Recording:
+    '''
+    An active recording of one or more sources, i.e. element/stream pairs.
+    It's read along with every other active recording by one of the shared
+    RecorderReaders, which hands it batches of packed entries. Entries from
+    all of the sources are merged in ID order and handed off to one of the
+    shared RecordingWriters.
+    '''
+    def __init__(self, name, sources, n_entries, n_sec, mode, recording_file, ring=None):
+        self.name = name
+        self.sources = sources
+        self.n_entries = n_entries
+        self.deadline = time.monotonic() + n_sec
+        self.mode = mode
+        self.recording_file = recording_file
+        self.ring = ring
+
+        # Filled in when the recording is handed to the engine
+        self.stream_ids = None
+        self.writer = None
+        self.log = None
+
+        # Where we are in each source. last_ids is None until we've
+        #   resolved where the streams were when we started
+        self.last_ids = None
+        self.lasts = None
+        self.started = None
+        self.next_read = 0
+        self.last_data = time.monotonic()
+        self.entries_read = 0
+        self.gaps = 0
+        self.keys = [set() for source in sources]
+        self.done = Event()
+
+        # Stats. Time spent in reads from redis, including waiting on new
+        #   entries, in packing and merging entries and blocked on a full
+        #   writer queue. Batches are the new entries from a source in one
+        #   read, and full batches are reads which hit READER_BATCH_LEN,
+        #   i.e. the source had more
+        self.start_time = time.monotonic()
+        self.read_sec = 0.0
+        self.pack_sec = 0.0
+        self.blocked_sec = 0.0
+        self.batches = 0
+        self.max_batch = 0
+        self.full_batches = 0
+
+        # Entries we've read but not yet written, and the ID past which we
+        #   can't write them yet since a source may have more entries
+        #   before it that we haven't read
+        self.pending = []
+        self.watermark = None
+
+    def add_batch(self, src, batch, gap, truncated):
+        '''
+        Takes a batch of packed entries from a source, newer than the last
+        one we've seen from it. If gap is true then the stream was trimmed
+        past our last entry before the read and we note that in the file
+        s.t. anyone reading it back knows entries may be missing. If truncated
+        is true the read was cut short and the source may have more entries.
+        '''
+        if len(batch) == 0:
+            return
+
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        if truncated:
+            self.full_batches += 1
+
+        if gap:
+            self.gaps += 1
+            marker = {MARKER_KEY: "gap", "from": self.last_ids[src], "to": "{}-{}".format(*batch[0][1:3])}
+            if len(self.sources) > 1:
+                marker["src"] = src
+            self.pending.append((msgpack.packb(marker, use_bin_type=True), batch[0][1], batch[0][2], None))
+
+        self.pending.extend(batch)
+        self.started[src] = True
+        self.lasts[src] = batch[-1][1:3]
+        self.last_ids[src] = "{}-{}".format(*self.lasts[src])
+        self.last_data = time.monotonic()
+
+        # Entries from other sources newer than the last one we read from
+        #   this source have to wait for the next read
+        if truncated and ((self.watermark is None) or (self.lasts[src] < self.watermark)):
+            self.watermark = self.lasts[src]
+
+    def flush(self, final=False):
+        '''
+        Merges the entries we've read from all sources in ID order and hands
+        the ones we can off to the writer, or to the ring for ring recordings
+        '''
+        ready = []
+        if len(self.pending) > 0:
+
+            # Sort in ID order, keeping gap markers in front of the entry
+            #   they come before
+            self.pending.sort(key=lambda b: (b[1], b[2], b[3] is not None))
+            if final or (self.watermark is None):
+                ready, self.pending = self.pending, []
+            else:
+                n_ready = 0
+                while (n_ready < len(self.pending)) and (self.pending[n_ready][1:3] <= self.watermark):
+                    n_ready += 1
+                ready, self.pending = self.pending[:n_ready], self.pending[n_ready:]
+
+            # Only keep what we need for an entry-limited recording
+            n_new = sum(1 for b in ready if b[3] is not None)
+            if (self.n_entries is not None) and (self.entries_read + n_new > self.n_entries):
+                n_new = 0
+                for i, b in enumerate(ready):
+                    if b[3] is not None:
+                        n_new += 1
+                        if self.entries_read + n_new == self.n_entries:
+                            ready = ready[:i + 1]
+                            break
+
+            if (len(ready) > 0) and (self.ring is None):
+                start = time.monotonic()
+                self.writer.put(self.recording_file, ready)
+                self.blocked_sec += time.monotonic() - start
+            self.entries_read += n_new
+
+            # If we're polling, we should wait for the interval before
+            #   reading again
+            if self.mode == "poll":
+                self.next_read = time.monotonic() + POLL_INTERVAL
+
+        self.watermark = None
+
+        # Ring recordings go through the ring every time s.t. triggers are
+        #   picked up even when there's no new data
+        if self.ring is not None:
+            self.ring.flush(self, ready)
+
+    def complete(self):
+        '''
+        Returns true once we've read all of the entries we want or once
+        we've recorded for longer than our elapsed time. Timed recordings
+        end by the wall clock s.t. time spent reading and writing counts
+        towards the duration. Ring recordings run until they're stopped
+        '''
+        if self.ring is not None:
+            return False
+        if self.n_entries is not None:
+            return self.entries_read >= self.n_entries
+        return time.monotonic() >= self.deadline
+
+    def summary(self):
+        '''
+        Returns what the recording knows about itself for the footer
+        '''
+        return {
+            "sources": [list(source) for source in self.sources],
+            "keys": [sorted(keys) for keys in self.keys],
+            "gaps": self.gaps,
+        }
+
+    def stats(self, heads=None):
+        '''
+        Returns the stats of the recording. heads is the (ts, seq) of the
+        newest entry in each of our streams, from which we work out how far
+        behind the streams we are
+        '''
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        written = self.writer.written.get(self.recording_file, {}) if self.recording_file is not None else {}
+        size = self.recording_file.size() if self.recording_file is not None else 0
+
+        lag = None
+        if (heads is not None) and (self.lasts is not None):
+            lag = max(max(heads[stream_id][0] - last[0], 0) if heads.get(stream_id) is not None else 0
+                for stream_id, last in zip(self.stream_ids, self.lasts))
+
+        return {
+            "mode": self.mode,
+            "seconds": elapsed,
+            "entries": self.entries_read,
+            "entries_per_sec": self.entries_read / elapsed,
+            "bytes": size,
+            "bytes_per_sec": size / elapsed,
+            "read_sec": self.read_sec,
+            "pack_sec": self.pack_sec,
+            "blocked_sec": self.blocked_sec,
+            "write_sec": written.get("seconds", 0.0),
+            "lag_ms": lag,
+            "batches": self.batches,
+            "mean_batch": self.entries_read / self.batches if self.batches > 0 else 0,
+            "max_batch": self.max_batch,
+            "full_batches": self.full_batches,
+            "gaps": self.gaps,
+            "dropped": written.get("dropped", 0),
+            "queue": self.writer.queue.qsize(),
+            "max_queue": self.writer.max_queued,
+            "queue_len": self.writer.queue_len,
+            "ring_entries": len(self.ring.entries) if self.ring is not None else None,
+            "ring_bytes": self.ring.bytes if self.ring is not None else None,
+        }
+
+    def finished(self):
+        '''
+        Called by the writer once the file is closed
+        '''
+        self.log(LogLevel.INFO, "Finished recording {} with {} entries read and {} gaps, max writer queue {}/{}".format(
+            self.name, self.entries_read, self.gaps, self.writer.max_queued, self.writer.queue_len))
+        self.done.set()
+
+    def join(self, timeout=None):
+        '''
+        Waits for the recording to finish, same as we would for a thread
+        '''
+        return self.done.wait(timeout)
+
+class Capture:
+    '''
+    Recording made by triggering a ring recording. It gets what's in the
+    ring when it's triggered and then new entries until its deadline.
+    Sits in active_recordings while it's being written, same as a
+    Recording.
+    '''
+    def __init__(self, name, recording_file, deadline):
+        self.name = name
+        self.recording_file = recording_file
+        self.deadline = deadline
+        self.done = Event()
+
+    def finished(self):
+        '''
+        Called by the writer once the file is closed
+        '''
+        self.done.set()
+
+    def join(self, timeout=None):
+        return self.done.wait(timeout)
+
+class RecordingRing:
+    '''
+    Flight recorder for a ring recording. Keeps the packed entries of the
+    last n_sec seconds and/or n_bytes bytes of the recording in memory,
+    dropping the oldest, s.t. memory use is fixed no matter how long the
+    recording runs. When triggered, everything in the ring goes out to a new
+    recording in one bulk write and new entries keep going to it for the
+    post-trigger window. The ring is only touched by the reader of the
+    recording, triggers are handed over on a queue.
+    '''
+    def __init__(self, n_sec, n_bytes, header, fsync, codec, block_size, typed=False, delta=False):
+        self.n_sec = n_sec
+        self.n_bytes = n_bytes
+        self.header = header
+        self.fsync = fsync
+        self.codec = codec
+        self.block_size = block_size
+        self.typed = typed
+        self.delta = delta
+        self.entries = deque()
+        self.bytes = 0
+        self.triggers = Queue()
+        self.captures = []
+
+    def add(self, ready):
+        '''
+        Adds packed entries to the ring and drops the oldest ones that no
+        longer fit
+        '''
+        for b in ready:
+            self.entries.append(b)
+            self.bytes += len(b[0])
+
+        newest = self.entries[-1][1] if len(self.entries) > 0 else None
+        while (len(self.entries) > 0) and (
+                ((self.n_bytes is not None) and (self.bytes > self.n_bytes)) or
+                ((self.n_sec is not None) and (newest - self.entries[0][1] > self.n_sec * 1000))):
+            self.bytes -= len(self.entries.popleft()[0])
+
+    def flush(self, recording, ready):
+        '''
+        Starts any captures that have been triggered with what's in the ring,
+        then adds new entries to the ring and the captures and closes any
+        captures whose window is over
+        '''
+        while True:
+            try:
+                capture = self.triggers.get_nowait()
+            except Empty:
+                break
+            if len(self.entries) > 0:
+                recording.writer.put(capture.recording_file, list(self.entries))
+            self.captures.append(capture)
+
+        if len(ready) > 0:
+            self.add(ready)
+            for capture in self.captures:
+                recording.writer.put(capture.recording_file, ready)
+
+        now = time.monotonic()
+        for capture in list(self.captures):
+            if (now >= capture.deadline) or (active_recordings.get(capture.name) is not capture):
+                self.close(recording, capture)
+
+    def close(self, recording, capture):
+        '''
+        Has the writer close out a capture
+        '''
+        self.captures.remove(capture)
+        if active_recordings.get(capture.name) is capture:
+            active_recordings.pop(capture.name)
+        capture.recording_file.footer = recording.summary()
+        recording.writer.close(capture.recording_file, capture.finished)
+
+    def close_all(self, recording):
+        '''
+        Closes out every capture when the ring recording is stopped,
+        including ones triggered that haven't gotten the ring yet
+        '''
+        self.flush(recording, [])
+        for capture in list(self.captures):
+            self.close(recording, capture)
+
+class RecordingWriter(Thread):
+    '''
+    Writer stage shared by a number of recordings. Readers put packed
+    batches on a bounded queue and this thread writes them out s.t. a slow
+    disk doesn't hold up reads from redis. Whatever has piled up on the
+    queue for a recording is written out together in one bulk write. When
+    the queue fills up readers block and we log a warning s.t. backpressure
+    shows up in the logs.
+    '''
+    def __init__(self, n, log, queue_len=WRITE_QUEUE_LEN):
+        super().__init__(daemon=True)
+        self.name = "record_writer_{}".format(n)
+        self.log = log
+        self.queue = Queue(maxsize=queue_len)
+        self.queue_len = queue_len
+        self.max_queued = 0
+        self.warned = False
+        self.n_files = 0
+
+        # Time spent writing each open file and the entries dropped since
+        #   writing it failed, file -> {"seconds", "dropped"}
+        self.written = {}
+
+    def put(self, recording_file, batch):
+        '''
+        Puts a batch on the queue to be written, blocking if the queue is full
+        '''
+        queued = self.queue.qsize() + 1
+        self.max_queued = max(self.max_queued, queued)
+
+        # Warn once per time we cross the threshold
+        if queued >= WRITE_QUEUE_WARN * self.queue_len:
+            if not self.warned:
+                self.log(LogLevel.WARNING, "Writer {} falling behind, queue {}/{} full".format(
+                    self.name, queued, self.queue_len))
+                self.warned = True
+        else:
+            self.warned = False
+
+        self.queue.put((recording_file, batch, None))
+
+    def close(self, recording_file, on_close):
+        '''
+        Closes the file once everything queued for it has been written
+        and then calls on_close
+        '''
+        self.queue.put((recording_file, None, on_close))
+
+    def write(self, recording_file, batch):
+        # Once we've failed to write a file we just drop its batches s.t.
+        #   the reader doesn't block forever
+        written = self.written.setdefault(recording_file, {"seconds": 0.0, "dropped": 0})
+        if len(batch) == 0:
+            return
+        if recording_file.error is not None:
+            written["dropped"] += sum(1 for b in batch if b[3] is not None)
+            return
+
+        start = time.monotonic()
+        try:
+            recording_file.write_batch(batch)
+        except Exception as e:
+            recording_file.error = e
+            written["dropped"] += sum(1 for b in batch if b[3] is not None)
+            self.log(LogLevel.ERR, "Failed to write to {}: {}".format(recording_file.filename, e))
+        written["seconds"] += time.monotonic() - start
+
+    def run(self):
+        while True:
+
+            # Wait for a batch and then grab whatever else is waiting,
+            #   grouping up the batches for each file
+            pending = {}
+            item = self.queue.get()
+            while item is not None:
+                recording_file, batch, on_close = item
+                if batch is not None:
+                    pending.setdefault(recording_file, []).extend(batch)
+                else:
+                    self.write(recording_file, pending.pop(recording_file, []))
+                    try:
+                        recording_file.close()
+                    except Exception as e:
+                        self.log(LogLevel.ERR, "Failed to close {}: {}".format(recording_file.filename, e))
+                    self.n_files -= 1
+                    self.written.pop(recording_file, None)
+                    on_close()
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    item = None
+
+            for recording_file, batch in pending.items():
+                self.write(recording_file, batch)
+
+class RecorderReader(Thread):
+    '''
+    Reader shared by a number of recordings. Each reader has its own element
+    (and so its own redis connection) and reads the streams for all of its
+    recordings with a single multi-stream read, handing the entries off to
+    each recording.
+    '''
+    def __init__(self, n):
+        super().__init__(daemon=True)
+        self.elem = Element("record_reader_{}".format(n), host=ATOM_HOST)
+        self.streams = StreamClient(self.elem)
+        self.recordings = []
+        self.cond = Condition()
+
+    def add(self, recording):
+        with self.cond:
+            self.recordings.append(recording)
+            self.cond.notify()
+
+    def finish(self, recording, err=None):
+        '''
+        Stops reading a recording and has its writer close it out. Does
+        nothing if the recording's already been finished
+        '''
+        with self.cond:
+            if (recording not in self.recordings) or recording.done.is_set():
+                return
+            self.recordings.remove(recording)
+
+        if err is not None:
+            self.elem.log(LogLevel.ERR, "Recording {}: {}".format(recording.name, err))
+
+        # Once we're out of here we want to note that we're no longer
+        #   active in the global system. It might be that someone else popped
+        #   it out through already in the "stop" command
+        if active_recordings.get(recording.name) is recording:
+            active_recordings.pop(recording.name)
+
+        recording.flush(final=True)
+        if recording.ring is not None:
+            recording.ring.close_all(recording)
+            recording.finished()
+        else:
+            recording.recording_file.footer = recording.summary()
+            recording.writer.close(recording.recording_file, recording.finished)
+
+    def run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                while len(self.recordings) == 0:
+                    self.cond.wait()
+                recordings = list(self.recordings)
+
+            try:
+                self.read(recordings)
+                failures = 0
+            except Exception as e:
+
+                # Retry a few times before giving up on the recordings.
+                #   Recordings only take entries newer than the last ones
+                #   they've seen, so reading again can't duplicate anything
+                failures += 1
+                self.elem.log(LogLevel.ERR, "Reader failed ({}/{}): {}".format(failures, READER_RETRIES, e))
+                if failures < READER_RETRIES:
+                    time.sleep(READER_RETRY_SEC * failures)
+                    continue
+
+                # Only finish what we still own, read may have finished some
+                failures = 0
+                with self.cond:
+                    recordings = [r for r in recordings if r in self.recordings]
+                for recording in recordings:
+                    self.finish(recording, "reader failed")
+
+    def read(self, recordings):
+        '''
+        Does one round of reading for all of the recordings
+        '''
+        # Finish off anything that's been stopped
+        for recording in recordings:
+            if active_recordings.get(recording.name) is not recording:
+                self.finish(recording)
+        recordings = [r for r in recordings if not r.done.is_set() and r in self.recordings]
+
+        # Figure out where the streams are for anything that's just started
+        new = [r for r in recordings if r.last_ids is None]
+        if len(new) > 0:
+            last_ids = self.streams.last_ids(list(set(sum((r.stream_ids for r in new), []))))
+            for recording in new:
+                recording.last_ids = [last_ids[stream_id] for stream_id in recording.stream_ids]
+                recording.lasts = [_split_id(last_id) for last_id in recording.last_ids]
+                recording.started = [False] * len(recording.sources)
+
+        # Only read the recordings that aren't waiting on their poll interval
+        now = time.monotonic()
+        due = [r for r in recordings if r.next_read <= now]
+        if len(due) == 0:
+            if len(recordings) > 0:
+                time.sleep(min(r.next_read for r in recordings) - now)
+            return
+
+        # Group the sources of the recordings by stream s.t. everything
+        #   reading the same stream shares a read, starting from the oldest
+        #   entry any of them needs
+        streams = {}
+        for recording in due:
+            for src, stream_id in enumerate(recording.stream_ids):
+                streams.setdefault(stream_id, []).append((recording, src))
+        last_ids = {}
+        for stream_id, readers in streams.items():
+            recording, src = min(readers, key=lambda r: r[0].lasts[r[1]])
+            last_ids[stream_id] = recording.last_ids[src]
+
+        # If a stream has been trimmed past the last entry a recording read
+        #   then it's lost data. Check before the read s.t. entries trimmed
+        #   while we're reading don't count against us
+        oldest = self.streams.oldest_ids(list(streams.keys()))
+
+        # Read all of the streams at once
+        start = time.monotonic()
+        result = self.streams.read(last_ids, READER_BATCH_LEN, READER_BLOCK_MS)
+        now = time.monotonic()
+        for recording in due:
+            recording.read_sec += now - start
+
+        for stream_id, entries in result:
+            stream_id = _decode_id(stream_id)
+            truncated = (len(entries) >= READER_BATCH_LEN)
+
+            entries = [({k.decode() if type(k) is bytes else k: v for (k, v) in fields.items()},
+                _decode_id(redis_id)) for (redis_id, fields) in entries]
+            keys = set()
+            for (entry, redis_id) in entries:
+                keys.update(entry)
+
+            # Pack up each entry into a msgpack item. If it's already
+            #   msgpack'd that's totally fine, this will just pack up the
+            #   keys and ID. Entries of recordings with more than one source
+            #   get tagged with the source, so we pack once per tag
+            batches = {}
+            for (recording, src) in streams[stream_id]:
+                start = time.monotonic()
+                tag = src if len(recording.sources) > 1 else None
+                if tag not in batches:
+                    batch = []
+                    for (entry, redis_id) in entries:
+                        entry = dict(entry, id=redis_id)
+                        if tag is not None:
+                            entry[SOURCE_KEY] = tag
+                        ts, seq = _split_id(redis_id)
+                        batch.append((msgpack.packb(entry, use_bin_type=True), ts, seq, src))
+                    batches[tag] = batch
+
+                # And hand the recording the part of the batch it hasn't seen
+                recording.keys[src].update(keys)
+                last = recording.lasts[src]
+                new_batch = [b for b in batches[tag] if b[1:3] > last]
+                gap = recording.started[src] and (oldest[stream_id] is not None) and \
+                    (oldest[stream_id] > last)
+                recording.add_batch(src, new_batch, gap, truncated)
+                recording.pack_sec += time.monotonic() - start
+
+        # Write out what we can, then finish anything that's complete or
+        #   that's gone too long without data
+        for recording in due:
+            start = time.monotonic()
+            blocked = recording.blocked_sec
+            recording.flush()
+            now = time.monotonic()
+            recording.pack_sec += (now - start) - (recording.blocked_sec - blocked)
+            if recording.complete():
+                self.finish(recording)
+            elif (recording.ring is None) and (now - recording.last_data >= BLOCK_MS / 1000):
+                self.finish(recording, "no data after {} entries read!".format(recording.entries_read))
+
+class RecorderEngine:
+    '''
+    Small fixed pool of readers and writers which serve every active
+    recording. Recordings are given to the least loaded reader and writer.
+    '''
+    def __init__(self, n_readers=READER_POOL_SIZE, n_writers=WRITER_POOL_SIZE):
+        self.readers = [RecorderReader(i) for i in range(n_readers)]
+        log = self.readers[0].elem.log
+        self.writers = [RecordingWriter(i, log) for i in range(n_writers)]
+        for thread in self.readers + self.writers:
+            thread.start()
+
+    def add(self, recording):
+        reader = min(self.readers, key=lambda r: len(r.recordings))
+        writer = min(self.writers, key=lambda w: w.n_files)
+        if recording.recording_file is not None:
+            writer.n_files += 1
+
+        recording.stream_ids = [reader.streams.stream_id(element, stream)
+            for (element, stream) in recording.sources]
+        recording.writer = writer
+        recording.log = reader.elem.log
+        reader.add(recording)
+
+def _recorder_engine():
+    '''
+    Returns the recorder engine, starting it up if this is the first
+    recording
+    '''
+    global recorder_engine
+    if recorder_engine is None:
+        recorder_engine = RecorderEngine()
+    return recorder_engine
+
+def start_recording(data):
+
+    # Data should be a dictionary with the following keys
+    #   name: required. String for the name of the recording
+    #   t: Optional time (in seconds) to record for. If omitted, will
+    #           default to 10
+    #   n: Optional number of entries to record for. If omitted will default
+    #           to default time. If both time and n are specified, n will
+    #           take precedence
+    #   perm: Optional boolean to make the recording persistent/permanent.
+    #           Will store the recording in a different location if so
+    #   e: Required element name
+    #   s: Required stream name
+    #   streams: Optional list of [element, stream] pairs to record together
+    #           in one recording, in place of e and s
+    #   mode: Optional, "poll" (default), "continuous" or "ring".
+    #           Continuous reads back to back instead of sleeping between
+    #           reads. Ring keeps the last t seconds and/or mb megabytes in
+    #           memory until stopped and only writes when triggered
+    #   mb: Optional number of megabytes of packed entries a ring recording
+    #           keeps. If given without t, the ring is only bounded by size
+    #   segment_mb: Optional size in megabytes at which to roll over to a
+    #           new segment. Makes a segmented recording
+    #   segment_t: Optional time in seconds after which to roll over to a
+    #           new segment. Makes a segmented recording
+    #   keep: Optional number of segments of a segmented recording to keep,
+    #           older ones are deleted
+    #   encoding: Optional, "msgpack" (default) or "typed". Typed stores
+    #           numeric keys as arrays per block of entries
+    #   delta: Optional boolean, default false. Delta-encodes the arrays of
+    #           a typed recording against the previous entry. Needs a
+    #           codec, as only compressed deltas take less space
+    #   fsync: Optional, "never" (default), "close" or a number of seconds.
+    #           How often the writer syncs the recording to disk
+    #   codec: Optional name of a codec in CODECS to compress the recording
+    #           with, in blocks of block_size bytes
+    #   block_size: Optional, uncompressed size of a compressed block
+    global active_recordings
+
+    # Make sure we got a name
+    if ("name" not in data) or (type(data["name"]) is not str):
+        return Response(err_code=1, err_str="name must be in data", serialize=True)
+
+    # Make sure we got a list of streams or an element and stream
+    if "streams" in data:
+        sources = data["streams"]
+        if (type(sources) is not list) or (len(sources) == 0) or \
+                any(((type(source) is not list) or (len(source) != 2) or
+                    any(type(v) is not str for v in source)) for source in sources) or \
+                (len(set(tuple(source) for source in sources)) != len(sources)):
+            return Response(err_code=9, err_str="streams must be a list of unique [element, stream] pairs", serialize=True)
+        sources = [tuple(source) for source in sources]
+    else:
+
+        # Make sure we got an element
+        if ("e" not in data) or (type(data["e"]) is not str):
+            return Response(err_code=2, err_str="element must be in data", serialize=True)
+
+        # Make sure we got a stream
+        if ("s" not in data) or (type(data["s"]) is not str):
+            return Response(err_code=3, err_str="stream must be in data", serialize=True)
+
+        sources = [(data["e"], data["s"])]
+
+    # Get the name
+    name = data["name"]
+
+    # Check that the name is not in use
+    if name in active_recordings:
+        return Response(err_code=4, err_str="Name {} already in use".format(name), serialize=True)
+
+    n_entries = None
+    n_sec = DEFAULT_N_SEC
+    perm = False
+    mode = "poll"
+    fsync = "never"
+    codec = None
+    block_size = BLOCK_SIZE
+
+    # Process either the n or t values that came in over the API
+    if ("n" in data) and (type(data["n"]) is int):
+        n_entries = data["n"]
+    if ("t" in data) and (type(data["t"]) is int):
+        n_sec = data["t"]
+    if ("mode" in data) and (data["mode"] in RECORDING_MODES):
+        mode = data["mode"]
+    elif ("mode" in data):
+        return Response(err_code=6, err_str="mode must be one of {}".format(RECORDING_MODES), serialize=True)
+    if ("fsync" in data) and ((data["fsync"] in FSYNC_POLICIES) or
+            ((type(data["fsync"]) in (int, float)) and (data["fsync"] > 0))):
+        fsync = data["fsync"]
+    elif ("fsync" in data):
+        return Response(err_code=7, err_str="fsync must be one of {} or a number of seconds".format(FSYNC_POLICIES), serialize=True)
+    if ("codec" in data) and (data["codec"] in CODECS):
+        codec = data["codec"]
+    elif ("codec" in data):
+        return Response(err_code=10, err_str="codec must be one of {}".format(list(CODECS.keys())), serialize=True)
+    if ("block_size" in data) and (type(data["block_size"]) is int) and (data["block_size"] > 0):
+        block_size = data["block_size"]
+    if ("encoding" in data) and (data["encoding"] not in ENCODINGS):
+        return Response(err_code=14, err_str="encoding must be one of {}".format(ENCODINGS), serialize=True)
+    typed = (data.get("encoding") == "typed")
+    delta = data.get("delta", False)
+    # Delta-encoding only pays off once the deltas are compressed
+    if (type(delta) is not bool) or (delta and ((not typed) or (codec is None))):
+        return Response(err_code=14, err_str="delta must be a boolean and needs the typed encoding and a codec", serialize=True)
+    if ("perm" in data) and (type(data["perm"]) is bool):
+        perm = data["perm"]
+
+        # If we have a permanent data request, make sure the user has
+        #   mounted a permanent location
+        if perm and not os.path.exists(PERM_RECORDING_LOC):
+            return Response(err_code=5, err_str="Please mount {} in your docker-compose file".format(PERM_RECORDING_LOC), serialize=True)
+
+    # Segmented recordings roll over to a new segment by size and/or time
+    segment_bytes = None
+    segment_sec = None
+    keep = None
+    for param in ("segment_mb", "segment_t"):
+        if (param in data) and ((type(data[param]) not in (int, float)) or (data[param] <= 0) or (mode == "ring")):
+            return Response(err_code=12, err_str="{} must be a positive number and can't be used with ring recordings".format(param), serialize=True)
+    if "segment_mb" in data:
+        segment_bytes = int(data["segment_mb"] * 1024 * 1024)
+    if "segment_t" in data:
+        segment_sec = data["segment_t"]
+    if "keep" in data:
+        if (type(data["keep"]) is not int) or (data["keep"] <= 0) or ((segment_bytes is None) and (segment_sec is None)):
+            return Response(err_code=13, err_str="keep must be a positive integer and needs segment_mb or segment_t", serialize=True)
+        keep = data["keep"]
+
+    # Recordings get a header noting their sources s.t. entries of a
+    #   recording of more than one source can be tagged with the index of
+    #   their source. Compressed and typed recordings note how they're
+    #   encoded s.t. slice and merge can write their entries the same way
+    header = {"sources": [list(source) for source in sources]}
+    if codec is not None:
+        header["codec"] = codec
+    if (codec is not None) or typed:
+        header["block_size"] = block_size
+    if typed:
+        header["encoding"] = "typed"
+        header["delta"] = delta
+
+    # Ring recordings don't open a file until they're triggered, each
+    #   trigger makes its own recording
+    if mode == "ring":
+        n_bytes = None
+        if "mb" in data:
+            if (type(data["mb"]) not in (int, float)) or (data["mb"] <= 0):
+                return Response(err_code=11, err_str="mb must be a positive number", serialize=True)
+            n_bytes = int(data["mb"] * 1024 * 1024)
+        ring_sec = n_sec if (("t" in data) or (n_bytes is None)) else None
+        ring = RecordingRing(ring_sec, n_bytes, header, fsync, codec, block_size, typed, delta)
+        recording = Recording(name, sources, None, n_sec, mode, None, ring=ring)
+        active_recordings[name] = recording
+        _recorder_engine().add(recording)
+
+        return Response(\
+            "Started ring recording {} keeping the last {}".format(
+                name, \
+                " and ".join(v for v in (
+                    "{} seconds".format(ring_sec) if ring_sec is not None else None,
+                    "{} MB".format(data["mb"]) if n_bytes is not None else None) if v is not None)), \
+            serialize=True)
+
+    # Open the file for the recording. A new recording replaces an old one
+    #   of the same name, be it a single file or segmented
+    folder = PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC
+    filename = os.path.join(folder, name + RECORDING_EXTENSION)
+    dirname = os.path.join(folder, name + SEGMENT_EXTENSION)
+    try:
+        if (segment_bytes is None) and (segment_sec is None):
+            if os.path.isdir(dirname):
+                _remove_segments(dirname)
+            recording_file = RecordingFile(filename, fsync, header, codec, block_size, typed, delta)
+        else:
+            for f in (filename, _index_filename(filename)):
+                if os.path.exists(f):
+                    os.remove(f)
+            filename = dirname
+            recording_file = SegmentedRecordingFile(dirname, fsync, header, codec, block_size,
+                segment_bytes, segment_sec, keep, typed, delta)
+    except:
+        return Response(err_code=8, err_str="Unable to open file {}".format(filename), serialize=True)
+
+    # Put the recording into the active_recordings struct and hand it off
+    #   to the engine to be read and written
+    recording = Recording(name, sources, n_entries, n_sec, mode, recording_file)
+    active_recordings[name] = recording
+    _recorder_engine().add(recording)
+
+    # Make the response
+    return Response(\
+        "Started recording {} for {} and storing in {}".format(
+            name, \
+            "{} entries".format(n_entries) if n_entries != None else "{} seconds".format(n_sec), \
+            PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC), \
+        serialize=True)
+
+def stop_recording(data):
+    '''
+    Stops a recording. Data should be a msgpack'd string of the name
+    '''
+    # Active recordings
+    global active_recordings
+
+    # Make sure the recording is active
+    if data not in active_recordings:
+        return Response(err_code=1, err_str="Recording {} not active".format(data), serialize=True)
+
+    # Note the recording and delete it from the active recordings object
+    recording = active_recordings.pop(data)
+
+    # Wait for the recording to finish
+    recording.join()
+
+    return Response("Success", serialize=True)
+
+def wait_recording(data):
+    '''
+    Waits for a recording to finish
+    '''
+    # Active recordings
+    global active_recordings
+
+    # Make sure the recording is active
+    if data not in active_recordings:
+        return Response(err_code=1, err_str="Recording {} not active".format(data), serialize=True)
+
+    start_time = time.time()
+    active_recordings[data].join()
+    stop_time = time.time()
+
+    return Response("Returned after {} seconds".format(stop_time - start_time), serialize=True)
+
+def trigger_recording(data):
+    '''
+    Triggers a ring recording, writing what's in its ring plus an optional
+    post-trigger window out to a new recording
+    '''
+    # Data should be a dictionary with the following keys
+    #   name: required. String for the name of the ring recording
+    #   out: Optional name of the recording to write. If omitted, will
+    #           default to the name of the ring recording and the time
+    #   post: Optional number of seconds to keep recording after the
+    #           trigger. If omitted, will default to 0, i.e. just the ring
+    #   perm: Optional boolean to make the recording persistent/permanent
+    global active_recordings
+
+    # Make sure we got the name of an active ring recording
+    if ("name" not in data) or (type(data["name"]) is not str):
+        return Response(err_code=1, err_str="name must be in data", serialize=True)
+    recording = active_recordings.get(data["name"])
+    if (not isinstance(recording, Recording)) or (recording.ring is None):
+        return Response(err_code=2, err_str="{} is not an active ring recording".format(data["name"]), serialize=True)
+
+    # Get the name of the new recording and make sure it's not in use
+    now = time.time()
+    out = data.get("out", "{}-{}-{:03d}".format(
+        data["name"], time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000))
+    if type(out) is not str:
+        return Response(err_code=3, err_str="out must be a string", serialize=True)
+    if out in active_recordings:
+        return Response(err_code=3, err_str="Name {} already in use".format(out), serialize=True)
+
+    post = data.get("post", 0)
+    if (type(post) not in (int, float)) or (post < 0):
+        return Response(err_code=4, err_str="post must be a non-negative number of seconds", serialize=True)
+
+    perm = False
+    if ("perm" in data) and (type(data["perm"]) is bool):
+        perm = data["perm"]
+        if perm and not os.path.exists(PERM_RECORDING_LOC):
+            return Response(err_code=5, err_str="Please mount {} in your docker-compose file".format(PERM_RECORDING_LOC), serialize=True)
+
+    ring = recording.ring
+    filename = os.path.join(
+        PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC, out + RECORDING_EXTENSION)
+    try:
+        recording_file = RecordingFile(filename, ring.fsync, ring.header, ring.codec, ring.block_size,
+            ring.typed, ring.delta)
+    except:
+        return Response(err_code=6, err_str="Unable to open file {}".format(filename), serialize=True)
+
+    # Hand the capture to the reader of the ring recording, it writes the
+    #   ring out on its next pass
+    capture = Capture(out, recording_file, time.monotonic() + post)
+    active_recordings[out] = capture
+    recording.writer.n_files += 1
+    ring.triggers.put(capture)
+
+    return Response(\
+        "Triggered {} into recording {} with {} seconds after the trigger, storing in {}".format(
+            data["name"], out, post, PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC), \
+        serialize=True)
+
+def _read_footer(file):
+    '''
+    Reads the footer from the end of a recording using the trailer. Returns
+    None if the recording doesn't have one, i.e. it was made with an older
+    version of this element or it was interrupted
+    '''
+    try:
+        file.seek(-TRAILER_LEN, os.SEEK_END)
+        trailer = msgpack.unpackb(file.read(TRAILER_LEN), raw=False)
+        if (type(trailer) is not dict) or (trailer.get(MARKER_KEY) != "tail"):
+            return None
+        offset = struct.unpack("<Q", trailer["footer"])[0]
+        file.seek(offset)
+        footer = msgpack.unpackb(file.read()[:-TRAILER_LEN], raw=False)
+    except Exception:
+        return None
+
+    if (type(footer) is not dict) or (footer.get(MARKER_KEY) != "footer"):
+        return None
+    return footer
+
+def _entry_keys(unpacker):
+    '''
+    Yields the source and set of keys of each entry from an unpacker, only
+    unpacking the sources and markers. All other values are skipped over.
+    Blocks are decompressed to get at the entries in them
+    '''
+    while True:
+        try:
+            record = {}
+            for i in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                if (key in (SOURCE_KEY, MARKER_KEY)) or (MARKER_KEY in record):
+                    record[key] = unpacker.unpack()
+                else:
+                    record[key] = None
+                    unpacker.skip()
+        except msgpack.OutOfData:
+            return
+
+        if MARKER_KEY not in record:
+            yield record.get(SOURCE_KEY, 0), record.keys() - {"id", SOURCE_KEY}
+        elif record[MARKER_KEY] == "block":
+
+            # Typed keys are pulled out of the entries of the block, and
+            #   every entry of the block has them
+            block = msgpack.Unpacker(raw=False, max_buffer_size=0)
+            block.feed(_decompress(record["codec"], record["data"]))
+            typed = set(record.get("columns") or ())
+            for (src, keys) in _entry_keys(block):
+                yield src, keys | typed
+
+def _scan_summary(file, filename, index, header):
+    '''
+    Summarizes a recording without a footer the slow way, going through
+    the index and the keys of each entry. Values are skipped over rather
+    than unpacked
+    '''
+    sources = header.get("sources", []) if header is not None else []
+    keys = [set() for source in sources] if len(sources) > 0 else [set()]
+
+    file.seek(0)
+    for (src, entry_keys) in _entry_keys(msgpack.Unpacker(file, raw=False, max_buffer_size=0)):
+        keys[src].update(entry_keys)
+
+    return {
+        "sources": sources,
+        "keys": [sorted(k) for k in keys],
+        "gaps": None,
+        "entries": len(index),
+        "first_id": "{}-{}".format(index["ts"][0], index["seq"][0]) if len(index) > 0 else None,
+        "last_id": "{}-{}".format(index["ts"][-1], index["seq"][-1]) if len(index) > 0 else None,
+        "bytes": os.fstat(file.fileno()).st_size,
+    }
+
+def _active_summary(recording):
+    '''
+    Summarizes an active recording from what it and its file know about
+    themselves, without reading the file. Counts only cover what's been
+    written so far
+    '''
+    summary = recording.summary()
+    recording_file = recording.recording_file
+    if isinstance(recording_file, SegmentedRecordingFile):
+        segments = list(recording_file.segments)
+        files = [segment for segment in segments if segment["entries"] is not None]
+        current = recording_file.current
+        first = next((segment["first_id"] for segment in files if segment["first_id"] is not None), None)
+        last = next((segment["last_id"] for segment in reversed(files) if segment["last_id"] is not None), None)
+        summary["entries"] = sum(segment["entries"] for segment in files) + current.entries
+        summary["bytes"] = sum(segment["bytes"] for segment in files) + current.offset
+        summary["segments"] = len(segments)
+    else:
+        current = recording_file
+        first = last = None
+        summary["entries"] = current.entries
+        summary["bytes"] = current.offset
+
+    if current.first is not None:
+        first = first if first is not None else "{}-{}".format(*current.first)
+        last = "{}-{}".format(*current.last)
+    summary["first_id"] = first
+    summary["last_id"] = last
+    summary["complete"] = False
+    return summary
+
+def _recording_summary(name, filename):
+    '''
+    Returns the summary of a recording from its footer. Recordings without
+    a footer, or segments with one that doesn't note their keys, are
+    scanned and the result cached until the file changes. Active
+    recordings are summarized from memory instead since they're always
+    changing
+    '''
+    recording = active_recordings.get(name)
+    if isinstance(recording, Recording) and (recording.recording_file is not None) and \
+            (recording.recording_file.filename == filename):
+        return _active_summary(recording)
+
+    if os.path.isdir(filename):
+        return _segments_summary(name, filename)
+
+    with open(filename, 'rb') as file:
+        footer = _read_footer(file)
+        if (footer is not None) and ("keys" in footer):
+            footer.pop(MARKER_KEY)
+            footer["complete"] = True
+            return footer
+
+        stat = os.fstat(file.fileno())
+        cached = summary_cache.get(filename)
+        if (cached is not None) and (cached[0] == (stat.st_mtime_ns, stat.st_size)):
+            return cached[1]
+
+        index = _load_index(filename, persist=(name not in active_recordings))
+        summary = _scan_summary(file, filename, index, _read_header(file))
+        summary["complete"] = False
+        summary_cache[filename] = ((stat.st_mtime_ns, stat.st_size), summary)
+        return summary
+
+def _segments_summary(name, dirname):
+    '''
+    Returns the summary of a segmented recording. The counts come from the
+    manifest for segments that are done. Once the recording is complete
+    the footer of the last segment summarizes all of it, until then each
+    segment is summarized on its own and the results combined.
+    '''
+    manifest = _read_manifest(dirname)
+    if manifest is None:
+        raise ValueError("No manifest in {}".format(dirname))
+    segments = manifest["segments"]
+    sources = manifest["header"].get("sources", [])
+
+    summary = {
+        "sources": sources,
+        "keys": [set() for source in sources] if len(sources) > 0 else [set()],
+        "gaps": None,
+        "entries": 0,
+        "first_id": None,
+        "last_id": None,
+        "bytes": 0,
+        "complete": manifest["complete"],
+        "segments": len(segments),
+    }
+
+    for i, segment in enumerate(segments):
+        if manifest["complete"] and (i < len(segments) - 1):
+            segment_summary = segment
+        else:
+            segment_summary = _recording_summary(name, os.path.join(dirname, segment["file"]))
+            for keys, segment_keys in zip(summary["keys"], segment_summary["keys"]):
+                keys.update(segment_keys)
+            if manifest["complete"]:
+                summary["gaps"] = segment_summary["gaps"]
+
+        summary["entries"] += segment_summary["entries"]
+        summary["bytes"] += segment_summary["bytes"]
+        if summary["first_id"] is None:
+            summary["first_id"] = segment_summary["first_id"]
+        if segment_summary["last_id"] is not None:
+            summary["last_id"] = segment_summary["last_id"]
+
+    summary["keys"] = [sorted(keys) for keys in summary["keys"]]
+    return summary
+
+def list_recordings(data):
+    '''
+    Returns a list of all recordings in the system. Data is optional and if
+    given should be a msgpack'd object with the following fields:
+
+    detailed: Optional, default false. If true, returns a summary of each
+        recording instead of just its name
+    '''
+    detailed = False
+    if (data is not None) and (len(data) > 0):
+        try:
+            request = msgpack.unpackb(data, raw=False)
+        except:
+            return Response(err_code=1, err_str="Failed to deserialize request", serialize=True)
+        if (type(request) is dict) and (type(request.get("detailed")) is bool):
+            detailed = request["detailed"]
+
+    recordings = []
+
+    # Loop over all locations
+    for folder in [PERM_RECORDING_LOC, TEMP_RECORDING_LOC]:
+
+        # If the folder doesn't exist, just move on
+        if not os.path.exists(folder):
+            continue
+
+        # Loop over all folders in the location
+        for filename in os.listdir(folder):
+
+            # If it ends with our extension, then add it. Segmented
+            #   recordings are folders
+            if filename.endswith(RECORDING_EXTENSION) or \
+                    (filename.endswith(SEGMENT_EXTENSION) and os.path.isdir(os.path.join(folder, filename))):
+                name = os.path.splitext(filename)[0]
+                if not detailed:
+                    recordings.append(name)
+                    continue
+
+                try:
+                    summary = _recording_summary(name, os.path.join(folder, filename))
+                except Exception as e:
+                    summary = {"error": str(e)}
+                summary["name"] = name
+                summary["perm"] = (folder == PERM_RECORDING_LOC)
+                summary["active"] = name in active_recordings
+                recordings.append(summary)
+
+    return Response(recordings, serialize=True)
+
+def _find_recording(name):
+    '''
+    Returns the filename of the recording with the given name, checking the
+    permanent location first, or None if there's no such recording. For
+    segmented recordings this is the folder of segments
+    '''
+    for folder in [PERM_RECORDING_LOC, TEMP_RECORDING_LOC]:
+        filename = os.path.join(folder, name + RECORDING_EXTENSION)
+        if os.path.exists(filename):
+            return filename
+        dirname = os.path.join(folder, name + SEGMENT_EXTENSION)
+        if os.path.isdir(dirname):
+            return dirname
+    return None
+
+class SegmentedFile:
+    '''
+    Read-only view of the segments of a segmented recording as one file,
+    with each segment at the offset the manifest notes for it. Segments are
+    only opened once they're read from and reads carry on into the next
+    segment at the end of one s.t. the entries can be streamed straight
+    through. fileno() is that of the last segment, which is the one
+    that's written to.
+    '''
+    def __init__(self, dirname, segments):
+        self.dirname = dirname
+        self.segments = segments
+        self.offsets = [segment["offset"] for segment in segments]
+        self.files = {}
+        self.current = 0
+        self.position = self.offsets[0] if len(segments) > 0 else 0
+
+    def _file(self, k):
+        if k not in self.files:
+            self.files[k] = open(os.path.join(self.dirname, self.segments[k]["file"]), 'rb', buffering=0)
+        return self.files[k]
+
+    def seek(self, offset):
+        self.current = max(bisect.bisect_right(self.offsets, offset) - 1, 0)
+        self.position = offset
+        if len(self.segments) > 0:
+            self._file(self.current).seek(offset - self.offsets[self.current])
+
+    def tell(self):
+        return self.position
+
+    def read(self, n=-1):
+        chunks = []
+        while (len(self.segments) > 0) and (n != 0):
+            chunk = self._file(self.current).read(n if n > 0 else -1)
+            if len(chunk) > 0:
+                chunks.append(chunk)
+                self.position += len(chunk)
+                if n > 0:
+                    break
+            elif self.current + 1 < len(self.segments):
+                self.current += 1
+                self.position = self.offsets[self.current]
+                self._file(self.current).seek(0)
+            else:
+                break
+        return b"".join(chunks)
+
+    def size(self):
+        '''
+        Offset of the end of the last segment
+        '''
+        if len(self.segments) == 0:
+            return 0
+        return self.offsets[-1] + os.fstat(self.fileno()).st_size
+
+    def fileno(self):
+        return self._file(len(self.segments) - 1).fileno()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _open_file(filename):
+    '''
+    Opens a recording found by _find_recording for reading, unbuffered
+    '''
+    if os.path.isdir(filename):
+        manifest = _read_manifest(filename)
+        if manifest is None:
+            raise OSError("No manifest in {}".format(filename))
+        return SegmentedFile(filename, manifest["segments"])
+    return open(filename, 'rb', buffering=0)
+
+def _read_header(file):
+    '''
+    Reads the header from the start of a recording. Returns None if the
+    recording doesn't have one, i.e. it's a recording of a single source
+    '''
+    file.seek(0)
+    unpacker = msgpack.Unpacker(file, raw=False)
+    try:
+        n_keys = unpacker.read_map_header()
+        if (n_keys == 0) or (unpacker.unpack() != MARKER_KEY) or (unpacker.unpack() != "header"):
+            return None
+        header = {}
+        for i in range(n_keys - 1):
+            key = unpacker.unpack()
+            header[key] = unpacker.unpack()
+    except (msgpack.OutOfData, ValueError):
+        return None
+
+    return header
+
+def _iter_entries(file, index, rows, use_msgpack, sources=None, keys=None, columns=None):
+    '''
+    Generator over the entries of a recording at the (sorted) entry indices
+    in rows. Seeks straight to the first entry using the index and then
+    streams the entries from there, skipping forward past any we don't want
+    and seeking again if the next one we want is far away. Blocks of
+    compressed recordings are decompressed once for all of the entries we
+    want from them. Yields (id, {key: value}) tuples, or
+    (id, {key: value}, [element, stream]) tuples if the list of sources is
+    passed. If a set of keys is passed only those keys are returned and the
+    values of the others are skipped over without being unpacked.
+
+    If a list of columns is passed and we're unpacking values, typed values
+    are left out of the entries and their arrays are handed back instead,
+    see _typed_columns.
+    '''
+    unpacker = None
+    position = None
+    block = None
+    block_offset = None
+    block_rows = None
+    typed = ()
+    arrays = (columns is not None) and use_msgpack
+    n = 0
+
+    # Plain views of the index columns, indexing the memmap itself
+    #   entry by entry is slow
+    offsets = np.asarray(index["offset"])
+    positions = np.asarray(index["pos"])
+    for row in rows:
+        offset = int(offsets[row])
+
+        if offset == block_offset:
+            unpacked = block[int(positions[row])]
+            if arrays and typed:
+                columns[-1][2].append(int(block_rows[positions[row]]))
+        else:
+
+            # Now, we want to loop over the file. Note that when we packed the file
+            #   we packed it as individual msgpack objects with no padding/association
+            #   between them so we need to use the msgpack streaming API
+            if (unpacker is None) or (offset < position) or (offset - position > READ_SKIP_BYTES):
+                file.seek(offset)
+                base = offset
+                unpacker = msgpack.Unpacker(file, raw=False)
+            else:
+                while base + unpacker.tell() < offset:
+                    unpacker.skip()
+
+            try:
+                unpacked = _unpack_record(unpacker, keys)
+            except msgpack.OutOfData:
+                return
+            position = base + unpacker.tell()
+            typed = ()
+
+            if unpacked.get(MARKER_KEY) == "block":
+                block, typed = _block_records(unpacked, keys, arrays)
+                block_offset = offset
+                unpacked = block[int(positions[row])]
+
+                # Note which rows of the block's arrays the entries we
+                #   want are, starting from the entry we're on. The arrays
+                #   only have rows for entries, not gap markers
+                if arrays and typed:
+                    block_rows = np.cumsum([("id" in record) for record in block]) - 1
+                    columns.append((n, typed, [int(block_rows[positions[row]])]))
+
+        # Make the
+        repacked = (unpacked["id"], {})
+
+        # If we should use msgpack to deserialize. Typed values are packed
+        #   back into the bytes they were recorded as if we shouldn't
+        for k in unpacked:
+            if (k != "id") and (k != SOURCE_KEY):
+                value = unpacked[k]
+                if k in typed:
+                    repacked[1][k] = value if use_msgpack else msgpack.packb(value, use_bin_type=True)
+                elif use_msgpack:
+                    repacked[1][k] = msgpack.unpackb(value, raw=False)
+                else:
+                    repacked[1][k] = value
+
+        if sources is not None:
+            repacked = repacked + (sources[unpacked.get(SOURCE_KEY, 0)],)
+
+        n += 1
+        yield repacked
+
+def _typed_columns(result, columns):
+    '''
+    Puts together the arrays of typed keys noted by _iter_entries for the
+    list of entries it gave. Keys that were typed for every entry, with the
+    same dtype and shape throughout, come back as a _Column of all of their
+    values without ever being turned into lists, key -> column. Values of
+    any other typed keys are put back into their entries. The entries may
+    be shared with the recording cache, so that's done on copies of them.
+    Returns the entries and the columns
+    '''
+    pieces = {}
+    for (start, arrays, positions) in columns:
+        for key, array in arrays.items():
+            pieces.setdefault(key, []).append((start, array[positions]))
+
+    typed = {}
+    copied = None
+    for key, key_pieces in pieces.items():
+        arrays = [array for (start, array) in key_pieces]
+        if (sum(len(array) for array in arrays) == len(result)) and (arrays[0].ndim <= 2) and \
+                all((array.dtype == arrays[0].dtype) and (array.shape[1:] == arrays[0].shape[1:]) for array in arrays):
+            typed[key] = np.concatenate(arrays).view(_Column)
+            continue
+        if copied is None:
+            copied = list(result)
+        for (start, array) in key_pieces:
+            for i, value in enumerate(array.tolist(), start):
+                copied[i] = copied[i][:1] + (dict(copied[i][1], **{key: value}),) + copied[i][2:]
+
+    return (result if copied is None else copied), typed
+
+def _fill_typed(result, typed):
+    '''
+    Returns copies of the entries with the values of typed columns put back
+    in, for when they have to be gone through entry by entry
+    '''
+    values = {key: column.view(np.ndarray).tolist() for key, column in typed.items()}
+    if len(values) == 0:
+        return result
+    return [entry[:1] + (dict(entry[1], **{key: values[key][i] for key in values}),) + entry[2:]
+        for i, entry in enumerate(result)]
+
+def _skip_packed(buf, pos):
+    '''
+    Returns the offset just past the msgpack object at pos in buf without
+    unpacking it
+    '''
+    b = buf[pos]
+    if (b <= 0x7f) or (b >= 0xe0) or (b in (0xc0, 0xc2, 0xc3)):
+        return pos + 1
+    if b <= 0x8f:
+        return _skip_items(buf, pos + 1, 2 * (b & 0x0f))
+    if b <= 0x9f:
+        return _skip_items(buf, pos + 1, b & 0x0f)
+    if b <= 0xbf:
+        return pos + 1 + (b & 0x1f)
+    if b in PACKED_LENGTHS:
+        size, extra = PACKED_LENGTHS[b]
+        n = int.from_bytes(buf[pos + 1:pos + 1 + size], "big")
+        return pos + 1 + size + extra + n
+    if b in PACKED_CONTAINERS:
+        size, per_item = PACKED_CONTAINERS[b]
+        n = int.from_bytes(buf[pos + 1:pos + 1 + size], "big")
+        return _skip_items(buf, pos + 1 + size, per_item * n)
+    if b in PACKED_FIXED:
+        return pos + PACKED_FIXED[b]
+    raise ValueError("Invalid msgpack at {}".format(pos))
+
+def _skip_items(buf, pos, n):
+    '''
+    Returns the offset just past the n msgpack objects starting at pos
+    '''
+    for i in range(n):
+        pos = _skip_packed(buf, pos)
+    return pos
+
+def _map_recording(file, offsets):
+    '''
+    Memory-maps a recording opened by _open_recording. Returns a list of
+    (offset, map) for the file, or for each segment of a segmented
+    recording that one of the record offsets is in, or None if it can't be
+    mapped
+    '''
+    try:
+        if isinstance(file, SegmentedFile):
+            segments = np.unique(np.searchsorted(file.offsets, offsets, side="right") - 1).tolist()
+            return [(file.offsets[k], mmap.mmap(file._file(k).fileno(), 0, access=mmap.ACCESS_READ))
+                for k in segments]
+        return [(0, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))]
+    except (OSError, ValueError):
+        return None
+
+def _raw_entries(file, index, rows, sources=None, keys=None):
+    '''
+    Returns the entries of a recording at the entry indices in rows already
+    packed, for reads that pass the values through as bytes. Each entry
+    packs to the same bytes as the (id, {key: value}) tuple _iter_entries
+    gives with use_msgpack false (with the source tacked on if the list of
+    sources is passed), but instead of unpacking the entry and packing it
+    back up the recording is memory-mapped and the bytes of the ID and of
+    each key and value are sliced straight out of the map. Returns a list
+    with the list of parts of each entry, to be joined by the caller, or
+    None if the recording can't be read this way, i.e. it's compressed or
+    typed, s.t. the caller falls back to _iter_entries. The maps are
+    closed once the parts are dropped.
+    '''
+    maps = _map_recording(file, index["offset"][rows])
+    if maps is None:
+        return None
+
+    packer = msgpack.Packer(use_bin_type=True)
+    starts = [offset for (offset, buf) in maps]
+    views = [memoryview(buf) for (offset, buf) in maps]
+    packed_sources = None if sources is None else [packer.pack(source) for source in sources]
+    src = np.asarray(index["src"])
+    header = packer.pack_array_header(2 if sources is None else 3)
+    packed_keys = None if keys is None else {packer.pack(key) for key in keys}
+
+    offsets = np.asarray(index["offset"])
+    entries = []
+    try:
+        for row in rows:
+            offset = int(offsets[row])
+            k = bisect.bisect_right(starts, offset) - 1
+            base, buf, view = starts[k], maps[k][1], views[k]
+            pos = offset - base
+
+            # Walk the pairs of the entry's map, keeping the spans of the
+            #   ones we pass through and picking out the ID. Markers mean
+            #   the recording is made of blocks
+            b = buf[pos]
+            if 0x80 <= b <= 0x8f:
+                n, pos = b & 0x0f, pos + 1
+            elif b == 0xde:
+                n, pos = int.from_bytes(buf[pos + 1:pos + 3], "big"), pos + 3
+            elif b == 0xdf:
+                n, pos = int.from_bytes(buf[pos + 1:pos + 5], "big"), pos + 5
+            else:
+                return None
+
+            spans = []
+            n_kept = 0
+            redis_id = None
+            for i in range(n):
+                b = buf[pos]
+                value = (pos + 1 + (b & 0x1f)) if 0xa0 <= b <= 0xbf else _skip_packed(buf, pos)
+                b = buf[value]
+                if b == 0xc4:
+                    end = value + 2 + buf[value + 1]
+                elif b in (0xc5, 0xc6):
+                    size = 2 if b == 0xc5 else 4
+                    end = value + 1 + size + int.from_bytes(buf[value + 1:value + 1 + size], "big")
+                else:
+                    end = _skip_packed(buf, value)
+                key = buf[pos:value]
+                if key == PACKED_ID:
+                    redis_id = view[value:end]
+                elif key == PACKED_MARKER:
+                    return None
+                elif (key != PACKED_SOURCE) and ((packed_keys is None) or (key in packed_keys)):
+                    if (len(spans) > 0) and (spans[-1][1] == pos):
+                        spans[-1][1] = end
+                    else:
+                        spans.append([pos, end])
+                    n_kept += 1
+                pos = end
+            if (redis_id is None) or (pos > len(buf)):
+                return None
+
+            parts = [header, redis_id, packer.pack_map_header(n_kept)]
+            parts.extend(view[start:end] for (start, end) in spans)
+            if packed_sources is not None:
+                parts.append(packed_sources[int(src[row])])
+            entries.append(parts)
+    except (IndexError, ValueError):
+        return None
+
+    return entries
+
+def _resolve_range(data, index, n_before=0):
+    '''
+    Converts the start/stop entry indices and t_start/t_stop redis
+    timestamps (in ms) in a request into an inclusive [start, stop] range
+    of entry indices into the recording. If both are given the range is the
+    intersection of the two. The time bounds are found with a binary search
+    over the index timestamps, which only touches the rows it compares
+    against (np.searchsorted would copy the whole column out of the map).
+    For segmented recordings the index only covers the segments we opened,
+    n_before is the number of entries before it and the range returned is
+    into the index.
+    '''
+    start_idx = 0
+    stop_idx = -1
+
+    if ("start" in data) and (type(data["start"]) is int):
+        start_idx = data["start"]
+    if ("stop" in data) and (type(data["stop"]) is int):
+        stop_idx = data["stop"]
+
+    start_idx = max(start_idx - n_before, 0)
+    if (stop_idx < 0) or (stop_idx - n_before >= len(index)):
+        stop_idx = len(index) - 1
+    else:
+        stop_idx -= n_before
+
+    if ("t_start" in data) and (type(data["t_start"]) in (int, float)):
+        start_idx = max(start_idx, bisect.bisect_left(index["ts"], data["t_start"]))
+    if ("t_stop" in data) and (type(data["t_stop"]) in (int, float)):
+        stop_idx = min(stop_idx, bisect.bisect_right(index["ts"], data["t_stop"]) - 1)
+
+    return start_idx, stop_idx
+
+def _session_sources(header):
+    '''
+    Returns the list of [element, stream] sources of a recording with more
+    than one source, else None
+    '''
+    if (header is None) or (len(header.get("sources", [])) <= 1):
+        return None
+    return header["sources"]
+
+def _resolve_source(data, header):
+    '''
+    Returns the index of the source picked out by the e and s fields of a
+    request. Returns None if they aren't given or the recording doesn't
+    note its sources, and -1 if the recording has no such source
+    '''
+    if ("e" not in data) or ("s" not in data) or (header is None) or ("sources" not in header):
+        return None
+    try:
+        return header["sources"].index([data["e"], data["s"]])
+    except ValueError:
+        return -1
+
+def _select_rows(index, start_idx, stop_idx, src):
+    '''
+    Returns the entry indices in [start_idx, stop_idx] which came from
+    the source src, or all of them if src is None
+    '''
+    rows = np.arange(start_idx, max(stop_idx + 1, start_idx))
+    if src is None:
+        return rows
+    if src < 0:
+        return rows[:0]
+    return rows[index["src"][rows] == src]
+
+def _select_segments(segments, data):
+    '''
+    Picks out the segments of a segmented recording that overlap the
+    start/stop and t_start/t_stop range of a request, going by the entry
+    counts and ID ranges in the manifest. The segment being written doesn't
+    have those yet, so it always overlaps. Returns the segments along with
+    the number of entries in the segments before them.
+    '''
+    start_idx = data["start"] if type(data.get("start")) is int else 0
+    stop_idx = data["stop"] if type(data.get("stop")) is int else -1
+    t_start = data["t_start"] if type(data.get("t_start")) in (int, float) else None
+    t_stop = data["t_stop"] if type(data.get("t_stop")) in (int, float) else None
+
+    selected = []
+    n_before = 0
+    n_entries = 0
+    for segment in segments:
+        n = segment["entries"]
+        if n == 0:
+            continue
+        overlaps = ((n is None) or (n_entries + n - 1 >= start_idx)) and \
+            ((stop_idx < 0) or (n_entries <= stop_idx))
+        if n is not None:
+            overlaps = overlaps and \
+                ((t_start is None) or (_split_id(segment["last_id"])[0] >= t_start)) and \
+                ((t_stop is None) or (_split_id(segment["first_id"])[0] <= t_stop))
+        if overlaps:
+            if len(selected) == 0:
+                n_before = n_entries
+            selected.append(segment)
+        n_entries += n if n is not None else 0
+
+    return selected, n_before
+
+def _open_segments(data, dirname):
+    '''
+    Opens a segmented recording for _open_recording, loading the indices of
+    only the segments that overlap the request. The offsets in the index
+    are shifted by the offset of their segment s.t. they can be used with
+    a SegmentedFile.
+    '''
+    manifest = _read_manifest(dirname)
+    if manifest is None:
+        return Response(err_code=2, err_str="Failed to read manifest of {}".format(dirname), serialize=True)
+
+    header = manifest.get("header")
+    if (header is not None) and ("codec" in header) and (header["codec"] not in CODECS):
+        return Response(err_code=2, err_str="Recording {} needs codec {} which isn't installed".format(
+            data["name"], header["codec"]), serialize=True)
+
+    segments, n_before = _select_segments(manifest["segments"], data)
+    indices = []
+    try:
+        for segment in segments:
+            index = _load_index(os.path.join(dirname, segment["file"]),
+                persist=(data["name"] not in active_recordings) and (not plot_worker))
+            index = index.copy()
+            index["offset"] += segment["offset"]
+            indices.append(index)
+    except OSError:
+        return Response(err_code=2, err_str="Failed to open segment {} of {}".format(segment["file"], dirname), serialize=True)
+
+    index = np.concatenate(indices) if len(indices) > 0 else np.zeros(0, dtype=INDEX_DTYPE)
+    return SegmentedFile(dirname, manifest["segments"]), dirname, index, header, n_before
+
+def _open_recording(data):
+    '''
+    Finds and opens the recording named in a request and loads its index
+    and header. Will return a Response() type on error, else a tuple of the
+    open (unbuffered) file, its filename, the index, the header and the
+    number of entries before the index, which is only nonzero for segmented
+    recordings
+    '''
+    if (("name" not in data) or (type(data["name"]) is not str)):
+        return Response(err_code=1, err_str="Name is required", serialize=True)
+
+    name = data["name"]
+
+    # Make sure we found the file
+    filename = _find_recording(name)
+    if filename is None:
+        return Response(err_code=3, err_str="No recording {}".format(name), serialize=True)
+    if os.path.isdir(filename):
+        return _open_segments(data, filename)
+
+    try:
+        file = open(filename, 'rb', buffering=0)
+    except:
+        return Response(err_code=2, err_str="Failed to open file {}".format(filename), serialize=True)
+
+    # Load the index s.t. we can jump straight to the start entry. Don't
+    #   write back to the index if the recording is still going since the
+    #   recorder owns it
+    header = _read_header(file)
+    if (header is not None) and ("codec" in header) and (header["codec"] not in CODECS):
+        file.close()
+        return Response(err_code=2, err_str="Recording {} needs codec {} which isn't installed".format(
+            name, header["codec"]), serialize=True)
+
+    index = _load_index(filename, persist=(name not in active_recordings) and (not plot_worker))
+
+    return file, filename, index, header, 0
+
+def _entries_size(obj):
+    '''
+    Rough size in bytes of decoded entries, counting the data they hold
+    plus a fixed overhead for each object
+    '''
+    if isinstance(obj, (bytes, str)):
+        return 48 + len(obj)
+    if isinstance(obj, np.ndarray):
+        return 112 + obj.nbytes
+    if isinstance(obj, dict):
+        return 64 + sum(_entries_size(k) + _entries_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return 56 + sum(_entries_size(v) for v in obj)
+    return 32
+
+class RecordingCache:
+    '''
+    LRU cache of decoded windows of recordings s.t. running plot, csv or get
+    over and over on the same recording doesn't decode it every time. Each
+    window is stored along with the mtime and size of the recording when it
+    was decoded and is thrown out as soon as the recording changes, which
+    also covers recordings that are still being written. Windows are
+    evicted least recently used first once the cache is over its budget.
+    If counters is given the cache notes its counters in its slot of it,
+    for the caches of the plot and export processes (see ProcessPool).
+    '''
+    def __init__(self, budget, counters=None, slot=0):
+        self.budget = budget
+        self.windows = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+        self.counters = counters
+        self.slot = slot
+
+    def _drop(self, key):
+        stamp, entries, size = self.windows.pop(key)
+        self.size -= size
+
+    def get(self, key, stamp):
+        '''
+        Returns the cached entries for the key or None if they aren't in the
+        cache or the recording has changed since they were decoded
+        '''
+        with self.lock:
+            cached = self.windows.get(key)
+            if (cached is not None) and (cached[0] == stamp):
+                self.windows.move_to_end(key)
+                self.hits += 1
+                self._note()
+                return cached[1]
+            if cached is not None:
+                self._drop(key)
+            self.misses += 1
+            self._note()
+            return None
+
+    def put(self, key, stamp, entries):
+        '''
+        Caches the entries decoded for the key, evicting the least recently
+        used windows to make room. Windows bigger than the budget aren't
+        cached.
+        '''
+        size = _entries_size(entries)
+        if size > self.budget:
+            return
+
+        with self.lock:
+            # Throw out windows of older versions of the recording
+            for other in [k for k, v in self.windows.items() if (k[0] == key[0]) and (v[0] != stamp)]:
+                self._drop(other)
+            if key in self.windows:
+                self._drop(key)
+
+            while self.size + size > self.budget:
+                self._drop(next(iter(self.windows)))
+                self.evictions += 1
+
+            self.windows[key] = (stamp, entries, size)
+            self.size += size
+            self._note()
+
+    def _counts(self):
+        return [self.hits, self.misses, self.evictions, len(self.windows), self.size, self.budget]
+
+    def _note(self):
+        if self.counters is not None:
+            n = len(CACHE_COUNTERS)
+            self.counters[self.slot * n:(self.slot + 1) * n] = self._counts()
+
+    def stats(self):
+        with self.lock:
+            return dict(zip(CACHE_COUNTERS, self._counts()))
+
+recording_cache = RecordingCache(CACHE_BUDGET)
+
+def _decode_chunk(filename, index, use_msgpack, sources, keys, columns=False):
+    '''
+    Decodes the entries at the rows of the index for one chunk of a read
+    split up by _decode_entries. Runs in one of the export processes. If
+    columns is true the typed columns noted while decoding are handed back
+    too, cut down to the rows of the chunk
+    '''
+    with _open_file(filename) as file:
+        if not columns:
+            return list(_iter_entries(file, index, np.arange(len(index)), use_msgpack, sources, keys))
+        pieces = []
+        result = list(_iter_entries(file, index, np.arange(len(index)), use_msgpack, sources, keys, pieces))
+    return result, [(start, {key: array[positions] for key, array in arrays.items()}, slice(None))
+        for (start, arrays, positions) in pieces]
+
+def _decode_entries(file, filename, index, rows, use_msgpack, sources=None, keys=None, columns=None):
+    '''
+    Returns the list of entries at the rows of the index, same as
+    _iter_entries. Long reads are split at entry boundaries from the index
+    into a couple of chunks per export process and decoded across them,
+    including unpacking each value, and the chunks are put back together
+    in order. Typed columns are noted in columns if it's given, same as
+    _iter_entries.
+    '''
+    n_chunks = min(2 * EXPORT_POOL_SIZE, len(rows) // DECODE_CHUNK_LEN)
+    if (EXPORT_POOL_SIZE < 2) or (n_chunks < 2):
+        return list(_iter_entries(file, index, rows, use_msgpack, sources, keys, columns))
+
+    pool = _export_pool()
+    pending = [pool.submit(_decode_chunk, filename, index[chunk], use_msgpack, sources, keys, columns is not None)
+        for chunk in np.array_split(rows, n_chunks)]
+    result = []
+    for future in pending:
+        if columns is None:
+            result.extend(future.result())
+            continue
+        chunk, pieces = future.result()
+        columns.extend((len(result) + start, arrays, positions) for (start, arrays, positions) in pieces)
+        result.extend(chunk)
+    return result
+
+def _get_recording(data, tag_sources=False, max_rows=None, keys=None, raw=False, columns=None):
+    '''
+    Returns the contents of a recording. Takes a msgpack serialized
+    request object with the following fields:
+
+    name: required recording name
+    start: start entry index
+    stop: stop entry index
+    t_start: start redis timestamp (ms)
+    t_stop: stop redis timestamp (ms)
+    e, s: element and stream of the source to return entries from, for
+        recordings of more than one source
+    msgpack: if we should use msgpack to deserialize values, assumed false
+
+    Will return a Response() type on error, else a list of all items
+    in the recording. If the recording has more than one source and e and s
+    aren't given it's an error, unless tag_sources is true in which case
+    each item gets its [element, stream] tacked on the end. If max_rows is
+    given and the range has more entries than that, only max_rows entries
+    evenly spread over the range are decoded. If a set of keys is given,
+    only those keys of each entry are decoded.
+
+    The list may be shared with the recording cache, so it must not be
+    modified. If raw is true and values aren't being deserialized, the
+    list comes back already packed as bytes instead when the entries can
+    be sliced straight out of the recording (see _raw_entries). If a list
+    of columns is given, typed values are left out of the entries and
+    noted in it instead (see _typed_columns), and they're cached along with
+    the entries.
+    '''
+    opened = _open_recording(data)
+    if type(opened) is not tuple:
+        return opened
+    file, filename, index, header, n_before = opened
+
+    use_msgpack = False
+    if ("msgpack" in data) and (type(data["msgpack"]) is bool):
+        use_msgpack = data["msgpack"]
+
+    with file:
+        src = _resolve_source(data, header)
+        sources = None
+        if (src is None) and (_session_sources(header) is not None):
+            if not tag_sources:
+                return Response(err_code=11, err_str="Recording has multiple sources, e and s are required", serialize=True)
+            sources = header["sources"]
+
+        start_idx, stop_idx = _resolve_range(data, index, n_before)
+
+        stat = os.fstat(file.fileno())
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = (filename, n_before, use_msgpack, start_idx, stop_idx, src, sources is not None, max_rows, keys,
+            columns is not None)
+        cached = recording_cache.get(key, stamp)
+        if (cached is not None) and (columns is not None):
+            columns.extend(cached[1])
+            return cached[0]
+        if cached is not None:
+            return cached
+
+        rows = _select_rows(index, start_idx, stop_idx, src)
+        if (max_rows is not None) and (len(rows) > max_rows):
+            rows = rows[_stride_indices(len(rows), max_rows)]
+
+        # Pass the entries through as they are on disk if we can. They
+        #   aren't decoded so there's nothing to cache
+        if raw and not use_msgpack:
+            entries = _raw_entries(file, index, rows, sources, keys)
+            if entries is not None:
+                packer = msgpack.Packer(use_bin_type=True)
+                return b"".join(itertools.chain([packer.pack_array_header(len(entries))], *entries))
+
+        result = _decode_entries(file, filename, index, rows, use_msgpack, sources, keys, columns)
+        recording_cache.put(key, stamp, result if columns is None else (result, list(columns)))
+        return result
+
+def _stride_indices(n, max_points):
+    '''
+    Indices of max_points points evenly spread over n points, including
+    the first and last
+    '''
+    return np.linspace(0, n - 1, max_points).astype(int)
+
+def _minmax_indices(y, max_points):
+    '''
+    Splits the series into max_points / 2 buckets and returns the indices
+    of the min and max of each bucket, in order
+    '''
+    n = len(y)
+    buckets = (np.arange(n) * (max_points // 2)) // n
+
+    # Sort by bucket and then value, s.t. the min and max of each bucket
+    #   are at its edges
+    order = np.lexsort((y, buckets))
+    starts = np.searchsorted(buckets[order], np.arange(max_points // 2))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+def _lttb_indices(x, y, max_points):
+    '''
+    Largest triangle three buckets. Keeps the first and last points and
+    splits the rest into max_points - 2 buckets. From each bucket keeps the
+    point making the largest triangle with the point kept from the bucket
+    before and the average of the bucket after.
+    '''
+    n = len(y)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+
+    kept = np.empty(max_points, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        kept[i + 1] = a
+    return kept
+
+def _downsample(x, y, max_points, method):
+    '''
+    Returns the indices of the points of the series to keep s.t. there are
+    at most max_points of them, using one of DOWNSAMPLE_METHODS
+    '''
+    if len(y) <= max_points:
+        return np.arange(len(y))
+    if method == "lttb":
+        return _lttb_indices(x, y, max_points)
+    return _minmax_indices(y, max_points)
+
+def _check_keys(data):
+    '''
+    Pulls the keys to read out of a request. Returns None if all keys should
+    be read, else the set of keys, or a string describing the problem if
+    they're invalid
+    '''
+    keys = data.get("keys", None)
+    if keys is None:
+        return None
+    if (type(keys) is not list) or any(type(key) is not str for key in keys):
+        return "keys must be a list of strings"
+    return frozenset(keys)
+
+def _check_downsample(data):
+    '''
+    Pulls max_points and the downsample method out of a request. Returns
+    (max_points, method) with max_points None if we shouldn't downsample, or
+    a string describing the problem if they're invalid
+    '''
+    max_points = data.get("max_points", None)
+    if (max_points is not None) and ((type(max_points) is not int) or (max_points < 3)):
+        return "max_points must be an integer of at least 3"
+    method = data.get("downsample", DOWNSAMPLE_METHODS[0])
+    if method not in DOWNSAMPLE_METHODS:
+        return "downsample must be one of {}".format(", ".join(DOWNSAMPLE_METHODS))
+    return max_points, method
+
+def _get_recording_downsampled(data, max_points, method, keys=None):
+    '''
+    Returns at most max_points entries of a recording for a preview. If
+    a key is given, the entries kept are picked by downsampling the values
+    of the key (or the lambda in the request run on them) against their
+    redis timestamps, else they're evenly spread over the range and only
+    the entries kept are decoded
+    '''
+    if "key" not in data:
+        return _get_recording(data, tag_sources=True, max_rows=max_points, keys=keys)
+
+    if (keys is not None) and (type(data["key"]) is str):
+        keys = keys | {data["key"]}
+    result = _get_recording(data, tag_sources=True, keys=keys)
+    if (type(result) is not list) or (len(result) <= max_points):
+        return result
+
+    try:
+        fn = _make_lambda("x", data.get("lambda", "x"))
+        values = [entry[1][data["key"]] for entry in result]
+    except:
+        return Response(err_code=6, err_str="Key {} not in recording or invalid lambda".format(data["key"]), serialize=True)
+
+    y = _vectorize(fn, _make_column(values), values, _same_number)
+    if (y is None) or (y.ndim != 1):
+        try:
+            y = np.array([float(fn(value)) for value in values])
+        except:
+            return Response(err_code=7, err_str="Values of key {} aren't numbers".format(data["key"]), serialize=True)
+
+    x = np.array([int(entry[0].split('-')[0]) for entry in result])
+    return [result[i] for i in _downsample(x, y, max_points, method)]
+
+def _encode_cursor(next_idx, stop_idx, src):
+    '''
+    Makes the opaque cursor string handed back to the client for the next
+    page of a paginated get
+    '''
+    return base64.urlsafe_b64encode(msgpack.packb([next_idx, stop_idx, src])).decode()
+
+def _decode_cursor(cursor):
+    '''
+    Decodes a cursor made by _encode_cursor. Returns None if the cursor
+    is not valid
+    '''
+    try:
+        next_idx, stop_idx, src = msgpack.unpackb(base64.urlsafe_b64decode(cursor))
+    except:
+        return None
+    if (type(next_idx) is not int) or (type(stop_idx) is not int) or \
+            ((src is not None) and (type(src) is not int)):
+        return None
+    return next_idx, stop_idx, src
+
+def _page_rows(index, rows, end, max_bytes):
+    '''
+    Returns the first of rows that fit in max_bytes of recording on disk.
+    Each record counts at the first of its entries in the page, so a plain
+    entry counts for its own size and the entries of a block for the size
+    of the block, and a page stops before a block that doesn't fit. The
+    page always has the entries of at least one record, since we read all
+    of a block to get any of its entries. The sizes come from the index rows the page covers,
+    PAGE_SCAN_LEN rows at a time, each record running up to the start of
+    the next one or the end of the recording
+    '''
+    offsets = index["offset"]
+    total = 0
+    counted = None
+    for start in range(0, len(rows), PAGE_SCAN_LEN):
+        chunk = rows[start:start + PAGE_SCAN_LEN]
+
+        # Start of each record in the window of the index from the first
+        #   row of the chunk through the end of the record of the last
+        first = int(chunk[0])
+        stop = bisect.bisect_right(offsets, offsets[chunk[-1]])
+        window = np.asarray(offsets[first:stop], dtype=np.int64)
+        starts = np.flatnonzero(window[1:] != window[:-1]) + 1
+        ends = np.append(window[starts], int(offsets[stop]) if stop < len(index) else end)
+        sizes = ends[np.searchsorted(starts, chunk - first, side="right")] - window[chunk - first]
+
+        # Only count each record once
+        records = window[chunk - first]
+        new = np.empty(len(chunk), dtype=bool)
+        new[0] = records[0] != counted
+        new[1:] = records[1:] != records[:-1]
+        totals = total + np.cumsum(np.where(new, sizes, 0))
+
+        n = int(np.searchsorted(totals, max_bytes, side="right"))
+        if (start == 0) and (n == 0):
+            n = int(np.argmax(records != records[0])) or len(chunk)
+        if n < len(chunk):
+            return rows[:start + n]
+        total = int(totals[-1])
+        counted = records[-1]
+
+    return rows
+
+def _get_recording_page(data, keys=None):
+    '''
+    Returns one page of a recording for a paginated get. The page is bounded
+    by the limit (entries) and max_bytes (bytes of recording on disk) fields
+    of the request and entries are packed into the response one by one as
+    they're decoded so we never hold more than the page in memory. If a set
+    of keys is given only those keys of each entry are returned.
+    '''
+    # Either pick up where the last page left off or start a new query
+    #   from the range in the request. The range in the cursor already has
+    #   any time bounds applied
+    request = data
+    if "cursor" in data:
+        cursor = _decode_cursor(data["cursor"])
+        if cursor is None:
+            return Response(err_code=4, err_str="Invalid cursor", serialize=True)
+        request = {k: v for k, v in data.items() if k not in ("t_start", "t_stop")}
+        request["start"], request["stop"], src = cursor
+
+    opened = _open_recording(request)
+    if type(opened) is not tuple:
+        return opened
+    file, filename, index, header, n_before = opened
+
+    with file:
+        start_idx, stop_idx = _resolve_range(request, index, n_before)
+        if "cursor" not in data:
+            src = _resolve_source(data, header)
+
+        # Entries of a recording with more than one source get tagged with
+        #   their source unless we're only returning one of them
+        sources = _session_sources(header) if src is None else None
+
+        use_msgpack = False
+        if ("msgpack" in data) and (type(data["msgpack"]) is bool):
+            use_msgpack = data["msgpack"]
+
+        # Bound the page by entry count and by the size of the entries on
+        #   disk. We always return at least one entry s.t. we make progress,
+        #   and all of a block's entries in range if we have to read it
+        rows = _select_rows(index, start_idx, stop_idx, src)
+        if ("limit" in data) and (type(data["limit"]) is int) and (data["limit"] > 0):
+            rows = rows[:data["limit"]]
+        if ("max_bytes" in data) and (type(data["max_bytes"]) is int) and (len(rows) > 0):
+            end = file.size() if isinstance(file, SegmentedFile) else os.fstat(file.fileno()).st_size
+            rows = _page_rows(index, rows, end, data["max_bytes"])
+
+        # Pass the entries through as they are on disk if we can, else
+        #   pack them up as we decode them
+        packer = msgpack.Packer(use_bin_type=True)
+        packed = None if use_msgpack else _raw_entries(file, index, rows, sources, keys)
+        if packed is None:
+            packed = [[packer.pack(entry)] for entry in
+                _iter_entries(file, index, rows, use_msgpack, sources, keys)]
+
+    cursor = None
+    if len(packed) > 0:
+        next_idx = int(rows[len(packed) - 1]) + 1
+        if next_idx <= stop_idx:
+            cursor = _encode_cursor(n_before + next_idx, n_before + stop_idx, src)
+
+    # Put together the response by hand since the entries are already packed
+    response = b"".join(itertools.chain([
+        packer.pack_map_header(2),
+        packer.pack("entries"),
+        packer.pack_array_header(len(packed))],
+        *packed, [
+        packer.pack("cursor"),
+        packer.pack(cursor)]))
+
+    return Response(response, serialize=False)
+
+def get_recording(data):
+    '''
+    Returns the contents of a recording. Takes a msgpack serialized
+    request object with the following fields:
+
+    name: required recording name
+    start: start entry index
+    stop: stop entry index
+    t_start: start redis timestamp (ms)
+    t_stop: stop redis timestamp (ms)
+    msgpack: if we should use msgpack to deserialize values, assumed false
+    e, s: element and stream of the source to return entries from, for
+        recordings of more than one source. If not given each entry of
+        such a recording has its [element, stream] tacked on the end
+    limit: max number of entries to return. Returns a page (see below)
+    max_bytes: max bytes of recording to return. Returns a page
+    cursor: cursor from a previous page to get the next page of
+    max_points: max number of entries to return, for previews. The entries
+        are downsampled (see below)
+    downsample: how to downsample, one of DOWNSAMPLE_METHODS. Default minmax
+    key: key whose values are downsampled to pick the entries to return. If
+        not given the entries are evenly spread over the range
+    lambda: optional lambda x: ... to turn the values of key into numbers
+    keys: optional list of keys to return. The values of other keys are
+        skipped over instead of being decoded
+
+    If any of limit, max_bytes or cursor are passed the response is a page,
+    i.e. a map with the entries under "entries" and the cursor for the next
+    page under "cursor". The cursor is None once there are no more entries.
+    '''
+    keys = _check_keys(data)
+    if type(keys) is str:
+        return Response(err_code=8, err_str=keys, serialize=True)
+
+    if any(k in data for k in ("limit", "max_bytes", "cursor")):
+        return _get_recording_page(data, keys)
+
+    downsample = _check_downsample(data)
+    if type(downsample) is str:
+        return Response(err_code=5, err_str=downsample, serialize=True)
+    max_points, method = downsample
+
+    # Load the recording using the function we share with plot_recording
+    if max_points is not None:
+        result = _get_recording_downsampled(data, max_points, method, keys)
+    else:
+        result = _get_recording(data, tag_sources=True, keys=keys, raw=True)
+    if type(result) is bytes:
+        return Response(result, serialize=False)
+    elif type(result) is not list:
+        return result
+    else:
+        return Response(result, serialize=True)
+
+def _recorder_stats():
+    '''
+    Returns the stats of each of the active recordings, name -> stats. How
+    far behind its streams each recording is comes from the newest entry of
+    each stream, all read in one round trip
+    '''
+    recordings = {name: recording for (name, recording) in list(active_recordings.items())
+        if isinstance(recording, Recording) and (recording.stream_ids is not None)}
+
+    heads = None
+    stream_ids = list(set(sum((recording.stream_ids for recording in recordings.values()), [])))
+    if (recorder_engine is not None) and (len(stream_ids) > 0):
+        try:
+            last_ids = recorder_engine.readers[0].streams.last_ids(stream_ids)
+            heads = {stream_id: _split_id(last_id) for (stream_id, last_id) in last_ids.items()}
+        except Exception:
+            pass
+
+    return {name: recording.stats(heads) for (name, recording) in recordings.items()}
+
+class StatsPublisher(Thread):
+    '''
+    Publishes the stats of each active recording every interval seconds on
+    a stream of the stats element named after the recording s.t. the health
+    of the recorder can be graphed, or even recorded. The interval can be
+    changed while it runs
+    '''
+    def __init__(self, interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.elem = Element(STATS_ELEMENT, host=ATOM_HOST)
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                for name, stats in _recorder_stats().items():
+                    self.elem.entry_write(name, stats, maxlen=STATS_MAXLEN, serialize=True)
+            except Exception as e:
+                self.elem.log(LogLevel.ERR, "Failed to publish stats: {}".format(e))
+
+def _publish_stats(interval):
+    '''
+    Starts publishing stats every interval seconds, or stops if it's 0
+    '''
+    global stats_publisher
+    if interval == 0:
+        if stats_publisher is not None:
+            stats_publisher.stopped.set()
+            stats_publisher = None
+    elif stats_publisher is None:
+        stats_publisher = StatsPublisher(interval)
+        stats_publisher.start()
+    else:
+        stats_publisher.interval = interval
+
+def recorder_stats(data):
+    '''
+    Returns the stats of the active recordings, to see how the recorder is
+    keeping up. Data is optional and if given should be a msgpack'd object
+    with the following fields:
+
+    name: Optional. Only return the stats of this recording
+    publish: Optional. Publish the stats of all active recordings every
+        this many seconds on streams of the STATS_ELEMENT element, one per
+        recording. 0 stops publishing them
+    '''
+    request = {}
+    if (data is not None) and (len(data) > 0):
+        try:
+            request = msgpack.unpackb(data, raw=False)
+        except:
+            return Response(err_code=1, err_str="Failed to deserialize request", serialize=True)
+        if type(request) is not dict:
+            return Response(err_code=1, err_str="Request must be a map", serialize=True)
+
+    if "publish" in request:
+        if (type(request["publish"]) not in (int, float)) or (request["publish"] < 0):
+            return Response(err_code=3, err_str="publish must be a number of seconds >= 0", serialize=True)
+        _publish_stats(request["publish"])
+
+    stats = _recorder_stats()
+    if "name" in request:
+        if request["name"] not in stats:
+            return Response(err_code=2, err_str="{} is not an active recording".format(request["name"]), serialize=True)
+        stats = {request["name"]: stats[request["name"]]}
+
+    return Response(stats, serialize=True)
+
+def cache_stats(data):
+    '''
+    Returns the hit/miss counts and size of the caches of decoded
+    recordings, added up over the element and its plot and export
+    processes, along with those of each cache under caches
+    '''
+    caches = {"element": recording_cache.stats()}
+    for name, pool in (("plot", plot_pool), ("export", export_pool)):
+        if pool is not None:
+            for k, stats in enumerate(pool.cache_stats()):
+                caches["{}_{}".format(name, k)] = stats
+
+    stats = {counter: sum(cache[counter] for cache in caches.values()) for counter in CACHE_COUNTERS}
+    stats["caches"] = caches
+    return Response(stats, serialize=True)
+
+def _make_lambda(arg, expr):
+    '''
+    Compiles "lambda arg: expr" the first time it's seen and returns the
+    cached lambda after that. Raises if the expression isn't valid
+    '''
+    if (arg, expr) not in lambda_cache:
+        lambda_cache[(arg, expr)] = eval("lambda " + arg + ": " + expr)
+    return lambda_cache[(arg, expr)]
+
+class _Column(np.ndarray):
+    '''
+    The values of a key across entries with one row per entry. Indexing it
+    indexes into the value of each entry s.t. lambdas written for a single
+    value, i.e. x[0] or x[1:3] * 2, run on the whole column at once.
+    Iterating it or taking its length would mean something different for
+    the column than for a value so they raise, which sends the lambda down
+    the per-entry path.
+    '''
+    def __getitem__(self, idx):
+        if type(idx) is not tuple:
+            idx = (idx,)
+        return np.ndarray.__getitem__(self.view(np.ndarray), (slice(None),) + idx).view(_Column)
+
+    def __iter__(self):
+        raise TypeError("Can't iterate over a column")
+
+    def __len__(self):
+        raise TypeError("Column has no length")
+
+class _ColumnValues:
+    '''
+    The values of a typed column one by one, for lambdas that can't run on
+    the whole column. Each row is only turned into a value when it's used
+    '''
+    def __init__(self, column):
+        self.array = column.view(np.ndarray)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i):
+        return self.array[i].tolist()
+
+    def __iter__(self):
+        return iter(self.array.tolist())
+
+def _make_column(values):
+    '''
+    Makes a _Column out of a list of values, or returns None if they aren't
+    all numbers or lists of numbers of the same length. The numbers all
+    have to be of the same type since numpy would make ints in a column of
+    floats into floats, which changes how they're written out
+    '''
+    try:
+        column = np.array(values)
+    except Exception:
+        return None
+    if (column.ndim == 0) or (column.ndim > 2) or (column.dtype.kind not in "biuf"):
+        return None
+
+    items = values if column.ndim == 1 else itertools.chain.from_iterable(values)
+    if len(set(map(type, items))) > 1:
+        return None
+    return column.view(_Column)
+
+class _TypedEntries:
+    '''
+    The entries of a read with the values of its typed columns put back in,
+    each entry only as it's used. Stands in for the list of entries when
+    checking a vectorized x lambda against running it on single entries
+    '''
+    def __init__(self, result, typed):
+        self.result = result
+        self.typed = typed
+
+    def __len__(self):
+        return len(self.result)
+
+    def __getitem__(self, i):
+        entry = dict(self.result[i][1])
+        for key, column in self.typed.items():
+            entry[key] = column.view(np.ndarray)[i].tolist()
+        return entry
+
+class _EntryColumns(dict):
+    '''
+    Stands in for an entry when vectorizing an x lambda, making the column
+    of each key as it's used. Typed columns are used as they are
+    '''
+    def __init__(self, result, typed=None):
+        super().__init__(typed or {})
+        self.result = result
+
+    def __missing__(self, key):
+        column = _make_column([entry[1][key] for entry in self.result])
+        if column is None:
+            raise TypeError("Key {} can't be vectorized".format(key))
+        self[key] = column
+        return column
+
+def _vectorize(fn, arg, values, same):
+    '''
+    Runs a lambda written for a single value on a whole column (or
+    _EntryColumns) at once. The result has to have one row per value and
+    match what the lambda gives on a sample of the values one at a time, as
+    compared by same(). Returns the result as an array, or None if the
+    lambda can't be vectorized s.t. the caller goes value by value.
+    '''
+    if arg is None:
+        return None
+
+    try:
+        with np.errstate(all="ignore"):
+            out = np.asarray(fn(arg))
+    except Exception:
+        return None
+
+    if (out.ndim == 0) or (out.shape[0] != len(values)) or (out.dtype.kind not in "biuf"):
+        return None
+
+    for i in np.unique(np.linspace(0, len(values) - 1, VECTOR_CHECK_LEN).astype(int)):
+        try:
+            if not same(out[i], fn(values[i])):
+                return None
+        except Exception:
+            return None
+
+    return out
+
+def _same_number(a, b):
+    '''
+    Whether the result of a vectorized plot lambda matches the per-entry one
+    '''
+    return bool(np.isclose(float(a), float(b), rtol=1e-9, atol=0, equal_nan=True))
+
+def _csv_line(x_val, val):
+    '''
+    Makes a line of a CSV, the x value followed by each item of the value
+    with a trailing comma, or the value itself if it isn't iterable
+    '''
+    try:
+        return "{},".format(x_val) + "".join(["{},".format(v) for v in val]) + "\n"
+    except:
+        return "{},{}\n".format(x_val, val)
+
+def _same_csv(a, b):
+    '''
+    Whether the result of a vectorized csv lambda makes the same CSV line as
+    the per-entry one
+    '''
+    return _csv_line("", a.tolist()) == _csv_line("", b)
+
+class ProcessPool:
+    '''
+    Fixed set of processes, each with a queue of its own s.t. work can be
+    sent to the process that has what it needs cached. Work submitted with
+    a key always goes to the same process, with int keys going to process
+    key % n s.t. consecutive keys are spread over the processes. Other work
+    goes to each process in turn. The processes are spawned rather than
+    forked since we have reader and writer threads running. Each process
+    keeps a cache of decoded recordings of the given budget, which notes
+    its counters in a slot of an array shared with us s.t. cache_stats can
+    add them up
+    '''
+    def __init__(self, n, budget, initializer=None):
+        context = multiprocessing.get_context("spawn")
+        self.counters = context.Array("q", n * len(CACHE_COUNTERS), lock=False)
+        self.executors = [ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=context,
+            initializer=_init_pool_process,
+            initargs=(self.counters, k, budget, initializer)) for k in range(n)]
+        self.turns = itertools.count()
+
+    def submit(self, fn, *args, key=None):
+        if key is None:
+            key = next(self.turns)
+        elif type(key) is not int:
+            key = zlib.crc32(repr(key).encode())
+        k = key % len(self.executors)
+        return self.executors[k].submit(fn, *args)
+
+    def cache_stats(self):
+        '''
+        Returns the stats of the cache of each process, same as
+        RecordingCache.stats
+        '''
+        n = len(CACHE_COUNTERS)
+        return [dict(zip(CACHE_COUNTERS, self.counters[k * n:(k + 1) * n])) for k in range(len(self.executors))]
+
+    def shutdown(self, wait=True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+def _init_pool_process(counters, slot, budget, initializer):
+    '''
+    Sets up a process of a ProcessPool with its cache, and then runs the
+    initializer of the pool if it has one
+    '''
+    global recording_cache
+    recording_cache = RecordingCache(budget, counters, slot)
+    recording_cache._note()
+    if initializer is not None:
+        initializer()
+
+def _plot_pool():
+    '''
+    Returns the pool of processes rendering plots, starting it on the first
+    plot. Each process caches its share of the budget of decoded recordings
+    '''
+    global plot_pool
+    if plot_pool is None:
+        plot_pool = ProcessPool(PLOT_POOL_SIZE, CACHE_BUDGET // PLOT_POOL_SIZE, _init_plot_worker)
+    return plot_pool
+
+def _init_plot_worker():
+    '''
+    Sets up a plot process. Plots are always rendered headless with Agg,
+    and plot processes never write to recording indexes since they don't
+    know which recordings are active. Each plot process gets its share of
+    the export processes for long plots s.t. together they don't start more
+    than the element would, and decodes inline if its share is less than
+    two
+    '''
+    global plot_worker, EXPORT_POOL_SIZE
+    plot_worker = True
+    EXPORT_POOL_SIZE = max(EXPORT_POOL_SIZE // PLOT_POOL_SIZE, 1)
+    plt.switch_backend("Agg")
+
+def _show_plots(data):
+    '''
+    Shows the plots of a plot request in interactive windows. Runs in a
+    process of its own, started for each plot request with show, s.t. the
+    windows staying open until they're closed doesn't hold up the plot
+    processes. Reads inline rather than starting export processes, and
+    doesn't cache what it reads since it only reads it once
+    '''
+    global plot_worker, EXPORT_POOL_SIZE, recording_cache
+    plot_worker = True
+    EXPORT_POOL_SIZE = 1
+    recording_cache = RecordingCache(0)
+    _render_plots(dict(data, save=False), show=True)
+
+def _render_plots(data, show=False):
+    '''
+    Loads the recording and renders the plots of a plot request. Runs in
+    one of the plot processes. Returns (err_code, err_str, plots) where
+    plots is a list with the title of each plot and either the path it was
+    saved at or the rendered image. If show is true the plots are shown
+    once they're rendered, see _show_plots.
+    '''
+    # Load the recording, only reading the keys we plot unless the x lambda
+    #   could be using any of them. If we failed to load it just return
+    #   that error
+    keys = None
+    if ("x" not in data) or ("keys" in data):
+        keys = frozenset(data.get("keys", [])).union(*(val[1] for plot in data["plots"] for val in plot["data"]))
+    pieces = []
+    result = _get_recording(data, keys=keys, columns=pieces)
+    if type(result) is not list:
+        return result.err_code, result.err_str, None
+    result, typed = _typed_columns(result, pieces)
+
+    # Get the number of results
+    n_results = len(result)
+    if (n_results == 0):
+        return 4, "0 results for recording", None
+
+    plots = data["plots"]
+    max_points, method = _check_downsample(data)
+    image_format = data.get("format", PLOT_FORMATS[0])
+
+    if ("x" in data):
+        try:
+            x_lambda = _make_lambda("entry", data["x"])
+            x_data = _vectorize(x_lambda, _EntryColumns(result, typed), _TypedEntries(result, typed), _same_number)
+            if x_data is None:
+                x_data = [x_lambda(entry[1]) for entry in _fill_typed(result, typed)]
+            x_label = str(data["x"])
+        except:
+            return 6, "Unable to convert {} to x data lambda".format(data["x"]), None
+    else:
+        x_data = [int(entry[0].split('-')[0]) for entry in result]
+        x_label = "Redis Timestamp (ms)"
+
+    # Turn the x data into a numpy array and subtract off the first item
+    #   so that the scale is reasonable
+    x_data = np.array(x_data)
+    x_data -= x_data[0]
+
+    # Columns of the values of each key, made as they're used. Typed keys
+    #   come as columns already
+    columns = dict(typed)
+
+    rendered = []
+    for plot_n, plot in enumerate(plots):
+
+        # Make sure each key exists in the first data item. The lambdas
+        #   were checked when the job was submitted
+        lambdas = []
+        for val in plot["data"]:
+            for key in val[1]:
+                if (key not in result[0][1]) and (key not in typed):
+                    plt.close("all")
+                    return 10, "Key {} not in data".format(key), None
+
+            label = str(val[2]) if len(val) == 3 else str(val[0])
+            lambdas.append((_make_lambda("x", val[0]), val[1], label))
+
+        # Now we want to preallocate the data for the plot. It should be a
+        #   matrix that's n-dimensional by lambda-key pair and entry
+        to_plot = np.zeros((sum(len(keys) for (l, keys, label) in lambdas), n_results))
+
+        # And finally we want to run each lambda over each of its keys. Run
+        #   it on the whole column of the key at once if we can, else go
+        #   entry by entry
+        idx = 0
+        for (l, keys, label) in lambdas:
+            for key in keys:
+                if key in typed:
+                    values = _ColumnValues(typed[key])
+                else:
+                    values = [entry[1][key] for entry in result]
+                if key not in columns:
+                    columns[key] = _make_column(values)
+
+                line = _vectorize(l, columns[key], values, _same_number)
+                if (line is not None) and (line.ndim == 1):
+                    to_plot[idx] = line
+                else:
+                    for i, value in enumerate(values):
+                        to_plot[idx][i] = l(value)
+                idx += 1
 
         # Now, we can go ahead and make the figure
         fig = plt.figure()
-        figures.append(fig)
 
-        # Plot all of the lines
-        idx = 0
-        for (l, keys, label) in lambdas:
-            for key in keys:
-                plt.plot(x_data, to_plot[idx,:], label=label + "-" + key)
-                idx += 1
+        # Plot all of the lines, downsampling each one if asked to s.t. we
+        #   don't hand matplotlib millions of points
+        idx = 0
+        for (l, keys, label) in lambdas:
+            for key in keys:
+                if max_points is not None:
+                    keep = _downsample(x_data, to_plot[idx], max_points, method)
+                    plt.plot(x_data[keep], to_plot[idx][keep], label=label + "-" + key)
+                else:
+                    plt.plot(x_data, to_plot[idx,:], label=label + "-" + key)
+                idx += 1
+
+        # Make the title, x label, y label and legend
+        title = "Recording-{}-{}".format(data["name"], plot.get("title", "Plot {}".format(plot_n)))
+        plt.title(title)
+
+        # Make the x label
+        plt.xlabel(plot.get("x_label", x_label))
+
+        # Make the y label
+        plt.ylabel(plot.get("y_label", "Value"))
+
+        # Make the legend
+        if plot.get("legend", True):
+            plt.legend()
+
+        # Either save the figure or hand back the rendered image
+        if data.get("save", False):
+            path = os.path.join(
+                PERM_RECORDING_LOC if data.get("perm", False) else TEMP_RECORDING_LOC,
+                "{}.{}".format(title, image_format))
+            fig.savefig(path, format=image_format)
+            rendered.append({"title": title, "path": path, "image": None})
+        else:
+            image = io.BytesIO()
+            fig.savefig(image, format=image_format)
+            rendered.append({"title": title, "path": None, "image": image.getvalue()})
+
+    # Draw the new plot
+    if show:
+        plt.show()
+    plt.close("all")
+
+    return 0, "", rendered
+
+def plot_recording(data):
+    '''
+    Makes a plot of the recording. Takes a msgpack-serialized JSON
+    object with the following fields
+    name : required recording name
+    plots: list of plots to make, where each item in the list is a list as well.
+        Each item in the plots list is a tuple, with values:
+            - 0 : lambda function to perform on the data. The data will be
+                    passed to the lambda as a dictionary named `x`
+            - 1 : list of keys on which to perform the lambda function
+            - 2 : optional label
+
+        An example plots field would look like:
+            "plots": [
+                {
+                    "data": [
+                        ["x[0]", ["joint_0", "joint_1"], "label0"],
+                    ],
+                    "title": "Some Title",
+                    "y_label": "Some Y Label",
+                    "x_label": "Some X Label",
+                    "legend": true/false,
+                },
+                {
+                    "data": [
+                        ["x[1]", ["joint_0", "joint_1"], "label1"],
+                        ["x[2]", ["joint_0", "joint_1"], "label2"],
+                    ],
+                    ...
+                }
+            ]
+    start: Entry index to start the plot at
+    stop: Entry index to stop the plot at
+    t_start: Redis timestamp (ms) to start the plot at
+    t_stop: Redis timestamp (ms) to stop the plot at
+    e, s: Element and stream of the source to plot, required for
+        recordings of more than one source
+    msgpack: Whether or not to use msgpack to deserialize each key on
+        readback from the recording. Default false
+    save: Optional, if true will save an image of each plot, default false
+    show: Optional, default false. If true the plots are also shown in an
+        interactive fashion, from a process of their own
+    perm: Optional, default false. If true will save in the permanent
+        file location, else temporary
+    x: Optional lambda for converting an entry into a timestamp. If not
+        passed, will use the redis timestamp. If passed, will be a
+        lambda for an entry lambda entry: ... where the user supplies ...
+        to convert the entry into an x-label
+    max_points: Optional. If given, each line is downsampled to at most
+        this many points before it's drawn
+    downsample: Optional, how to downsample, one of DOWNSAMPLE_METHODS.
+        Default minmax
+    format: Optional, one of PLOT_FORMATS. Default png
+    keys: Optional list of keys to read on top of the ones plotted, for
+        the x lambda. Only the keys plotted are read unless x is given
+        without keys
+
+    The request is checked and then the plots are rendered in the
+    background by one of the plot processes s.t. we don't hold up any other
+    commands. Plots of a recording are always rendered by the same process
+    s.t. plotting it again hits that process's cache. Returns the ID of the
+    plot job to pass to plot_result. Plots that are shown don't hold up the
+    job, it finishes once they're rendered.
+    '''
+    global plot_job_count
+
+    if (("name" not in data) or (type(data["name"]) is not str)):
+        return Response(err_code=1, err_str="Name is required", serialize=True)
+    if _find_recording(data["name"]) is None:
+        return Response(err_code=3, err_str="No recording {}".format(data["name"]), serialize=True)
+
+    # We should have a list of all of the entries that we care about seeing
+    #   and now for each entry need to go ahead and run all of the lambdas
+    if ("plots" not in data) or (type(data["plots"]) is not list):
+        return Response(err_code=5, err_str="Plots must be specified", serialize=True)
+
+    downsample = _check_downsample(data)
+    if type(downsample) is str:
+        return Response(err_code=12, err_str=downsample, serialize=True)
+
+    if data.get("format", PLOT_FORMATS[0]) not in PLOT_FORMATS:
+        return Response(err_code=13, err_str="format must be one of {}".format(", ".join(PLOT_FORMATS)), serialize=True)
+
+    keys = _check_keys(data)
+    if type(keys) is str:
+        return Response(err_code=15, err_str=keys, serialize=True)
+
+    if ("x" in data):
+        try:
+            _make_lambda("entry", data["x"])
+        except:
+            return Response(err_code=6, err_str="Unable to convert {} to x data lambda".format(data["x"]), serialize=True)
+
+    # Check the lambdas of each plot
+    for plot in data["plots"]:
+
+        # Get the plot data
+        if (type(plot) is not dict) or ("data" not in plot) or (type(plot["data"]) is not list):
+            return Response(err_code=7, err_str="Each plot must have a data list", serialize=True)
+
+        for val in plot["data"]:
+
+            # Make sure the length of the array is proper
+            if (type(val) is not list) or (len(val) < 2) or (len(val) > 3) or \
+                    (type(val[1]) is not list) or any(type(key) is not str for key in val[1]):
+                return Response(err_code=8, err_str="plot value {} does not have 2 or 3 items with a list of keys second".format(val), serialize=True)
+
+            # Try to make the lambda from the first one
+            try:
+                _make_lambda("x", val[0])
+            except:
+                return Response(err_code=9, err_str="Unable to make lambda from {}".format(val[0]), serialize=True)
+
+    # Hand the plot off to the plot processes
+    _expire_jobs(plot_jobs, plot_jobs_finished, PLOT_RESULT_TTL)
+    plot_job_count += 1
+    job = plot_job_count
+    plot_jobs[job] = _plot_pool().submit(_render_plots, data, key=data["name"])
+    plot_jobs[job].add_done_callback(lambda future: plot_jobs_finished.__setitem__(job, time.monotonic()))
 
-        # Make the title, x label, y label and legend
-        title = "Recording-{}-{}".format(data["name"], plot.get("title", "Plot {}".format(plot_n)))
-        plt.title(title)
+    # Showing the plots waits on someone to close them, so it gets a
+    #   process of its own rather than one from the pool. Reap any that
+    #   have been closed while we're at it
+    multiprocessing.active_children()
+    if data.get("show", False) is True:
+        multiprocessing.get_context("spawn").Process(target=_show_plots, args=(data,), daemon=True).start()
 
-        # Make the x label
-        plt.xlabel(plot.get("x_label", x_label))
+    return Response({"job": job}, serialize=True)
 
-        # Make the y label
-        plt.ylabel(plot.get("y_label", "Value"))
+def _expire_jobs(jobs, finished, ttl):
+    '''
+    Drops the jobs that finished more than ttl seconds ago without their
+    results being picked up. Takes the job ID -> future and job ID -> when
+    it finished maps of the jobs
+    '''
+    now = time.monotonic()
+    for job, when in list(finished.items()):
+        if now - when >= ttl:
+            jobs.pop(job, None)
+            finished.pop(job, None)
 
-        # Make the legend
-        if plot.get("legend", True):
-            plt.legend()
+def _wait_job(future, wait):
+    '''
+    Waits for a job to finish if wait is true, or at most wait seconds if
+    it's a number. Whether it timed out or failed is up to the caller to
+    sort out from the future
+    '''
+    try:
+        if (wait is True) or ((type(wait) in (int, float)) and (wait > 0)):
+            future.result(timeout=None if wait is True else wait)
+    except Exception:
+        pass
 
-        # If we are supposed to save the figures, do so
-        if data.get("save", False):
-            fig.savefig(os.path.join(
-                PERM_RECORDING_LOC if data.get("perm", False) else TEMP_RECORDING_LOC,
-                title))
+def plot_result(data):
+    '''
+    Returns the result of a plot job. Takes a msgpack'd object with the
+    following fields:
 
-    # Draw the new plot
-    if data.get("show", True):
-        plt.show()
+    job: required ID of the plot job from plot
+    wait: Optional, default false. If true waits for the job to finish, or
+        if a number waits at most that many seconds
 
-    return Response("Success", serialize=True)
+    Returns a map noting if the job is done and if so the plots it made,
+    each with its title and either the path it was saved at or the
+    rendered image. Results are handed back once, after which the job is
+    forgotten. Results not picked up within PLOT_RESULT_TTL seconds of the
+    job finishing are dropped.
+    '''
+    _expire_jobs(plot_jobs, plot_jobs_finished, PLOT_RESULT_TTL)
+    future = plot_jobs.get(data.get("job")) if type(data) is dict else None
+    if future is None:
+        return Response(err_code=1, err_str="No plot job {}".format(
+            data.get("job") if type(data) is dict else None), serialize=True)
+
+    job = data["job"]
+    _wait_job(future, data.get("wait", False))
+    if not future.done():
+        return Response({"job": job, "done": False}, serialize=True)
+
+    plot_jobs.pop(job, None)
+    plot_jobs_finished.pop(job, None)
+    try:
+        err_code, err_str, plots = future.result()
+    except Exception as e:
+        return Response(err_code=14, err_str="Plot job failed: {}".format(e), serialize=True)
+
+    if err_code != 0:
+        return Response(err_code=err_code, err_str=err_str, serialize=True)
+    return Response({"job": job, "done": True, "plots": plots}, serialize=True)
+
+def _export_pool():
+    '''
+    Returns the pool of processes running export, slice and merge jobs,
+    converting recordings for csv and decoding long reads, starting it on
+    the first one that needs it. Each
+    process caches its share of the budget of decoded recordings for the
+    csv chunks it converts. Plot processes start their own, smaller ones
+    (see _init_plot_worker), which only decode
+    '''
+    global export_pool
+    with export_pool_lock:
+        if export_pool is None:
+            export_pool = ProcessPool(EXPORT_POOL_SIZE, 0 if plot_worker else CACHE_BUDGET // EXPORT_POOL_SIZE)
+    return export_pool
+
+def _csv_chunk(filename, index, use_msgpack, keys, lambdas, x, read_keys=None):
+    '''
+    Converts a chunk of a recording to CSV. Takes the rows of the index
+    for the entries in the chunk, the keys to convert and the lambda
+    strings from the request. Only read_keys are read if it's given. Runs
+    in one of the export processes for long recordings, the same one for
+    the same chunk each time. The entries decoded go through the cache of
+    the process it runs in s.t. converting the chunk again only converts
+    it. Returns the CSV text for each key.
+    '''
+    with _open_file(filename) as file:
+        stat = os.fstat(file.fileno())
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = (filename, "csv", len(index), zlib.crc32(index.tobytes()), use_msgpack, read_keys)
+        cached = recording_cache.get(key, stamp)
+        if cached is None:
+            pieces = []
+            cached = (list(_iter_entries(file, index, np.arange(len(index)), use_msgpack, keys=read_keys, columns=pieces)),
+                pieces)
+            recording_cache.put(key, stamp, cached)
+    result, typed = _typed_columns(*cached)
+
+    # Get the x value for each entry, running the x lambda on whole columns
+    #   at once if we can
+    if x is not None:
+        x_lambda = _make_lambda("entry", x)
+        x_vals = _vectorize(x_lambda, _EntryColumns(result, typed), _TypedEntries(result, typed), _same_csv)
+        if x_vals is not None:
+            x_vals = x_vals.tolist()
+        else:
+            x_vals = [x_lambda(entry) for (redis_id, entry) in _fill_typed(result, typed)]
+    else:
+        x_vals = [redis_id.split('-')[0] for (redis_id, entry) in result]
+
+    # Then convert each key. Lambdas are run on the whole column of the key
+    #   at once if we can, else entry by entry. Typed keys come as columns
+    #   already
+    text = {}
+    for key in keys:
+        fn = _make_lambda("x", lambdas[key]) if key in lambdas else (lambda x: x)
+        if key in typed:
+            values = _ColumnValues(typed[key])
+        else:
+            try:
+                values = [entry[key] for (redis_id, entry) in result]
+            except KeyError:
+                values = None
+
+        lines = None
+        if values is not None:
+            out = _vectorize(fn, typed[key] if key in typed else _make_column(values), values, _same_csv)
+            if (out is not None) and (out.ndim == 1):
+                lines = ["{},{}\n".format(x_val, v) for x_val, v in zip(x_vals, out.tolist())]
+            elif (out is not None) and (out.ndim == 2):
+                end = ",\n" if out.shape[1] > 0 else "\n"
+                lines = ["{},{}{}".format(x_val, ",".join(map(str, row)), end) for x_val, row in zip(x_vals, out.tolist())]
+
+        if (lines is None) and (key in typed):
+            lines = [_csv_line(x_val, fn(value)) for x_val, value in zip(x_vals, values)]
+        elif lines is None:
+            lines = [_csv_line(x_val, fn(entry[key])) for x_val, (redis_id, entry) in zip(x_vals, result) if key in entry]
+
+        text[key] = "".join(lines)
+
+    return text
+
+def _write_csv_chunk(files, text):
+    '''
+    Writes the CSV text for each key of a chunk to the file of the key
+    '''
+    for key in files:
+        files[key].write(text[key])
 
 def csv_recording(data):
     '''
@@ -528,101 +4032,989 @@ def csv_recording(data):
         to generate the "x" column (column 0) of the CSV file
     desc: Optional. Description to add to filename s.t. it doesn't overwrite
         pre-existing data
+    start/stop: Optional. Entry indices to convert, inclusive
+    t_start/t_stop: Optional. Redis timestamps (ms) to convert, inclusive
+    e, s: Element and stream of the source to convert, required for
+        recordings of more than one source
+    keys: Optional list of keys to convert. Only these keys are read, the
+        values of the others are skipped over, so x can only use these keys
+
+    The recording is streamed through in chunks of CSV_CHUNK_LEN entries s.t.
+    memory is bounded no matter how long it is. Recordings longer than one
+    chunk have their chunks converted in parallel by the export processes
+    and written out in order. Returns the number of rows written, how long
+    it took and the files written.
     '''
-    result = _get_recording(data)
-    if type(result) is not list:
-        return result
+    opened = _open_recording(data)
+    if type(opened) is not tuple:
+        return opened
+    file, filename, index, header, n_before = opened
+
+    use_msgpack = False
+    if ("msgpack" in data) and (type(data["msgpack"]) is bool):
+        use_msgpack = data["msgpack"]
+
+    with file:
+        read_keys = _check_keys(data)
+        if type(read_keys) is str:
+            return Response(err_code=10, err_str=read_keys, serialize=True)
+
+        src = _resolve_source(data, header)
+        if (src is None) and (_session_sources(header) is not None):
+            return Response(err_code=11, err_str="Recording has multiple sources, e and s are required", serialize=True)
+
+        start_idx, stop_idx = _resolve_range(data, index, n_before)
+        rows = _select_rows(index, start_idx, stop_idx, src)
+
+        # A time window can easily select nothing, so make sure we have data
+        if len(rows) == 0:
+            return Response(err_code=8, err_str="0 results for recording", serialize=True)
+
+        # The keys of the first entry decide the files we write
+        first = next(_iter_entries(file, index, rows[:1], use_msgpack, keys=read_keys))
+        for key in (read_keys or []):
+            if key not in first[1]:
+                return Response(err_code=10, err_str="Key {} not in recording".format(key), serialize=True)
+
+    # Check the x lambda
+    x_lambda = data.get("x", None)
+    if x_lambda is not None:
+        try:
+            _make_lambda("entry", x_lambda)
+        except:
+            return Response(err_code=5, err_str="Failed to convert {} to lambda".format(x_lambda), serialize=True)
+
+    # Get the general list of lambdas, as strings s.t. they can be handed
+    #   to the export processes
+    lambdas = data.get("lambdas", None)
+    if lambdas is None:
+        lambdas = {}
+    elif type(lambdas) is str:
+
+        # Make a dictionary with the same lambda for each key
+        lambdas = {key: lambdas for key in first[1]}
+    elif type(lambdas) is not dict:
+        return Response(err_code=7, err_str="Lambdas argument must be dict or string", serialize=True)
+
+    for key in lambdas:
+        try:
+            _make_lambda("x", lambdas[key])
+        except:
+            return Response(err_code=6, err_str="Failed to convert {} to lambda".format(lambdas[key]), serialize=True)
 
     # If we got a result then we want to go ahead and make a CSV file for
     #   each key
     files = {}
     desc = data.get("desc", "")
-    for key in result[0][1]:
-        filename = os.path.join(
+    try:
+        for key in first[1]:
+            filename_csv = os.path.join(
+                PERM_RECORDING_LOC if data.get("perm", False) else TEMP_RECORDING_LOC,
+                "{}-{}-{}.csv".format(data["name"], desc, key))
+            try:
+                files[key] = open(filename_csv, "w", buffering=CSV_WRITE_BUFFER)
+            except:
+                return Response(err_code=4, err_str="Failed to open file {}".format(filename_csv), serialize=True)
+
+        # Convert the chunks, in the export processes if there's more than
+        #   one, keeping a bounded number in flight and writing them out in
+        #   order as they finish. Each chunk goes to the same process every
+        #   time s.t. converting the recording again hits its cache
+        start_time = time.monotonic()
+        chunks = [index[rows[i:i + CSV_CHUNK_LEN]] for i in range(0, len(rows), CSV_CHUNK_LEN)]
+        pending = []
+        try:
+            if len(chunks) == 1:
+                _write_csv_chunk(files, _csv_chunk(filename, chunks[0], use_msgpack, list(files), lambdas, x_lambda, read_keys))
+            else:
+                pool = _export_pool()
+                first = zlib.crc32(filename.encode())
+                for i, chunk in enumerate(chunks):
+                    pending.append(pool.submit(_csv_chunk, filename, chunk, use_msgpack, list(files), lambdas, x_lambda,
+                        read_keys, key=first + i))
+                    if len(pending) >= 2 * EXPORT_POOL_SIZE:
+                        _write_csv_chunk(files, pending.pop(0).result())
+                for future in pending:
+                    _write_csv_chunk(files, future.result())
+        except Exception as e:
+            for future in pending:
+                future.cancel()
+            return Response(err_code=9, err_str="Failed to convert recording: {}".format(e), serialize=True)
+
+    # Make sure everything we wrote makes it out
+    finally:
+        for f in files.values():
+            f.close()
+
+    elapsed = time.monotonic() - start_time
+    return Response({
+        "rows": len(rows),
+        "seconds": elapsed,
+        "rows_per_sec": len(rows) / elapsed if elapsed > 0 else None,
+        "files": [f.name for f in files.values()],
+    }, serialize=True)
+
+def _npy_header(dtype, shape):
+    '''
+    Makes a .npy header for an array of the given dtype and shape, padded
+    out to NPY_HEADER_LEN s.t. it can be rewritten in place once the final
+    shape is known
+    '''
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": shape})
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", NPY_HEADER_LEN - 10) + \
+        (header.ljust(NPY_HEADER_LEN - 11) + "\n").encode("latin1")
+
+class _NpyWriter:
+    '''
+    Streams an array out to a .npy file a chunk of rows at a time, s.t. we
+    don't need to know how many rows there'll be up front. The header is
+    filled in with the final shape on close.
+    '''
+    def __init__(self, path, dtype, row_shape):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.rows = 0
+        self.file = open(path, "wb", buffering=CSV_WRITE_BUFFER)
+        self.file.write(_npy_header(self.dtype, (0,) + self.row_shape))
+
+    def write(self, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.file.write(array.tobytes())
+        self.rows += len(array)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, (self.rows,) + self.row_shape))
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path)
+
+class _KeyExport:
+    '''
+    Export of one key of a recording. Keys whose values are all numbers or
+    arrays of numbers of the same shape are written as one array with a
+    row per entry. All other keys are written as a blob of the recorded
+    bytes of each value and the offsets of each value into the blob, with
+    one more offset than there are entries s.t. value i is
+    blob[offsets[i]:offsets[i + 1]]. Entries missing the key get an empty
+    value.
+    '''
+    def __init__(self, directory, key, as_array, rows_before):
+        self.path = os.path.join(directory, key.replace(os.sep, "_"))
+        self.as_array = as_array and (rows_before == 0)
+        self.rows_before = rows_before
+        self.array = None
+        self.offsets = None
+        self.blob = None
+        self.size = 0
+        self.failed = False
+
+    def add(self, values):
+        '''
+        Adds the values for a chunk of entries. Values are the recorded
+        bytes of the value of each entry, None if the entry doesn't have
+        the key
+        '''
+        if self.as_array:
+            array = None
+            if None not in values:
+                try:
+                    array = np.array([msgpack.unpackb(v, raw=False) for v in values])
+                except Exception:
+                    pass
+            fits = (array is not None) and (array.ndim > 0) and (array.dtype.kind in "biuf")
+
+            # The first values decide the dtype and shape of the array
+            if fits and (self.array is None):
+                self.array = _NpyWriter(self.path + ".npy", array.dtype, array.shape[1:])
+            fits = fits and (array.shape[1:] == self.array.row_shape) and \
+                np.can_cast(array.dtype, self.array.dtype, casting="safe")
+
+            if fits:
+                self.array.write(array)
+                return
+
+            # If the values don't fit in an array, write out a blob instead.
+            #   If we've already written some of the array the key has to be
+            #   redone from the start
+            self.as_array = False
+            if self.array is not None:
+                self.array.discard()
+                self.array = None
+                self.failed = True
+                return
+
+        if self.failed:
+            return
+
+        if self.offsets is None:
+            self.offsets = _NpyWriter(self.path + ".offsets.npy", np.uint64, ())
+            self.blob = _NpyWriter(self.path + ".blob.npy", np.uint8, ())
+            self.offsets.write(np.zeros(self.rows_before + 1, dtype=np.uint64))
+
+        lengths = np.array([len(v) if v is not None else 0 for v in values], dtype=np.uint64)
+        self.offsets.write(self.size + np.cumsum(lengths))
+        self.size += int(lengths.sum())
+        self.blob.write(np.frombuffer(b"".join(v for v in values if v is not None), dtype=np.uint8))
+
+    def close(self):
+        '''
+        Finishes the export of the key. Returns the layout it was written
+        with, or None if it has to be redone as a blob
+        '''
+        if self.array is not None:
+            self.array.close()
+            return "array"
+        if self.offsets is not None:
+            self.offsets.close()
+            self.blob.close()
+            return "blob"
+        return None
+
+def _export_keys(file, index, rows, directory, as_array, only=None):
+    '''
+    Goes through the entries of a recording a chunk at a time and exports
+    each key, or only the keys given. Returns the layout of each key, None
+    for keys that have to be redone as blobs
+    '''
+    exports = {}
+    for start in range(0, len(rows), EXPORT_CHUNK_LEN):
+        entries = [entry[1] for entry in _iter_entries(file, index, rows[start:start + EXPORT_CHUNK_LEN], False)]
+
+        # Keys can show up part of the way through a recording
+        for entry in entries:
+            for key in entry:
+                if (key not in exports) and ((only is None) or (key in only)):
+                    exports[key] = _KeyExport(directory, key, as_array, start)
+
+        for key in exports:
+            exports[key].add([entry.get(key, None) for entry in entries])
+
+    return {key: exports[key].close() for key in exports}
+
+def _remove_export(path):
+    '''
+    Removes the export folder or file at path, if there is one
+    '''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def export_recording(data):
+    '''
+    Exports a recording to NumPy files for offline analysis. Takes a
+    msgpack'd object with the following fields:
+
+    name: required. Recording name
+    msgpack: Optional, default false. If the values of the recording are
+        msgpack'd. Only msgpack'd numbers and arrays of numbers can be
+        exported as arrays
+    format: Optional, one of EXPORT_FORMATS. Default npy, a .npy file per
+        key in a folder. npz zips them into one .npz file
+    desc: Optional. Description to add to the name of the export
+    perm: Optional, default false. Whether to export to the permanent or
+        temporary location
+    start/stop: Optional. Entry indices to export, inclusive
+    t_start/t_stop: Optional. Redis timestamps (ms) to export, inclusive
+    e, s: Element and stream of the source to export, required for
+        recordings of more than one source
+
+    The redis timestamp and sequence number of each entry are written to
+    _ts and _seq straight from the index. See _KeyExport for how each key is
+    written. All of the .npy files can be opened with np.load(mmap_mode='r').
+    The export is written to a temporary folder next to it and only replaces
+    an earlier export of the same name once it's done, s.t. nothing from the
+    earlier export is left in it. Returns the path of the export, the layout
+    of each key, the number of entries and how long it took.
+    '''
+    opened = _open_recording(data)
+    if type(opened) is not tuple:
+        return opened
+    file, filename, index, header, n_before = opened
+
+    use_msgpack = False
+    if ("msgpack" in data) and (type(data["msgpack"]) is bool):
+        use_msgpack = data["msgpack"]
+
+    export_format = data.get("format", EXPORT_FORMATS[0])
+    if export_format not in EXPORT_FORMATS:
+        file.close()
+        return Response(err_code=5, err_str="format must be one of {}".format(", ".join(EXPORT_FORMATS)), serialize=True)
+
+    with file:
+        src = _resolve_source(data, header)
+        if (src is None) and (_session_sources(header) is not None):
+            return Response(err_code=11, err_str="Recording has multiple sources, e and s are required", serialize=True)
+
+        start_idx, stop_idx = _resolve_range(data, index, n_before)
+        rows = _select_rows(index, start_idx, stop_idx, src)
+        if len(rows) == 0:
+            return Response(err_code=8, err_str="0 results for recording", serialize=True)
+
+        directory = os.path.join(
             PERM_RECORDING_LOC if data.get("perm", False) else TEMP_RECORDING_LOC,
-            "{}-{}-{}.csv".format(data["name"], desc, key))
+            "{}-{}-export".format(data["name"], data.get("desc", "")))
+        path = directory + ".npz" if export_format == "npz" else directory
+        staging = directory + ".tmp"
         try:
-            files[key] = open(filename, "w")
+            _remove_export(staging)
+            os.makedirs(staging)
         except:
-            return Response(err_code=4, err_str="Failed to open file {}".format(filename), serialize=True)
+            return Response(err_code=4, err_str="Failed to make folder {}".format(staging), serialize=True)
 
-    # And then loop over the data and write to the file
-    x_lambda = data.get("x", None)
-    if x_lambda is not None:
+        start_time = time.monotonic()
         try:
-            x_lambda = eval("lambda entry: " + x_lambda)
-        except:
-            return Response(err_code=5, err_str="Failed to convert {} to lambda".format(x_lambda), serialize=True)
+            np.save(os.path.join(staging, "_ts.npy"), index["ts"][rows])
+            np.save(os.path.join(staging, "_seq.npy"), index["seq"][rows])
 
-    # Get the general list of lambdas
-    lambdas = data.get("lambdas", None)
-    if lambdas is not None:
-        if type(lambdas) is dict:
-            for key in lambdas:
-                try:
-                    lambdas[key] = eval("lambda x: " + lambdas[key])
-                except:
-                    return Response(err_code=6, err_str="Failed to convert {} to lambda".format(lambdas[key]), serialize=True)
-        elif type(lambdas) is str:
+            layouts = _export_keys(file, index, rows, staging, use_msgpack)
+            redo = set(key for key in layouts if layouts[key] is None)
+            if len(redo) > 0:
+                layouts.update(_export_keys(file, index, rows, staging, False, redo))
+
+            # Zip up the files into a .npz if asked to. They're stored rather
+            #   than compressed s.t. loading them is just a read
+            if export_format == "npz":
+                with zipfile.ZipFile(staging + ".npz", "w", zipfile.ZIP_STORED, allowZip64=True) as npz:
+                    for name in sorted(os.listdir(staging)):
+                        npz.write(os.path.join(staging, name), name)
+                shutil.rmtree(staging)
+                staging += ".npz"
+
+            _remove_export(path)
+            os.rename(staging, path)
+        except Exception as e:
+            _remove_export(staging)
+            _remove_export(directory + ".tmp.npz")
+            return Response(err_code=9, err_str="Failed to export recording: {}".format(e), serialize=True)
+
+    elapsed = time.monotonic() - start_time
+    return Response({
+        "path": path,
+        "keys": layouts,
+        "rows": len(rows),
+        "seconds": elapsed,
+    }, serialize=True)
+
+class Replay(Thread):
+    '''
+    Publishes the entries of a recording back onto streams, keeping the
+    timing of the original entries scaled by speed, or as fast as possible
+    if speed is 0. Each entry is published at a deadline relative to when
+    the replay started s.t. time spent publishing doesn't add up into drift
+    over the replay. A prefetch thread reads and decodes entries ahead of
+    the publisher into a bounded queue s.t. the publisher only ever waits
+    on the clock.
+    '''
+    def __init__(self, name, filename, index, rows, targets, element, speed, maxlen):
+        super().__init__(daemon=True)
+        self.recording = name
+        self.filename = filename
+        self.index = index
+        self.rows = rows
+        self.targets = targets
+        self.elem = element
+        self.speed = speed
+        self.maxlen = maxlen
+        self.queue = Queue(maxsize=REPLAY_PREFETCH_CHUNKS)
+        self.stopped = Event()
+        self.published = 0
+        self.late = 0.0
+        self.error = None
+
+    def put(self, chunk):
+        '''
+        Puts a chunk on the queue for the publisher, giving up if the replay
+        is stopped while we're waiting for room
+        '''
+        while not self.stopped.is_set():
             try:
-                l_val = eval("lambda x: " + lambdas)
-            except:
-                return Response(err_code=6, err_str="Failed to convert {} to lambda".format(lambdas), serialize=True)
+                self.queue.put(chunk, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
 
-            # Make a dictionary with the same lambda for each key
-            lambdas = {}
-            for key in result[0][1]:
-                lambdas[key] = l_val
-        else:
-            return Response(err_code=7, err_str="Lambdas argument must be dict or string", serialize=True)
+    def prefetch(self):
+        '''
+        Reads and decodes the entries to replay a chunk at a time. Each
+        entry is tagged with the stream it's published on
+        '''
+        try:
+            with _open_file(self.filename) as file:
+                for start in range(0, len(self.rows), REPLAY_PREFETCH_LEN):
+                    chunk = list(_iter_entries(file, self.index,
+                        self.rows[start:start + REPLAY_PREFETCH_LEN], False, self.targets))
+                    if not self.put(chunk):
+                        return
+        except Exception as e:
+            self.error = e
+        self.put(None)
+
+    def run(self):
+        Thread(target=self.prefetch, daemon=True).start()
+
+        start = None
+        chunk = self.queue.get()
+        while (chunk is not None) and (not self.stopped.is_set()):
+            for (redis_id, values, stream) in chunk:
+                ts = int(redis_id.split('-')[0])
+
+                # Wait for the deadline of the entry. Entries we're late on
+                #   go out right away and we note how late
+                if self.speed > 0:
+                    if start is None:
+                        start = time.monotonic()
+                        first_ts = ts
+                    delay = start + (ts - first_ts) / 1000.0 / self.speed - time.monotonic()
+                    if delay > 0:
+                        if self.stopped.wait(delay):
+                            break
+                    else:
+                        self.late = max(self.late, -delay)
+
+                try:
+                    self.elem.entry_write(stream, values, maxlen=self.maxlen)
+                except Exception as e:
+                    self.error = e
+                    self.stopped.set()
+                    break
+                self.published += 1
+
+            chunk = self.queue.get() if not self.stopped.is_set() else None
+
+        self.stopped.set()
+        if active_replays.get(self.recording) is self:
+            active_replays.pop(self.recording)
+
+        if self.error is not None:
+            self.elem.log(LogLevel.ERR, "Replay of {} failed: {}".format(self.recording, self.error))
+        self.elem.log(LogLevel.INFO, "Replayed {}/{} entries of {}, at most {:.1f} ms late".format(
+            self.published, len(self.rows), self.recording, self.late * 1000))
+
+    def stats(self):
+        return {
+            "published": self.published,
+            "entries": len(self.rows),
+            "max_late_ms": self.late * 1000,
+            "error": str(self.error) if self.error is not None else None,
+        }
+
+def replay_recording(data):
+    '''
+    Replays a recording, publishing its entries back onto streams in the
+    background. Takes a msgpack'd object with the following fields:
+
+    name: required. Recording name
+    element: Optional, name of the element to publish as. Default
+        replay_<name>
+    stream: Optional, stream to publish on. Default is the stream each
+        entry was recorded from
+    speed: Optional, default 1. Multiplier on the original rate, i.e. 2 for
+        twice as fast. 0 publishes as fast as possible
+    maxlen: Optional, max length of the streams we publish on
+    start/stop: Optional. Entry indices to replay, inclusive
+    t_start/t_stop: Optional. Redis timestamps (ms) to replay, inclusive
+    e, s: Optional. Element and stream of the source to replay, for
+        recordings of more than one source. Default replays all of them
+    '''
+    opened = _open_recording(data)
+    if type(opened) is not tuple:
+        return opened
+    file, filename, index, header, n_before = opened
+    file.close()
+
+    name = data["name"]
+    if name in active_replays:
+        return Response(err_code=5, err_str="Recording {} already being replayed".format(name), serialize=True)
 
-    # Loop over the data
-    for (redis_id, entry) in result:
+    speed = data.get("speed", 1)
+    if (type(speed) not in (int, float)) or (speed < 0):
+        return Response(err_code=4, err_str="speed must be a number >= 0", serialize=True)
 
-        # Get the x value to write to the file
-        if x_lambda is not None:
-            x_val = x_lambda(entry)
+    maxlen = data.get("maxlen", REPLAY_MAXLEN)
+    if (type(maxlen) is not int) or (maxlen <= 0):
+        return Response(err_code=7, err_str="maxlen must be a positive integer", serialize=True)
+
+    # Work out the stream each source is published on. Recordings made
+    #   with an older version of this element don't note their source so
+    #   need a stream to be given
+    sources = header.get("sources", []) if header is not None else []
+    if "stream" in data:
+        if type(data["stream"]) is not str:
+            return Response(err_code=6, err_str="stream must be a string", serialize=True)
+        targets = [data["stream"]] * max(len(sources), 1)
+    elif len(sources) == 0:
+        return Response(err_code=6, err_str="Recording doesn't note its stream, stream is required", serialize=True)
+    else:
+        targets = [stream for (element, stream) in sources]
+
+    src = _resolve_source(data, header)
+    if (src is None) and ("stream" not in data) and (len(set(targets)) < len(targets)):
+        return Response(err_code=6, err_str="Sources of recording have the same stream name, stream or e and s are required", serialize=True)
+
+    start_idx, stop_idx = _resolve_range(data, index, n_before)
+    rows = _select_rows(index, start_idx, stop_idx, src)
+    if len(rows) == 0:
+        return Response(err_code=8, err_str="0 results for recording", serialize=True)
+
+    element = data.get("element", "replay_" + name)
+    replay = Replay(name, filename, index, rows, targets, Element(element, host=ATOM_HOST), speed, maxlen)
+    active_replays[name] = replay
+    replay.start()
+
+    return Response("Started replay of {} entries of {} as {}".format(len(rows), name, element), serialize=True)
+
+def stop_replay(data):
+    '''
+    Stops a replay. Data should be a msgpack'd string of the name of the
+    recording being replayed. Returns the stats of the replay
+    '''
+    if data not in active_replays:
+        return Response(err_code=1, err_str="Recording {} not being replayed".format(data), serialize=True)
+
+    replay = active_replays.pop(data)
+    replay.stopped.set()
+    replay.join()
+
+    return Response(replay.stats(), serialize=True)
+
+def wait_replay(data):
+    '''
+    Waits for a replay to finish. Data should be a msgpack'd string of the
+    name of the recording being replayed. Returns the stats of the replay
+    '''
+    if data not in active_replays:
+        return Response(err_code=1, err_str="Recording {} not being replayed".format(data), serialize=True)
+
+    replay = active_replays[data]
+    replay.join()
+
+    return Response(replay.stats(), serialize=True)
+
+def _record_end(file, offset):
+    '''
+    Returns the offset just past the record at offset in an open recording
+    '''
+    file.seek(offset)
+    unpacker = msgpack.Unpacker(file, raw=False, max_buffer_size=0)
+    unpacker.skip()
+    return offset + unpacker.tell()
+
+def _unblocked_entries(file, index, rows, blocks):
+    '''
+    Decodes the block holding the entries at rows of the index and packs
+    each of them back up as a record of its own, with typed values packed
+    back into the bytes they were recorded as. Returns them as a batch for
+    RecordingFile.write_batch. blocks holds on to the last block decoded
+    s.t. recordings which interleave within a block only decode it once
+    '''
+    key = (file, int(index["offset"][rows[0]]))
+    if key not in blocks:
+        file.seek(key[1])
+        blocks.clear()
+        blocks[key] = _block_records(msgpack.Unpacker(file, raw=False, max_buffer_size=0).unpack())
+    records, typed = blocks[key]
+    packer = msgpack.Packer(use_bin_type=True)
+
+    batch = []
+    for row in rows:
+        record = records[int(index["pos"][row])]
+        entry = {k: (packer.pack(v) if k in typed else v) for k, v in record.items() if k not in ("id", SOURCE_KEY)}
+        entry["id"] = record["id"]
+        if SOURCE_KEY in record:
+            entry[SOURCE_KEY] = record[SOURCE_KEY]
+        batch.append((packer.pack(entry), int(index["ts"][row]), int(index["seq"][row]), int(index["src"][row])))
+    return batch
+
+def _copy_entries(recording_file, file, index, start, stop, blocks):
+    '''
+    Copies the entries at rows start through stop of the index of an open
+    recording to the end of recording_file. The records they're in are
+    copied byte for byte in the kernel. Only the entries in a block that's
+    cut by the start or stop are decoded (see _unblocked_entries), and
+    they're written out through recording_file, which blocks them back up
+    if it's compressed or typed. Returns the number of bytes copied and the
+    number of entries decoded
+    '''
+    # Rows [first, end) are in records we copy whole. Offsets only go up
+    #   and entries in a block share its offset
+    offsets = index["offset"]
+    first, end = start, stop + 1
+    if (start > 0) and (offsets[start - 1] == offsets[start]):
+        first = min(bisect.bisect_right(offsets, offsets[start]), stop + 1)
+    if (stop + 1 < len(index)) and (offsets[stop + 1] == offsets[stop]):
+        end = max(bisect.bisect_left(offsets, offsets[stop]), first)
+
+    if first > start:
+        recording_file.write_batch(_unblocked_entries(file, index, np.arange(start, first), blocks))
+
+    # Copy the records in between, one segment at a time for segmented
+    #   recordings since each segment has its own header and footer
+    copied = 0
+    n = first
+    while n < end:
+        if isinstance(file, SegmentedFile):
+            k = bisect.bisect_right(file.offsets, int(offsets[n])) - 1
+            base, fd = file.offsets[k], file._file(k).fileno()
+            m = end
+            if k + 1 < len(file.offsets):
+                m = min(end, bisect.bisect_left(offsets, file.offsets[k + 1]))
         else:
-            x_val = redis_id.split('-')[0]
+            base, fd, m = 0, file.fileno(), end
+
+        offset = int(offsets[n])
+        count = _record_end(file, int(offsets[m - 1])) - offset
+        recording_file.copy(fd, offset - base, count, index[n:m])
+        copied += count
+        n = m
+
+    if end <= stop:
+        recording_file.write_batch(_unblocked_entries(file, index, np.arange(end, stop + 1), blocks))
+
+    return copied, (first - start) + (stop + 1 - end)
+
+def _finished_summary(name, filename):
+    '''
+    Returns the summary of a recording if it's finished s.t. the summary
+    comes from its footer, else None rather than scanning the recording
+    '''
+    if name in active_recordings:
+        return None
+    if os.path.isdir(filename):
+        manifest = _read_manifest(filename)
+        if (manifest is None) or (not manifest["complete"]):
+            return None
+    else:
+        with open(filename, 'rb') as file:
+            footer = _read_footer(file)
+        if (footer is None) or ("keys" not in footer):
+            return None
+    return _recording_summary(name, filename)
+
+def _copy_target(data):
+    '''
+    Returns the filename of the new recording of a slice or merge request,
+    or a Response() type on error
+    '''
+    if ("out" not in data) or (type(data["out"]) is not str):
+        return Response(err_code=4, err_str="out must be a string", serialize=True)
+    if (data["out"] in active_recordings) or (_find_recording(data["out"]) is not None):
+        return Response(err_code=4, err_str="Recording {} already exists".format(data["out"]), serialize=True)
+
+    perm = data.get("perm", False) is True
+    if perm and not os.path.exists(PERM_RECORDING_LOC):
+        return Response(err_code=5, err_str="Please mount {} in your docker-compose file".format(PERM_RECORDING_LOC), serialize=True)
 
-        # For each key, write the key and its data to the file
-        for key in entry:
+    return os.path.join(PERM_RECORDING_LOC if perm else TEMP_RECORDING_LOC, data["out"] + RECORDING_EXTENSION)
 
-            # Value by default is just entry[key]
-            val = entry[key]
+def _header_encoding(header):
+    '''
+    Returns the (codec, block_size, typed, delta) a recording was written
+    with, going by its header
+    '''
+    if header is None:
+        return None, BLOCK_SIZE, False, False
+    return header.get("codec"), header.get("block_size", BLOCK_SIZE), \
+        (header.get("encoding") == "typed"), header.get("delta", False)
 
-            # If we have some lambdas then we need to perhaps transform the
-            #   value in that manner
-            if lambdas is not None and key in lambdas:
-                val = lambdas[key](val)
+def _write_copy(data, filename, header, runs, summaries):
+    '''
+    Writes the new recording of a slice or merge request. runs are the
+    (file, index, start, stop) runs of entries to copy into it, in order,
+    and summaries the summaries of the recordings they come from, None for
+    any that aren't finished. The keys of those recordings are noted in the
+    footer as the keys of the new one. If we don't have them all the keys
+    are left out s.t. listing the new recording scans it instead. The new
+    recording is encoded the same as the ones it's copied from s.t. the
+    entries that have to be decoded go back into blocks like the records
+    copied around them. Returns the response
+    '''
+    start_time = time.monotonic()
+    codec, block_size, typed, delta = _header_encoding(header)
+    try:
+        recording_file = RecordingFile(filename, header=header, codec=codec, block_size=block_size,
+            typed=typed, delta=delta)
+    except:
+        return Response(err_code=7, err_str="Unable to open file {}".format(filename), serialize=True)
 
-            # Make the line for the CSV, starting off with the x value
-            buff = "{},".format(x_val)
+    footer = {"sources": header.get("sources", []) if header is not None else [], "gaps": None}
+    if all(summary is not None for summary in summaries):
+        keys = [set() for source_keys in summaries[0]["keys"]]
+        schema = {}
+        for summary in summaries:
+            for source_keys, summary_keys in zip(keys, summary["keys"]):
+                source_keys.update(summary_keys)
+            schema.update(summary.get("schema", {}))
+        footer["keys"] = [sorted(source_keys) for source_keys in keys]
+        if len(schema) > 0:
+            footer["schema"] = schema
 
-            # And add each item from the iterable
+    copied = 0
+    decoded = 0
+    blocks = {}
+    try:
+        for (file, index, start, stop) in runs:
+            run_copied, run_decoded = _copy_entries(recording_file, file, index, start, stop, blocks)
+            copied += run_copied
+            decoded += run_decoded
+        recording_file.footer = footer
+        recording_file.close()
+    except Exception as e:
+        recording_file.file.close()
+        recording_file.index_file.close()
+        for f in (filename, _index_filename(filename)):
             try:
-                for v in val:
-                    buff += "{},".format(v)
-            except:
-                buff += "{}".format(val)
+                os.remove(f)
+            except OSError:
+                pass
+        return Response(err_code=7, err_str="Failed to write recording: {}".format(e), serialize=True)
 
-            # Finish off with a newline and write to file
-            buff += "\n"
-            files[key].write(buff)
+    return Response({
+        "name": data["out"],
+        "path": filename,
+        "entries": recording_file.entries,
+        "bytes": os.path.getsize(filename),
+        "copied": copied,
+        "decoded": decoded,
+        "seconds": time.monotonic() - start_time,
+    }, serialize=True)
 
-    # And note the success
-    return Response("Success", serialize=True)
+def slice_recording(data):
+    '''
+    Cuts a range of entries out of a recording into a new recording without
+    decoding them. Takes a msgpack'd object with the following fields:
+
+    name: required. Recording name
+    out: required. Name of the new recording
+    start/stop: Optional. Entry indices to keep, inclusive
+    t_start/t_stop: Optional. Redis timestamps (ms) to keep, inclusive
+    perm: Optional, default false. Whether to store the new recording in
+        the permanent or temporary location
+
+    The entries of all sources in the range are kept. Returns the name, path,
+    number of entries and size of the new recording, how many bytes were
+    copied straight across, how many entries had to be decoded and how long
+    it took.
+    '''
+    filename = _copy_target(data)
+    if type(filename) is not str:
+        return filename
+
+    opened = _open_recording(data)
+    if type(opened) is not tuple:
+        return opened
+    file, source_filename, index, header, n_before = opened
+
+    with file:
+        start_idx, stop_idx = _resolve_range(data, index, n_before)
+        if stop_idx < start_idx:
+            return Response(err_code=6, err_str="0 results for recording", serialize=True)
+
+        summary = _finished_summary(data["name"], source_filename)
+        return _write_copy(data, filename, header, [(file, index, start_idx, stop_idx)], [summary])
+
+def merge_recording(data):
+    '''
+    Merges recordings of the same sources into a new recording, with their
+    entries in Redis ID order, without decoding them. Takes a msgpack'd
+    object with the following fields:
+
+    names: required. List of the names of the recordings to merge
+    out: required. Name of the new recording
+    t_start/t_stop: Optional. Redis timestamps (ms) to keep, inclusive
+    perm: Optional, default false. Whether to store the new recording in
+        the permanent or temporary location
+
+    Entries that are in more than one of the recordings, i.e. where they
+    overlap, are only kept once. Runs of entries that come one after the
+    other in one recording are copied straight across and only entries in
+    blocks that are cut where the recordings interleave are decoded.
+    Returns the same as slice.
+    '''
+    names = data.get("names")
+    if (type(names) is not list) or (len(names) < 2) or any(type(name) is not str for name in names) or \
+            (len(set(names)) != len(names)):
+        return Response(err_code=1, err_str="names must be a list of at least two recording names", serialize=True)
+
+    filename = _copy_target(data)
+    if type(filename) is not str:
+        return filename
+
+    request = {k: data[k] for k in ("t_start", "t_stop") if k in data}
+    opened = []
+    try:
+        for name in names:
+            recording = _open_recording(dict(request, name=name))
+            if type(recording) is not tuple:
+                return recording
+            opened.append(recording)
+
+        sources = [header.get("sources") if header is not None else None for (f, n, i, header, b) in opened]
+        if any(s != sources[0] for s in sources):
+            return Response(err_code=8, err_str="Recordings must all be of the same sources", serialize=True)
+
+        # Records are copied across as they are, so they all have to be
+        #   compressed and typed the same way
+        encodings = [_header_encoding(header) for (f, n, i, header, b) in opened]
+        if any((e[0], e[2], e[3]) != (encodings[0][0], encodings[0][2], encodings[0][3]) for e in encodings):
+            return Response(err_code=9, err_str="Recordings must all have the same codec and encoding", serialize=True)
+
+        # Sort the entries of all of the recordings by ID, and then by which
+        #   recording they're from s.t. we keep the first of any duplicates
+        which = []
+        rows = []
+        ids = []
+        for k, (file, source_filename, index, header, n_before) in enumerate(opened):
+            start_idx, stop_idx = _resolve_range(request, index, n_before)
+            rows.append(np.arange(start_idx, max(stop_idx + 1, start_idx)))
+            which.append(np.full(len(rows[-1]), k))
+            ids.append(index[["ts", "seq", "src"]][rows[-1]])
+        rows = np.concatenate(rows)
+        which = np.concatenate(which)
+        ids = np.concatenate(ids)
+
+        order = np.lexsort((rows, which, ids["src"], ids["seq"], ids["ts"]))
+        rows, which, ids = rows[order], which[order], ids[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = ids[1:] != ids[:-1]
+        rows, which = rows[keep], which[keep]
+        if len(rows) == 0:
+            return Response(err_code=6, err_str="0 results for recordings", serialize=True)
+
+        # Split them into runs of consecutive entries of one recording
+        breaks = (np.flatnonzero((which[1:] != which[:-1]) | (rows[1:] != rows[:-1] + 1)) + 1).tolist()
+        runs = [(opened[which[a]][0], opened[which[a]][2], int(rows[a]), int(rows[b - 1]))
+            for a, b in zip([0] + breaks, breaks + [len(rows)])]
+
+        summaries = [_finished_summary(name, recording[1]) for name, recording in zip(names, opened)]
+        return _write_copy(data, filename, opened[0][3], runs, summaries)
+    finally:
+        for recording in opened:
+            recording[0].close()
+
+def _run_job(fn, data, active=None):
+    '''
+    Runs the command fn on its request as a job, in one of the export
+    processes or on a thread of the element. An export process doesn't know
+    which recordings are active, so it's given the names of the ones that
+    were when the job was started s.t. it doesn't write their indexes or
+    take their names. Returns the error code and string of the response and
+    the response itself, unpacked
+    '''
+    global active_recordings
+    if active is not None:
+        active_recordings = dict.fromkeys(active)
+
+    response = fn(data)
+    result = msgpack.unpackb(response.data, raw=False) if response.err_code == 0 else None
+    return response.err_code, response.err_str, result
+
+def _thread_job(fn, *args):
+    '''
+    Runs fn on a thread of its own. Returns a future for its result, same
+    as a pool would
+    '''
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    Thread(target=run, daemon=True).start()
+    return future
+
+def _job_command(fn, key_fields=(), pooled=True):
+    '''
+    Returns the handler of a command that runs fn in the background as a
+    job s.t. long conversions and copies never hold up other commands, in
+    particular start and stop. Jobs run in the export processes, keyed by
+    the key_fields of the request, i.e. by what they write, s.t. two jobs
+    writing the same files run one after the other. Jobs that hand their
+    own work out to the export processes (csv) aren't pooled and run on a
+    thread of the element instead. The handler returns the ID of the job to
+    pass to job_result
+    '''
+    def command(data):
+        global job_count
+        _expire_jobs(jobs, jobs_finished, JOB_RESULT_TTL)
+        job_count += 1
+        job = job_count
+        if pooled:
+            key = tuple(data.get(field) for field in key_fields) if type(data) is dict else None
+            jobs[job] = _export_pool().submit(_run_job, fn, data, list(active_recordings), key=key)
+        else:
+            jobs[job] = _thread_job(_run_job, fn, data)
+        jobs[job].add_done_callback(lambda future: jobs_finished.__setitem__(job, time.monotonic()))
+        return Response({"job": job}, serialize=True)
+
+    return command
+
+def job_result(data):
+    '''
+    Returns the result of a csv, export, slice or merge job. Takes a
+    msgpack'd object with the following fields:
+
+    job: required ID of the job from the command
+    wait: Optional, default false. If true waits for the job to finish, or
+        if a number waits at most that many seconds
+
+    Returns a map noting if the job is done and if so the response of the
+    command under result. Errors of the command are returned as they are.
+    Results are handed back once, after which the job is forgotten. Results
+    not picked up within JOB_RESULT_TTL seconds of the job finishing are
+    dropped.
+    '''
+    _expire_jobs(jobs, jobs_finished, JOB_RESULT_TTL)
+    future = jobs.get(data.get("job")) if type(data) is dict else None
+    if future is None:
+        return Response(err_code=12, err_str="No job {}".format(
+            data.get("job") if type(data) is dict else None), serialize=True)
+
+    job = data["job"]
+    _wait_job(future, data.get("wait", False))
+    if not future.done():
+        return Response({"job": job, "done": False}, serialize=True)
+
+    jobs.pop(job, None)
+    jobs_finished.pop(job, None)
+    try:
+        err_code, err_str, result = future.result()
+    except Exception as e:
+        return Response(err_code=13, err_str="Job failed: {}".format(e), serialize=True)
+
+    if err_code != 0:
+        return Response(err_code=err_code, err_str=err_str, serialize=True)
+    return Response({"job": job, "done": True, "result": result}, serialize=True)
 
 if __name__ == '__main__':
     elem = Element("record", host=ATOM_HOST)
     elem.command_add("start", start_recording, timeout=1000, deserialize=True)
     elem.command_add("stop", stop_recording, timeout=1000, deserialize=True)
     elem.command_add("wait", wait_recording, timeout=60000, deserialize=True)
+    elem.command_add("trigger", trigger_recording, timeout=1000, deserialize=True)
     elem.command_add("list", list_recordings, timeout=1000)
     elem.command_add("get", get_recording, timeout=1000, deserialize=True)
-    elem.command_add("plot", plot_recording, timeout=1000000, deserialize=True)
-    elem.command_add("csv", csv_recording, timeout=10000, deserialize=True)
+    elem.command_add("plot", plot_recording, timeout=1000, deserialize=True)
+    elem.command_add("csv", _job_command(csv_recording, pooled=False), timeout=1000, deserialize=True)
+    elem.command_add("plot_result", plot_result, timeout=1000000, deserialize=True)
+    elem.command_add("export", _job_command(export_recording, ("name", "desc", "perm")), timeout=1000, deserialize=True)
+    elem.command_add("replay", replay_recording, timeout=1000, deserialize=True)
+    elem.command_add("replay_stop", stop_replay, timeout=1000, deserialize=True)
+    elem.command_add("replay_wait", wait_replay, timeout=60000, deserialize=True)
+    elem.command_add("slice", _job_command(slice_recording, ("out", "perm")), timeout=1000, deserialize=True)
+    elem.command_add("merge", _job_command(merge_recording, ("out", "perm")), timeout=1000, deserialize=True)
+    elem.command_add("job_result", job_result, timeout=1000000, deserialize=True)
+    elem.command_add("cache", cache_stats, timeout=1000)
+    elem.command_add("stats", recorder_stats, timeout=1000)
 
-    # Want to launch the plot thread s.t. our plot API can return quickly
+    if STATS_PUBLISH_SEC > 0:
+        _publish_stats(STATS_PUBLISH_SEC)
 
     elem.command_loop()